@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+
+"""
+Benchmarks of kajgps on synthetic tracks, to see whether a change makes
+kajgps faster
+
+Usage: python kajbench.py -sizes=1000,10000,100000 -save=baseline.json
+       python kajbench.py -compare=baseline.json
+       python kajbench.py -sizes=all  (SIZES, up to 10M points: hours)
+Other parameters: -formats=gpx,csv,CSV -seconds=1 -breaks=4 -climbs=3
+-places=2 (per km of track) -repeat=1 -seed=1
+"""
+
+from math import radians, sin, cos, pi
+
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import kajgeo as geo
+import kajlib as lib
+import kajgps
+
+if sys.version_info < (3,):
+    range = xrange
+
+SIZES = [1000, 10000, 100000, 1000000, 10000000]  # From 1k to 10M points
+
+
+class SyntheticTrack(object):
+    """
+    Deterministic random walk: the same parameters give the same track,
+    as GPX, kajgps CSV or Columbus CSV, point by point (no list in memory)
+    """
+    START = datetime.datetime(2000, 1, 1, 8, 0, 0)
+    LAT = 60.16218  # Starting point, in the Turku archipelago
+    LON = 21.91810
+
+    def __init__(self, points, seconds=1, breaks=4, break_s=600, climbs=3,
+                 climb_m=150, speed_kmh=10.0, places_per_km=2.0, seed=1):
+        self.points = points
+        self.seconds = seconds  # Sampling interval
+        self.breaks = breaks  # Stops, evenly spread, of break_s each
+        self.break_s = break_s
+        self.climbs = climbs  # Up and down again, of climb_m each
+        self.climb_m = climb_m
+        self.speed_kmh = speed_kmh
+        self.places_per_km = places_per_km
+        self.seed = seed
+
+    def __str__(self):
+        s = "SyntheticTrack %s points every %s s, %s breaks, %s climbs"
+        return s % (self.points, self.seconds, self.breaks, self.climbs)
+
+    def trackpoints(self):
+        """(lat, lon, alt, datetime) of each point, one after another"""
+        rnd = random.Random(self.seed)
+        lat = self.LAT
+        lon = self.LON
+        heading = rnd.uniform(0, 2 * pi)
+        break_points = 0
+        if self.breaks > 0:  # At most a quarter of the track standing still
+            break_points = min(self.break_s // self.seconds,
+                               self.points // (4 * self.breaks))
+        moving_points = max(self.points - self.breaks * break_points, 1)
+        break_every = max(moving_points // (self.breaks + 1), 1)
+        still_left = 0
+        moved = 0
+        for i in range(self.points):
+            a_datetime = self.START + datetime.timedelta(
+                seconds=i * self.seconds)
+            share = moved / float(moving_points)
+            alt = 10 + self.climb_m * abs(sin(pi * self.climbs * share))
+            yield lat, lon, round(alt, 1), a_datetime
+            if still_left > 0:
+                still_left -= 1
+                continue
+            moved += 1
+            if (self.breaks > 0 and moved % break_every == 0 and
+                    moved // break_every <= self.breaks):
+                still_left = break_points
+            heading += radians(rnd.gauss(0, 10))
+            km = (self.speed_kmh * rnd.uniform(0.7, 1.3) *
+                  self.seconds / 3600.0)
+            lat += geo.km2lat_diff(km * cos(heading))
+            lon += geo.km2lon_diff(km * sin(heading), lat)
+
+    def gpx_lines(self):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<gpx version="1.1" creator="kajbench">\n'
+        yield '<trk><name>Benchmark</name><trkseg>\n'
+        for lat, lon, alt, a_datetime in self.trackpoints():
+            yield '<trkpt lat="%.6f" lon="%.6f">\n' % (lat, lon)
+            yield '<ele>%s</ele>\n' % alt
+            yield '<time>%sZ</time>\n' % a_datetime.isoformat()
+            yield '</trkpt>\n'
+        yield '</trkseg></trk>\n</gpx>\n'
+
+    def csv_lines(self):
+        yield 'date,time,lat,lon,alt\n'
+        for lat, lon, alt, a_datetime in self.trackpoints():
+            yield '%s,%s,%.6f,%.6f,%s\n' % (
+                a_datetime.date(), a_datetime.time(), lat, lon, alt)
+
+    def columbus_lines(self):
+        yield ('INDEX,TAG,DATE,TIME,LATITUDE N/S,LONGITUDE E/W,HEIGHT,'
+               'SPEED,HEADING,VOX\n')
+        for i, (lat, lon, alt, a_datetime) in enumerate(self.trackpoints()):
+            yield '%s,T,%s,%s,%.6f%s,%.6f%s,%d,0,0,\n' % (
+                i + 1, a_datetime.strftime("%y%m%d"),
+                a_datetime.strftime("%H%M%S"),
+                abs(lat), "N" if lat >= 0 else "S",
+                abs(lon), "E" if lon >= 0 else "W", alt)
+
+    def places_lines(self):
+        """ge_places.csv with places_per_km placemarks near the track"""
+        rnd = random.Random(self.seed + 1)
+        yield 'placemark,descr,placetype_id,prominence,lat,lon,alt,folder,' \
+              'color\n'
+        if self.places_per_km <= 0:
+            return
+        every_km = 1.0 / self.places_per_km
+        next_km = 0.0
+        km = 0.0
+        previous = None
+        i = 0
+        for lat, lon, alt, a_datetime in self.trackpoints():
+            if previous is not None:
+                km += geo.distance(previous[0], previous[1], lat, lon)
+            previous = (lat, lon)
+            if km < next_km:
+                continue
+            next_km += every_km
+            i += 1
+            pm_lat = lat + geo.km2lat_diff(rnd.uniform(-0.5, 0.5))
+            pm_lon = lon + geo.km2lon_diff(rnd.uniform(-0.5, 0.5), lat)
+            yield 'Place %s,,village,%s,%.5f,%.5f,%d,,\n' % (
+                i, rnd.randint(1, 9), pm_lat, pm_lon, alt)
+
+    def save_as(self, filename):
+        """By extension: .gpx, .csv or .CSV (Columbus); ge_places*.csv"""
+        if os.path.basename(filename).startswith("ge_places"):
+            lines = self.places_lines()
+        elif filename.endswith(".gpx"):
+            lines = self.gpx_lines()
+        elif filename.endswith(".CSV"):
+            lines = self.columbus_lines()
+        elif filename.endswith(".csv"):
+            lines = self.csv_lines()
+        else:
+            raise Exception("SyntheticTrack.save_as: Unknown format %s" %
+                            filename)
+        with open(filename, "w") as f:
+            f.writelines(lines)
+        return os.path.getsize(filename)
+
+
+class Benchmark(object):
+    """Seconds, points per second and MB per second of each stage"""
+    STAGES = [  # Spans of kajgps, see lib.Span
+        ("import", "import"), ("still points", "import/still points"),
+        ("segmentation", "segmentation"), ("transits", "transits"),
+        ("compression", "compression")]
+    EXPORTERS = ["json", "gpx", "kml", "svg"]
+    ROW = {'header': "Benchmark", 'parameters': "", 'activity_id': "run",
+           'lat': "", 'lon': "", 'km': ""}  # As in Command.as_dict
+
+    def __init__(self, sizes, formats=("gpx", "csv", "CSV"), repeat=1,
+                 **track_params):
+        self.sizes = sizes
+        self.formats = formats
+        self.repeat = repeat
+        self.track_params = track_params
+        self.results = []
+        self.dir_ = None
+
+    def __str__(self):
+        s = "Benchmark sizes %s formats %s repeat %s %s"
+        return s % (",".join(str(size) for size in self.sizes),
+                    ",".join(self.formats), self.repeat, self.track_params)
+
+    def run(self):
+        lib.start_log("kajbench")  # As in Command, for the HTML footers
+        self.dir_ = tempfile.mkdtemp(prefix="kajbench")
+        try:
+            for size in self.sizes:
+                self._run_size(size)
+        finally:
+            shutil.rmtree(self.dir_)
+        return self.results
+
+    def _add(self, stage, size, seconds, points, file_format="",
+             n_bytes=None):
+        result = {'stage': stage, 'size': size, 'format': file_format,
+                  'seconds': round(seconds, 6),
+                  'points_per_s': (int(round(points / seconds))
+                                   if seconds else None),
+                  'mb_per_s': (round(n_bytes / 1e6 / seconds, 3)
+                               if n_bytes is not None and seconds else None)}
+        self.results.append(result)
+        print(self.result_line(result))
+
+    @staticmethod
+    def result_line(result):
+        return "%-22s %9s %-4s %10.4f s %12s points/s %9s MB/s" % (
+            result['stage'], result['size'], result['format'],
+            result['seconds'], result['points_per_s'], result['mb_per_s'])
+
+    def _best_of(self, func):
+        """(lowest seconds of self.repeat calls of func, its result)"""
+        best = None
+        for _ in range(self.repeat):
+            started = time.time()
+            result = func()
+            seconds = time.time() - started
+            if best is None or seconds < best[0]:
+                best = (seconds, result)
+        return best
+
+    def _run_size(self, size):
+        synthetic = SyntheticTrack(size, **self.track_params)
+        size_dir = os.path.join(self.dir_, str(size))
+        os.makedirs(size_dir)
+        places_file = os.path.join(size_dir, "ge_places.csv")
+        synthetic.save_as(places_file)
+        self.use_places(places_file)
+        for file_format in self.formats:
+            filename = os.path.join(size_dir, "track." + file_format)
+            n_bytes = synthetic.save_as(filename)
+            self._run_track(filename, file_format, size, n_bytes)
+        self._run_tracklist(size_dir, size)
+
+    @staticmethod
+    def use_places(places_file):
+        """The synthetic places, each a sub-area of area Benchmark"""
+        areas = {'Benchmark': {'order': 0, 'sub_areas': []}}
+        kajgps._areas = areas
+        kajgps._places = kajgps.Places(places_file)
+        for i, pm in enumerate(kajgps._places):
+            areas[pm.text] = {'area': 'Benchmark', 'order_area': 0,
+                              'order_sub_area': i}
+
+    def _run_track(self, filename, file_format, size, n_bytes):
+        """Track import and analysis by span; each exporter, for gpx"""
+        def analysed():
+            lib.start_stats()
+            try:
+                return kajgps.Track(filename, server_level=True,
+                                    **self.ROW)
+            finally:
+                stats.append(lib.stop_stats())
+        stats = []
+        track = self._best_of(analysed)[1]
+        spans = dict((span['span'], span['seconds'])
+                     for span in min(stats, key=lambda s: s['seconds'])
+                     ['spans'])
+        for stage, span in self.STAGES:
+            if span in spans:
+                self._add(stage, size, spans[span], size, file_format,
+                          n_bytes if stage == "import" else None)
+        if file_format != "gpx":
+            return
+        for exporter in self.EXPORTERS:
+            seconds, output = self._best_of(
+                lambda: format(track, exporter))
+            self._add("export " + exporter, size, seconds, size, exporter,
+                      len(output))
+
+    def _run_tracklist(self, size_dir, size):
+        """Tracklist scan into a track cache, then TrackCache renders"""
+        track_dir = os.path.join(size_dir, "tracks")
+        os.makedirs(track_dir)
+        shutil.copy(os.path.join(size_dir, "track.gpx"), track_dir)
+        cache_dir = os.path.join(size_dir, "cache")
+
+        def scanned():
+            tracklist = kajgps.Tracklist(track_dir, mode="cache",
+                                         **dict(self.ROW, parameters="year"))
+            tracklist.save_as(cache_dir)
+        seconds = self._best_of(scanned)[0]
+        self._add("Tracklist scan", size, seconds, size)
+        shutil.copy(os.path.join(cache_dir, "ge_segments.csv"),
+                    os.path.join(cache_dir, "ge_segments_new.csv"))
+        seconds, cache = self._best_of(lambda: kajgps.TrackCache(
+            cache_dir, **dict(self.ROW, mode="landscape",
+                              lat=SyntheticTrack.LAT, lon=SyntheticTrack.LON,
+                              km=50)))  # The random walk fits, mostly
+        self._add("TrackCache read", size, seconds, size)
+        for exporter in ["svg", "html", "kml"]:
+            seconds, output = self._best_of(
+                getattr(cache, "as_" + exporter))
+            self._add("TrackCache " + exporter, size, seconds, size,
+                      exporter, len(output))
+
+    def as_dict(self):
+        return {'created': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'benchmark': str(self), 'results': self.results}
+
+    def save_as(self, filename):
+        lib.save_as(filename, json.dumps(self.as_dict(), indent=1,
+                                         sort_keys=True,
+                                         separators=(",", ": ")) + "\n",
+                    verbose=True)
+
+    def compare(self, baseline_file):
+        """Seconds of each stage now / seconds in the baseline"""
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        before = dict(((r['stage'], r['size'], r['format']), r['seconds'])
+                      for r in baseline['results'])
+        s = "\nCompared with %s (%s)\n" % (baseline_file,
+                                           baseline['created'])
+        s += "%-22s %9s %-4s %10s %10s %7s\n" % (
+            "Stage", "Points", "", "Before s", "Now s", "Ratio")
+        for result in self.results:
+            key = (result['stage'], result['size'], result['format'])
+            if key not in before:
+                continue
+            ratio = (result['seconds'] / before[key] if before[key]
+                     else float("nan"))
+            s += "%-22s %9s %-4s %10.4f %10.4f %7.2f\n" % (
+                key + (before[key], result['seconds'], ratio))
+        return s
+
+
+def main(argv):
+    params = {'sizes': "1000,10000,100000", 'formats': "gpx,csv,CSV",
+              'repeat': "1", 'seconds': "1", 'breaks': "4", 'climbs': "3",
+              'places': "2", 'seed': "1", 'save': "", 'compare': ""}
+    for arg in argv[1:]:
+        param, _, val = arg.partition("=")
+        if param[1:] not in params:
+            raise Exception("kajbench: Unknown parameter %s\n%s" %
+                            (arg, __doc__))
+        params[param[1:]] = val
+    sizes = (SIZES if params['sizes'] == "all" else
+             [int(size) for size in params['sizes'].split(",")])
+    benchmark = Benchmark(
+        sizes,
+        formats=params['formats'].split(","),
+        repeat=int(params['repeat']), seconds=int(params['seconds']),
+        breaks=int(params['breaks']), climbs=int(params['climbs']),
+        places_per_km=float(params['places']), seed=int(params['seed']))
+    print(benchmark)
+    benchmark.run()
+    if params['save'] != "":
+        benchmark.save_as(params['save'])
+    if params['compare'] != "":
+        print(benchmark.compare(params['compare']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+
+"""
+Differential test of two versions of kajgps on a corpus of tracks: the
+segments, distances and exports (KML, SVG, JSON) of a reference version
+against this one, compared structurally, numbers within a tolerance
+
+Usage: python kajdiff.py -ref=main -corpus=~/tracks
+       python kajdiff.py -ref=../kajgps-old -synthetic=1000,10000
+-ref is a git revision of this repository, or a directory with kajgps.py
+Other parameters: -formats=kml,svg,json -tolerance=0.0001 (relative)
+-ignore=regex (text not compared) -keep=dir (keeps both runs)
+"""
+
+from xml.etree import ElementTree
+
+import datetime
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import kajbench
+
+_py_dir = os.path.dirname(os.path.realpath(__file__))
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+
+
+class Side(object):
+    """One version of kajgps, run on the corpus in a directory of its own"""
+    CONFIG_PY = "kajdiff_config"  # Empty module for -config=, server level
+
+    def __init__(self, name, source, run_dir):
+        self.name = name
+        self.source = source  # Directory, or git revision of this repo
+        self.dir_ = os.path.join(run_dir, name)
+        self.seconds = 0.0
+        self.failures = []
+
+    def __str__(self):
+        return "%s (%s): %.2f s" % (self.name, self.source, self.seconds)
+
+    def prepare(self, config_dir):
+        """The code of the version, with the config of this one"""
+        os.makedirs(self.dir_)
+        if os.path.isdir(self.source):
+            for filename in os.listdir(self.source):
+                if filename.endswith(".py"):
+                    shutil.copy(os.path.join(self.source, filename),
+                                self.dir_)
+            shutil.copytree(os.path.join(self.source, "svg"),
+                            os.path.join(self.dir_, "svg"))
+        else:
+            archive = subprocess.Popen(
+                ["git", "archive", self.source], cwd=_py_dir,
+                stdout=subprocess.PIPE)
+            subprocess.check_call(["tar", "-x", "-C", self.dir_],
+                                  stdin=archive.stdout)
+            if archive.wait() != 0:
+                raise Exception("kajdiff: No git revision %s" % self.source)
+        shutil.copytree(config_dir, os.path.join(self.dir_, "config"))
+        os.makedirs(os.path.join(self.dir_, "out"))
+        open(os.path.join(self.dir_, self.CONFIG_PY + ".py"), "w").close()
+
+    def run(self, corpus, formats, commands_header):
+        """KML and SVG by ge_commands.csv, JSON at server level"""
+        rows = [commands_header]
+        for i, infile in enumerate(corpus):
+            for file_format in formats:
+                if file_format != "json":
+                    rows.append("Track,,,Kajdiff,run,,,,%s,%s" % (
+                        infile, self.outfile(i, file_format)))
+        if len(rows) > 1:
+            commands = os.path.join(self.dir_, "config", "ge_commands.csv")
+            with open(commands, "w") as f:
+                f.write("\n".join(rows) + "\n")
+            self._kajgps([])
+        if "json" in formats:
+            for i, infile in enumerate(corpus):
+                self._kajgps(["-config=" + self.CONFIG_PY, "-i=" + infile,
+                              "-o=" + self.outfile(i, "json"), "-ofmt=json"])
+
+    def _kajgps(self, args):
+        started = time.time()
+        with open(os.path.join(self.dir_, "kajdiff.log"), "a") as log:
+            returncode = subprocess.call(
+                [sys.executable, "kajgps.py"] + args, cwd=self.dir_,
+                stdout=log, stderr=subprocess.STDOUT)
+        self.seconds += time.time() - started
+        if returncode != 0:
+            self.failures.append("kajgps.py %s: exit code %s, see %s" % (
+                " ".join(args), returncode,
+                os.path.join(self.dir_, "kajdiff.log")))
+
+    @staticmethod
+    def outfile(i, file_format):
+        return os.path.join("out", "%03d.%s" % (i + 1, file_format))
+
+    def output(self, i, file_format):
+        """Contents of an output file, None if missing"""
+        filename = os.path.join(self.dir_, self.outfile(i, file_format))
+        if not os.path.exists(filename):
+            return None
+        opener = gzip.open if file_format == "svgz" else open
+        with opener(filename, "rb") as f:
+            return f.read()
+
+
+class Differences(object):
+    """Differences between two outputs, by path within the output"""
+    MAX_LISTED = 5
+
+    def __init__(self, tolerance, ignore):
+        self.tolerance = tolerance
+        self.ignore = ignore  # Compiled regexes
+        self.list = []
+        self.tolerated = 0  # Texts with numbers differing, but close
+
+    def __len__(self):
+        return len(self.list)
+
+    def __str__(self):
+        s = ""
+        for path, ref, new in self.list[:self.MAX_LISTED]:
+            s += "    %s\n      ref: %s\n      new: %s\n" % (
+                path, self._short(ref), self._short(new))
+        if len(self.list) > self.MAX_LISTED:
+            s += "    ... %s more\n" % (len(self.list) - self.MAX_LISTED)
+        return s
+
+    @staticmethod
+    def _short(value):
+        text = repr(value)
+        return text if len(text) <= 100 else text[:97] + "..."
+
+    def add(self, path, ref, new):
+        self.list.append((path, ref, new))
+
+    def text(self, path, ref, new):
+        """Equal text, apart from ignored parts and numbers close enough"""
+        ref = self._masked(ref or "")
+        new = self._masked(new or "")
+        if ref == new:
+            return
+        ref_numbers = [float(n) for n in _NUMBER.findall(ref)]
+        new_numbers = [float(n) for n in _NUMBER.findall(new)]
+        same_words = _NUMBER.split(ref) == _NUMBER.split(new)
+        if (same_words and len(ref_numbers) == len(new_numbers) and
+                all(self.close(x, y)
+                    for x, y in zip(ref_numbers, new_numbers))):
+            self.tolerated += 1
+            return
+        self.add(path, ref, new)
+
+    def _masked(self, text):
+        for regex in self.ignore:
+            text = regex.sub("*", text)
+        return text.strip()
+
+    def close(self, x, y):
+        return abs(x - y) <= self.tolerance * max(1.0, abs(x), abs(y))
+
+    def xml(self, path, ref, new):
+        """Elements compared by tag, attributes, text and children"""
+        if ref.tag != new.tag:
+            self.add(path, ref.tag, new.tag)
+            return
+        for key in sorted(set(ref.attrib) | set(new.attrib)):
+            self.text("%s@%s" % (path, key), ref.get(key), new.get(key))
+        self.text(path, ref.text, new.text)
+        self.text(path + " (tail)", ref.tail, new.tail)
+        ref_children = list(ref)
+        new_children = list(new)
+        if len(ref_children) != len(new_children):
+            self.add(path + " (children)", self._tags(ref_children),
+                     self._tags(new_children))
+        for i, (ref_child, new_child) in enumerate(zip(ref_children,
+                                                       new_children)):
+            self.xml("%s/%s[%s]" % (path, self._tag(ref_child), i + 1),
+                     ref_child, new_child)
+
+    @staticmethod
+    def _tag(element):
+        return element.tag.split("}")[-1]  # Without {namespace}
+
+    @staticmethod
+    def _tags(elements):
+        return " ".join(Differences._tag(e) for e in elements)
+
+    def json(self, path, ref, new):
+        """Dicts by key, lists by position, numbers within tolerance"""
+        number = (int, float)
+        if isinstance(ref, dict) and isinstance(new, dict):
+            for key in sorted(set(ref) | set(new)):
+                if key not in ref or key not in new:
+                    self.add("%s/%s" % (path, key), ref.get(key),
+                             new.get(key))
+                else:
+                    self.json("%s/%s" % (path, key), ref[key], new[key])
+        elif isinstance(ref, list) and isinstance(new, list):
+            if len(ref) != len(new):
+                self.add(path + " (length)", len(ref), len(new))
+            for i, (ref_item, new_item) in enumerate(zip(ref, new)):
+                self.json("%s[%s]" % (path, i), ref_item, new_item)
+        elif (isinstance(ref, number) and isinstance(new, number) and
+              not isinstance(ref, bool) and not isinstance(new, bool)):
+            if ref != new:
+                if self.close(ref, new):
+                    self.tolerated += 1
+                else:
+                    self.add(path, ref, new)
+        elif isinstance(ref, basestring) and isinstance(new, basestring):
+            self.text(path, ref, new)
+        elif ref != new:
+            self.add(path, ref, new)
+
+
+class Kajdiff(object):
+    """Reference and new version on a corpus: differences and speed"""
+    def __init__(self, ref, corpus, formats=("kml", "svg", "json"),
+                 tolerance=0.0001, ignore=(), keep=None):
+        self.corpus = [os.path.abspath(os.path.expanduser(infile))
+                       for infile in corpus]
+        self.formats = formats
+        self.tolerance = tolerance
+        today = datetime.date.today().strftime("%d.%m.%Y")
+        self.ignore = [re.compile(re.escape(today) + r" \d\d:\d\d(:\d\d)?"),
+                       re.compile(r"Response time: [\d:.]+")]
+        self.ignore += [re.compile(regex) for regex in ignore]
+        self.keep = keep
+        self.run_dir = keep or tempfile.mkdtemp(prefix="kajdiff")
+        self.sides = [Side("ref", ref, self.run_dir),
+                      Side("new", _py_dir, self.run_dir)]
+        self.results = []  # (infile, format, Differences or None)
+        self.points = 0
+
+    def run(self):
+        commands = os.path.join(_py_dir, "config", "ge_commands.csv")
+        with open(commands) as f:
+            commands_header = f.readline().strip()
+        self.points = sum(count_points(infile) for infile in self.corpus)
+        try:
+            for side in self.sides:
+                side.prepare(os.path.join(_py_dir, "config"))
+                side.run(self.corpus, self.formats, commands_header)
+            self._compare()
+        finally:
+            if self.keep is None:
+                shutil.rmtree(self.run_dir)
+
+    def _compare(self):
+        ref, new = self.sides
+        for i, infile in enumerate(self.corpus):
+            for file_format in self.formats:
+                ref_output = ref.output(i, file_format)
+                new_output = new.output(i, file_format)
+                if ref_output is None or new_output is None:
+                    self.results.append((infile, file_format, None))
+                    continue
+                differences = Differences(self.tolerance, self.ignore)
+                try:
+                    if file_format == "json":
+                        differences.json("", json.loads(ref_output),
+                                         json.loads(new_output))
+                    else:
+                        ref_root = ElementTree.fromstring(ref_output)
+                        differences.xml(Differences._tag(ref_root), ref_root,
+                                        ElementTree.fromstring(new_output))
+                except (ValueError, SyntaxError):  # Not JSON or XML
+                    differences = Differences(self.tolerance, self.ignore)
+                    differences.text("(text)", ref_output, new_output)
+                self.results.append((infile, file_format, differences))
+
+    @property
+    def differs(self):
+        return [result for result in self.results
+                if result[2] is None or len(result[2]) > 0]
+
+    def report(self):
+        s = ""
+        for infile, file_format, differences in self.results:
+            name = "%s %s" % (os.path.basename(infile), file_format)
+            if differences is None:
+                s += "%-40s MISSING OUTPUT\n" % name
+            elif len(differences) > 0:
+                s += "%-40s DIFFERENT (%s)\n%s" % (name, len(differences),
+                                                    differences)
+            elif differences.tolerated > 0:
+                s += "%-40s same, %s within tolerance\n" % (
+                    name, differences.tolerated)
+            else:
+                s += "%-40s same\n" % name
+        points = self.points
+        s += "\n%s tracks, %s points, %s\n" % (
+            len(self.corpus), points, ", ".join(self.formats))
+        for side in self.sides:
+            s += "%s, %s points/s\n" % (
+                side, int(points / side.seconds) if side.seconds else "-")
+            for failure in side.failures:
+                s += "  FAILED %s\n" % failure
+        ref, new = self.sides
+        if new.seconds:
+            s += "Speedup %.2fx\n" % (ref.seconds / new.seconds)
+        s += ("%s outputs of %s differ\n" %
+              (len(self.differs), len(self.results)))
+        return s
+
+
+def count_points(infile):
+    """Trackpoints in a GPX file, or rows of points in a CSV file"""
+    with open(infile) as f:
+        if infile.endswith(".gpx"):
+            return sum(line.count("</trkpt>") for line in f)
+        return sum(1 for line in f if line[:1].isdigit())
+
+
+def synthetic_corpus(sizes, dir_):
+    """kajbench.SyntheticTrack of each size, as GPX files in dir_"""
+    corpus = []
+    for size in sizes:
+        filename = os.path.join(dir_, "synthetic_%s.gpx" % size)
+        kajbench.SyntheticTrack(size).save_as(filename)
+        corpus.append(filename)
+    return corpus
+
+
+def main(argv):
+    params = {'ref': "", 'corpus': "", 'synthetic': "",
+              'formats': "kml,svg,json", 'tolerance': "0.0001",
+              'ignore': "", 'keep': ""}
+    for arg in argv[1:]:
+        param, _, val = arg.partition("=")
+        if param[1:] not in params:
+            raise Exception("kajdiff: Unknown parameter %s\n%s" %
+                            (arg, __doc__))
+        params[param[1:]] = val
+    if params['ref'] == "":
+        raise Exception("kajdiff: -ref missing\n%s" % __doc__)
+    corpus = []
+    for path in params['corpus'].split(","):
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            corpus += sorted(os.path.join(path, filename)
+                             for filename in os.listdir(path)
+                             if filename.endswith((".gpx", ".csv", ".CSV")))
+        elif path != "":
+            corpus.append(path)
+    synthetic_dir = None
+    if params['synthetic'] != "":
+        synthetic_dir = tempfile.mkdtemp(prefix="kajdiff_corpus")
+        corpus += synthetic_corpus(
+            [int(size) for size in params['synthetic'].split(",")],
+            synthetic_dir)
+    kajdiff = Kajdiff(params['ref'], corpus,
+                      formats=params['formats'].split(","),
+                      tolerance=float(params['tolerance']),
+                      ignore=[params['ignore']] if params['ignore'] else [],
+                      keep=params['keep'] or None)
+    try:
+        kajdiff.run()
+    finally:
+        if synthetic_dir is not None:
+            shutil.rmtree(synthetic_dir)
+    print(kajdiff.report())
+    return 1 if kajdiff.differs else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -36,6 +36,21 @@ def distance(lat1, lon1, lat2, lon2):
     return km
 
 
+def distances(lats, lons):
+    """distance() from each point to the next, as a list; first item 0"""
+    lat_rads = [radians(lat) for lat in lats]
+    lon_rads = [radians(lon) for lon in lons]
+    cos_lats = [cos(lat) for lat in lat_rads]
+    result = [0.0] * len(lats)
+    for i in range(1, len(lats)):
+        d_lat = lat_rads[i] - lat_rads[i - 1]
+        d_lon = lon_rads[i] - lon_rads[i - 1]
+        a = (sin(d_lat / 2) ** 2 +
+             cos_lats[i - 1] * cos_lats[i] * sin(d_lon / 2) ** 2)
+        result[i] = 6367 * 2 * asin(sqrt(a))
+    return result
+
+
 def bearing(lat1, lon1, lat2, lon2):
     """Bearing = direction, in degrees"""
     # convert decimal degrees to radians
@@ -5,9 +5,11 @@
 Geodata analysis of tracks; management of placemarks
 
 External usage: kajgps -i=stdin -ifmt=gpx -o=stdout -ofmt=json -log=logfile
+Server: kajgps -serve=host:port (or socket path) -root=dir, see Command._serve
 """
 
-from math import degrees, atan, atan2, log10, sqrt
+from math import degrees, radians, sin, cos, atan, atan2, log10, sqrt
+from bisect import bisect_left
 
 import datetime
 import codecs
@@ -16,6 +18,20 @@ import os
 import csv
 import importlib
 import json
+import marshal
+import cProfile
+import multiprocessing
+import struct
+import time
+import traceback
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ForkingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+except ImportError:  # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ForkingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
 
 from kajlib import logged
 from kajhtml import tr, td, tdr, red
@@ -24,6 +40,7 @@ import kajfmt as fmt
 import kajlib as lib
 import kajhtml
 import kajsvg
+import kajresample as resample
 
 if sys.version_info < (3,):
     range = xrange
@@ -170,6 +187,72 @@ class Trackpoint(Point):
             return 0
 
 
+class SpilledTrackpoints(object):
+    """
+    Trackpoints as imported, for Track._analyse_in_chunks: in memory up
+    to limit points, then all of them in a lib.ColumnSpill. Spilled, the
+    text is not kept, and the altitude only as a number.
+    """
+    COLUMNS = ("lat", "lon", "alt", "seconds")
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_memory = []  # None when spilled
+        self.spill = None
+
+    def __len__(self):
+        if self.spill is None:
+            return len(self.in_memory)
+        return len(self.spill)
+
+    def __getitem__(self, i):
+        return self.trackpoints(i, i + 1)[0]
+
+    def is_spilled(self):
+        return self.spill is not None
+
+    def append(self, tp):
+        if self.spill is None:
+            self.in_memory.append(tp)
+            if len(self.in_memory) <= self.limit:
+                return
+            self.spill = lib.ColumnSpill(self.COLUMNS)
+            for tp in self.in_memory:
+                self._spill(tp)
+            self.in_memory = None
+        else:
+            self._spill(tp)
+
+    def _spill(self, tp):
+        try:
+            alt = float(tp.alt)
+        except ValueError:
+            alt = 0.0
+        self.spill.append((tp.lat, tp.lon, alt,
+                           (tp.datetime - self.EPOCH).total_seconds()))
+
+    def index(self, a_datetime):
+        """First trackpoint at a_datetime or later"""
+        if self.spill is None:
+            return bisect_left([tp.datetime for tp in self.in_memory],
+                               a_datetime)
+        seconds = (a_datetime - self.EPOCH).total_seconds()
+        return self.spill.bisect("seconds", seconds)
+
+    def trackpoints(self, first, stop):
+        if self.spill is None:
+            return self.in_memory[first:stop]
+        return [Trackpoint(lat, lon,
+                           self.EPOCH + datetime.timedelta(seconds=seconds),
+                           alt)
+                for lat, lon, alt, seconds in self.spill.rows(first, stop)]
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
 class Timepoint(Trackpoint):
     """Statistics for one minute hh:mm (hh:mm:00 until hh:m1:00, \
 hh:m1 = one minute later)"""
@@ -400,8 +483,12 @@ class Places(object):
         self.pm_list = []
         self.name_dict = {}
         self.filename = infile
+        snapshot = kwargs.pop('snapshot', None)
         self.kwargs = kwargs
         self.kwargs['infile'] = infile
+        if snapshot is not None:  # As returned by snapshot(), no file read
+            self.restore(snapshot)
+            return
         create_empty_collection = infile is None
         if create_empty_collection:
             return
@@ -537,6 +624,18 @@ class Places(object):
     def add(self, pm):  # Add an individual Placemark object
         self.pm_list.append(pm)
 
+    def snapshot(self):
+        """Placemarks as plain dicts, to be saved with marshal"""
+        return [dict(pm.__dict__) for pm in self.pm_list]
+
+    def restore(self, pm_dicts):
+        """Placemarks from snapshot(), without area and placetype lookups"""
+        for pm_dict in pm_dicts:
+            pm = Placemark.__new__(Placemark)
+            pm.__dict__.update(pm_dict)
+            self.pm_list.append(pm)
+        self._create_name_dict()
+
     def _copy(self):
         original = self.kwargs.get('original')
         forced_breaks = self.kwargs.get('forced_breaks')
@@ -553,6 +652,7 @@ class Places(object):
                 if pm.inside(p1, p2):
                     self.add(fb)
 
+    @lib.timed("export kml")
     def as_kml(self, with_descr=False):  # Places as kml
         k = kml.doc_header(self.filename)
         self.sort_by_hierarchy()
@@ -592,6 +692,7 @@ class Places(object):
         k += kml.doc_footer()
         return k
 
+    @lib.timed("export html")
     def as_html(self):
         self.sort_by_category()
         html.set_title_desc(self.kwargs['header'], self.kwargs['infile'])
@@ -613,14 +714,11 @@ class Places(object):
         self.sort_by_prominence()
         return h
 
+    @lib.timed("export svg")
     def as_svg(self):
 
-        if os.path.exists(_svg_icon_file):
-            with codecs.open(_svg_icon_file) as f:
-                svg_icons = f.read()
-        else:
+        if not os.path.exists(_svg_icon_file):
             userbug.add("Track as_svg missing icons file %s" % _svg_icon_file)
-            svg_icons = ""
 
         title = self.kwargs['header']
         desc = fmt.current_timestamp()
@@ -634,7 +732,7 @@ class Places(object):
         svg_map = SVGMap(svg, fixed=fixed)
         svg.set_title(title, desc)
         s = ""
-        s += svg.doc_header(more_defs=svg_icons)
+        s += svg.doc_header()
         s += svg_map.svg_comment
         s += svg_map.draw_map_frame()
         s += svg_map.plot_map_grid(svg_map.spread_km)
@@ -652,6 +750,7 @@ class Places(object):
             #g += gpx.doc_footer()
             #return g
 
+    @lib.timed("export js")
     def as_js(self):
         js = '''wholefoods_json = {
     "features": [\n'''
@@ -668,7 +767,7 @@ class Places(object):
             return
         if file_format == 'kml':
             a_str = self.as_kml(extended)
-        elif file_format == 'svg':
+        elif file_format in ('svg', 'svgz'):
             a_str = self.as_svg()
         elif file_format == 'html':
             a_str = self.as_html()
@@ -678,6 +777,7 @@ class Places(object):
             raise Exception("Unknown format %s" % str(file_format))
         lib.save_as(filename, a_str, verbose=True)
 
+    @lib.timed("export csv")
     def save_as_csv(self, filename):
         with open(filename, 'w') as csvfile:
             fieldnames = ['placemark', 'descr', 'placetype_id', 'prominence',
@@ -697,8 +797,7 @@ class Places(object):
     def closest_placemark(self, point):
         dist = 99999
         if self.count() == 0:
-            empty = Placemark("-", -point.lat, (180+point.lon))
-            return empty
+            return self._antipode(point)
             #raise Exception("closest_placemark: 0 placemarks to compute from.")
         closest_pm = self.pm_list[0]
         for pm in self.pm_list:
@@ -710,6 +809,36 @@ class Places(object):
                 closest_pm = pm
         return closest_pm
 
+    def closest_placemarks(self, points):
+        """closest_placemark of many points, sharing the placemark setup"""
+        if self.count() == 0:
+            return [self._antipode(point) for point in points]
+        # Comparing the haversine term a ranks as distance() does
+        candidates = [(radians(pm.lat), radians(pm.lon),
+                       cos(radians(pm.lat)), pm)
+                      for pm in self.pm_list if not pm.dynamic]
+        lib.count("haversine calls", len(candidates) * len(points))
+        result = []
+        for point in points:
+            lat = radians(point.lat)
+            lon = radians(point.lon)
+            cos_lat = cos(lat)
+            closest_a = 2  # a is at most 1
+            closest_pm = self.pm_list[0]
+            for pm_lat, pm_lon, pm_cos_lat, pm in candidates:
+                a = (sin((pm_lat - lat) / 2) ** 2 +
+                     cos_lat * pm_cos_lat * sin((pm_lon - lon) / 2) ** 2)
+                if a < closest_a:
+                    closest_a = a
+                    closest_pm = pm
+            result.append(closest_pm)
+        return result
+
+    @staticmethod
+    def _antipode(point):
+        """Placeholder closest placemark when there are none"""
+        return Placemark("-", -point.lat, (180+point.lon))
+
     def sort_by_prominence(self):
         self.pm_list.sort(key=Placemark.by_prominence)
 
@@ -755,27 +884,34 @@ class Tracklist(object):
     @logged
     def _scan_hd(self, dir_, mode):
         file_extensions = tuple([".gpx", ".CSV", ".csv"])
-        i = 0
+        full_filenames = []
         for directory, dirs, files in os.walk(dir_):
             for just_filename in files:
                 if just_filename.endswith(file_extensions):
-                    full_filename = os.path.join(directory, just_filename)
-                    i += 1
-                    track = Track(full_filename, mode=mode, diary=self)
-                    if track.count() == 0:
-                        continue
-                    track_dict = track.as_dict()
-                    if i == 1:
-                        self.min_date = track.date
-                        self.max_date = track.date
-                    self.min_date = min(self.min_date, track.date)
-                    self.max_date = max(self.max_date, track.date)
-                    track_dict['track'] = track
-                    self.tracks.append(track_dict)
-                    if mode == "segments":
-                        for segment in track.segments:
-                            seg_dict = segment.as_dict()
-                            self.segments.append(seg_dict)
+                    full_filenames.append(os.path.join(directory,
+                                                       just_filename))
+        sizes = [os.path.getsize(filename) for filename in full_filenames]
+        progress = lib.Progress("Tracklist", len(full_filenames), sum(sizes))
+        for i, full_filename in enumerate(full_filenames, 1):
+            track = Track(full_filename, mode=mode, diary=self,
+                          progress=progress)
+            progress.add(n_bytes=sizes[i - 1], points=track.count())
+            if track.count() == 0:
+                continue
+            track_dict = track.as_dict()
+            if i == 1:
+                self.min_date = track.date
+                self.max_date = track.date
+            self.min_date = min(self.min_date, track.date)
+            self.max_date = max(self.max_date, track.date)
+            track_dict['track'] = track
+            self.tracks.append(track_dict)
+            if mode == "segments":
+                for segment in track.segments:
+                    seg_dict = segment.as_dict()
+                    seg_dict['date'] = segment.first['tp'].datetime.date()
+                    self.segments.append(seg_dict)
+        progress.done()
         self._calc_nwse()
         self._calc_values()
         if mode != "segments":
@@ -890,7 +1026,7 @@ class Tracklist(object):
             a_str = self.as_kml()
         elif file_format == 'html':
             a_str = self.as_html()
-        elif file_format == 'svg':
+        elif file_format in ('svg', 'svgz'):
             a_str = self.as_svg()
         else:
             create_cache = self.mode == "cache"
@@ -957,6 +1093,7 @@ class Tracklist(object):
         Segment.save_as_csv(filename, self.seg_dicts, comment)
 
     @logged
+    @lib.timed("export csv")
     def save_as_csv(self, filename):
         skim_fields = 'date activity_id timezone name distance lat lon comment'
         diary_fields = ('hm_to_hm activity_id name area a_dist_fmt ' +
@@ -1085,6 +1222,7 @@ class Tracklist(object):
         return "? 60"
 
     @logged
+    @lib.timed("export kml")
     def as_kml(self):
         hdr = self.header + " " + self.track_base_dir
         k = kml.doc_header(hdr)
@@ -1140,6 +1278,7 @@ class Tracklist(object):
         return k
 
     @logged
+    @lib.timed("export kml")
     def as_kml_g(self):
         hdr = self.header + " " + self.track_base_dir
         k = kml.doc_header(hdr)
@@ -1206,6 +1345,7 @@ class Tracklist(object):
         return k
 
     @logged
+    @lib.timed("export html")
     def as_html(self):
         html.set_title_desc(self.header, self.track_base_dir)
         h = html.doc_header()
@@ -1270,6 +1410,7 @@ class Tracklist(object):
         h += html.doc_footer()
         return h
 
+    @lib.timed("export svg")
     def as_svg(self):
         s = ""
         last_track = len(self.tracks) - 1
@@ -1300,10 +1441,7 @@ class TrackCache(object):
         self.infile = os.path.join(self.dir_, filename)
         self.header = kwargs['header']
         self.cache = []
-        self.fields = ("date time_start time_stop activity_id " +
-                       "distance duration speed count " +
-                       "hm_up hm_down start_dist name " +
-                       "max_lat min_lat max_lon min_lon").split()
+        self.fields = Segment.CSV_FIELDS
 
         self.activity_id = kwargs['activity_id']
         self.min_date = datetime.datetime.min
@@ -1331,27 +1469,7 @@ class TrackCache(object):
         self._sort_tracks(self.mode)
 
     def _import_csv(self, infile):
-        if not os.path.exists(infile):
-            e = "File '%s' missing; create using Tracklist mode 'segments')"
-            raise Exception(e % infile)
-        with open(infile) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=";")
-            for i, file_dict in enumerate(reader):
-                first_field = file_dict.get('date')
-                is_blank = len(first_field.strip()) == 0
-                is_comment = (first_field + " ")[0] == "#"
-                if not (is_blank or is_comment):
-                    seg_dict = {}
-                    for field in self.fields:
-                        value = file_dict.get(field)
-                        if value is None:
-                            e = "Row %s missing field '%s'.\n" % (i, field)
-                            e += "Fix file '%s'\n" % infile
-                            e += "Mandatory fields: %s" % " ".join(self.fields)
-                            raise Exception(e)
-                        seg_dict[field] = value
-                    Segment.make_numeric(seg_dict)
-                    self.cache.append(seg_dict)
+        self.cache += Segment.read_csv(infile)
 
     @logged
     def save_as(self, filename):
@@ -1363,7 +1481,7 @@ class TrackCache(object):
             a_str = self.as_kml()
         elif file_format == 'html':
             a_str = self.as_html()
-        elif file_format == 'svg':
+        elif file_format in ('svg', 'svgz'):
             a_str = self.as_svg()
         else:
             raise Exception("Unknown file format %s" % file_format)
@@ -1402,6 +1520,7 @@ class TrackCache(object):
             Segment.clean_before_save(seg_dict)
         print("adjust_activity: A total of %s rows changed" % i)
 
+    @lib.timed("export csv")
     def save_as_csv(self):
         filename = os.path.join(self.dir_, 'ge_segments_new.csv')
         with open(filename, 'w') as csvfile:
@@ -1415,6 +1534,7 @@ class TrackCache(object):
                 writer.writerow(seg_dict)
             print("Edited track cache metadata saved on file %s" % filename)
 
+    @lib.timed("export html")
     def as_html(self):
         html.set_title_desc(self.header, "")
         h = html.doc_header()
@@ -1586,6 +1706,7 @@ class TrackCache(object):
         h += html.doc_footer()
         return h
 
+    @lib.timed("export html")
     def as_html_g(self):
         html.set_title_desc(self.kwargs['header'], self.kwargs['infile'])
         h = html.doc_header()
@@ -1612,6 +1733,7 @@ class TrackCache(object):
     def seg_dict_as_html(self, with_date):
         return ""
 
+    @lib.timed("export svg")
     def as_svg(self):
         s = ""
         title = self.header
@@ -1632,6 +1754,7 @@ class TrackCache(object):
     def _load_tracks(self, canvas_area):
         c = len(self.cache)
         j = 0
+        progress = lib.Progress("TrackCache", c)
         for i, seg_dict in enumerate(self.cache):
             filename = Segment.csv_filename(seg_dict)
             activity_id = seg_dict['activity_id']
@@ -1647,7 +1770,9 @@ class TrackCache(object):
             if within_map:
                 track = Track(filename, activity_id=activity_id, mode="read",
                               main_activity_id=self.activity_id,
-                              comment="%s / %s (%s)" % (i + 1, c, j))
+                              comment="%s / %s (%s)" % (i + 1, c, j),
+                              progress=progress)
+                progress.add(points=track.count())
                 seg_dict['track'] = track
                 if j == 0:
                     self.min_date = track.date
@@ -1672,8 +1797,10 @@ class TrackCache(object):
                 seg_dict['order_area'] = sub_area_dict.get('order_area', 0)
                 Segment.update_order(seg_dict)
             else:
+                progress.add()
                 seg_dict.update({'area': 'a', 'order_area': 0, 'sub_area': 'a',
                                  'date_order': 'b', 'date_header': 'c'})
+        progress.done()
 
     def _sort_tracks(self, order):
         if order == "activity":
@@ -1684,6 +1811,7 @@ class TrackCache(object):
             self.cache.sort(key=lambda seg: ("%7d" % seg['order_area']) +
                 seg['order_activity'] + seg['date_order'] + seg['time_start'])
 
+    @lib.timed("export kml")
     def as_kml(self):
         seg_fmt = "{time_start:.5}-{time_stop:.5} {distance_fmt} km "
         seg_fmt += "{duration} {speed_fmt} km/h %s"
@@ -1758,6 +1886,9 @@ class TrackCache(object):
 
 class Segment(object):
     """Stretch of a track, separated by breaks"""
+    CSV_FIELDS = ('date time_start time_stop activity_id distance duration ' +
+                  'speed count hm_up hm_down start_dist name ' +
+                  'max_lat min_lat max_lon min_lon').split()
 
     def __init__(self, track, i_first_tp, i_last_tp, activity_id, type):
         self.track = track
@@ -1838,9 +1969,7 @@ class Segment(object):
         [clean.append(seg) for seg in seg_dicts if seg not in clean]
         seg_dicts = clean
 
-        fields = ('date time_start time_stop activity_id distance duration ' +
-                  'speed count hm_up hm_down start_dist name ' +
-                  'max_lat min_lat max_lon min_lon').split()
+        fields = Segment.CSV_FIELDS
         with open(filename, 'w') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=fields, delimiter=";")
             writer.writeheader()
@@ -1855,6 +1984,45 @@ class Segment(object):
                 writer.writerow(seg_dict)
             print("Segment metadata saved on file %s" % filename)
 
+    @staticmethod
+    def read_csv(infile):
+        """Segment metadata as saved by save_as_csv, no trackpoints"""
+        if not os.path.exists(infile):
+            e = "File '%s' missing; create using Tracklist mode 'segments')"
+            raise Exception(e % infile)
+        fields = Segment.CSV_FIELDS
+        seg_dicts = []
+        with open(infile) as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=";")
+            for i, file_dict in enumerate(reader):
+                first_field = file_dict.get('date')
+                is_blank = len(first_field.strip()) == 0
+                is_comment = (first_field + " ")[0] == "#"
+                if not (is_blank or is_comment):
+                    seg_dict = {}
+                    for field in fields:
+                        value = file_dict.get(field)
+                        if value is None:
+                            e = "Row %s missing field '%s'.\n" % (i, field)
+                            e += "Fix file '%s'\n" % infile
+                            e += "Mandatory fields: %s" % " ".join(fields)
+                            raise Exception(e)
+                        seg_dict[field] = value
+                    Segment.make_numeric(seg_dict)
+                    seg_dicts.append(seg_dict)
+        return seg_dicts
+
+    @staticmethod
+    def start_end_datetimes(seg_dict):
+        """From a seg_dict of read_csv; stop before start = next day"""
+        start = fmt.datetime_from_ymd_hms(seg_dict['date'] + " " +
+                                          seg_dict['time_start'])
+        end = fmt.datetime_from_ymd_hms(seg_dict['date'] + " " +
+                                        seg_dict['time_stop'])
+        if end < start:
+            end += datetime.timedelta(days=1)
+        return start, end
+
     def name(self):
         if self.first['name'] == self.last['name']:
             return self.first['name']
@@ -2206,89 +2374,61 @@ class Segment(object):
         split_lift_in_middle = (self.activity_id == "lift" and
                                 self.i_last_tp - self.i_first_tp == 1)
         marker = "marker-mid='url(#mid)'" if split_lift_in_middle else ""
-        svg.polyline_begin({'stroke': color, 'stroke-dasharray': dashes},
-                           "", marker)
+        xs, ys = self.xy_columns()
         s1 = s2 = ""
-        for i in range(self.i_first_tp, self.i_last_tp + 1):
-            lat = self.track.trackpoints[i].lat
-            lon = self.track.trackpoints[i].lon
-            x, y = svg.map.latlon2xy(lat, lon)
-            svg.polyline_add_point(x, y)
-            if split_lift_in_middle and i == self.i_first_tp:
-                lat2 = self.track.trackpoints[i + 1].lat
-                lon2 = self.track.trackpoints[i + 1].lon
-                mid_lat = (lat + lat2) / 2
-                mid_lon = (lon + lon2) / 2
-                x2, y2 = svg.map.latlon2xy(mid_lat, mid_lon)
-                angle = atan2(x2 - x, y - y2)
-                angle = (degrees(angle) + 180) % 180 + 180
-                svg.polyline_add_point(x2, y2)
-                duration = self.first['time'] + "-" + self.last['time']
-                s1 = svg.plot_text_mm(x2, y2, self.first['name'], style_1,
-                                      angle=angle + 90, dy=-1.5)
-                s2 = svg.plot_text_mm(x2, y2, duration, style_2,
-                                      angle=angle + 90, dy=+2.5)
-        s += svg.plot_polyline()
+        if split_lift_in_middle:
+            tp1, tp2 = self.tp_list()
+            mid_lat = (tp1.lat + tp2.lat) / 2
+            mid_lon = (tp1.lon + tp2.lon) / 2
+            x2, y2 = svg.map.latlon2xy(mid_lat, mid_lon)
+            angle = atan2(x2 - xs[0], ys[0] - y2)
+            angle = (degrees(angle) + 180) % 180 + 180
+            xs.insert(1, x2)
+            ys.insert(1, y2)
+            duration = self.first['time'] + "-" + self.last['time']
+            s1 = svg.plot_text_mm(x2, y2, self.first['name'], style_1,
+                                  angle=angle + 90, dy=-1.5)
+            s2 = svg.plot_text_mm(x2, y2, duration, style_2,
+                                  angle=angle + 90, dy=+2.5)
+        s += svg.plot_polyline_xy(xs, ys, {'stroke': color,
+                                           'stroke-dasharray': dashes},
+                                  "", marker)
         s += s1 + s2
         return s
 
     def as_speed_svg(self):
-        last_colour = svg.speed2colour(0)  # Colour of no movement
-        s = ""
-        last_tp = self.i_first_tp
-        last_x = last_y = 0.0
-        svg.polyline_begin({'stroke': last_colour})
-        for i in range(self.i_first_tp, self.i_last_tp + 1):
-            tp = self.track.trackpoints[i]
-            x, y = svg.map.latlon2xy(tp.lat, tp.lon)
-            if i > self.i_first_tp:
-                speed = tp.speed(last_tp)
-                colour = svg.speed2colour(speed)
-                if colour != last_colour:
-                    s += svg.plot_polyline()
-                    s += svg.comment("Speed %s" % speed)
-                    svg.polyline_begin({'stroke': colour})
-                    svg.polyline_add_point(last_x, last_y)
-                    last_colour = colour
-            svg.polyline_add_point(x, y)
-            last_x = x
-            last_y = y
-            last_tp = tp
-        s += svg.plot_polyline()
-        return s
+        tps = self.tp_list()
+        xs, ys = self.xy_columns()
+        colours = [svg.speed2colour(0)]  # Colour of no movement
+        colours += [svg.speed2colour(tp.speed(prev_tp))
+                    for prev_tp, tp in zip(tps, tps[1:])]
+        return svg.plot_colored_polyline_xy(xs, ys, colours)
 
     def as_slope_svg(self):
-        last_colour = "#" + _activities[self.activity_id].color1
-        s = ""
-        last_x = last_y = 0.0
-        svg.polyline_begin({'stroke': last_colour, 'stroke-width': 0.3})
-        for i in range(self.i_first_tp, self.i_last_tp + 1):
-            tp = self.track.trackpoints[i]
-            colour = self.track.color(tp)
-            x, y = svg.map.latlon2xy(tp.lat, tp.lon)
-            is_first_point = (i == self.i_first_tp)
-            if not is_first_point:
-                slope_changed = (colour != last_colour)
-                if slope_changed:
-                    s += svg.plot_polyline()  # Plot what's in the "buffer"
-                    s += svg.comment("Slope %s" % colour)
-                    svg.polyline_begin({'stroke': colour, 'stroke-width': 0.3})
-                    svg.polyline_add_point(last_x, last_y)
-            lift_pen = svg.polyline_add_point(x, y)
-            if lift_pen:
-                s += svg.plot_polyline()
-                s += svg.comment("Went outside map borders")
-                svg.polyline_begin({'stroke': colour, 'stroke-width': 0.3})
-            last_x = x
-            last_y = y
-            last_colour = colour
-        s += svg.plot_polyline()
-        svg.list_midpoints()
-        return s
+        colours = [self.track.color(tp) for tp in self.tp_list()]
+        xs, ys = self.xy_columns()
+        return svg.plot_colored_polyline_xy(xs, ys, colours,
+                                            {'stroke-width': 0.3})
+
+    def tp_list(self):
+        return self.track.trackpoints[self.i_first_tp:self.i_last_tp + 1]
+
+    def xy_columns(self):
+        """x and y (mm on the current SVG map) of all trackpoints"""
+        tps = self.tp_list()
+        return svg.map.latlons2xys([tp.lat for tp in tps],
+                                   [tp.lon for tp in tps])
 
 
 class Track(object):
     """Collection of Trackpoints, usually as recorded by GPS"""
+    INPUT_FORMATS = ("gpx", "csv", "CSV", "kml", "json")  # See _import_file
+    DECIMATE_MAX_GAP_S = 20  # See _decimate: well within time_window_s
+    DECIMATE_STILL_S = 10
+    CHUNK_POINT_BYTES = 1000  # Memory per point analysed, see _chunk_points
+    CHUNK_MIN_POINTS = 10000
+    CHUNK_OVERLAP_S = 300  # Well over time_window_s and minimum_break_s
+
     def __init__(self, infile, **kwargs):
         kwargs['infile'] = infile
         self.kwargs = kwargs
@@ -2311,8 +2451,11 @@ class Track(object):
         self.tour = []
         self.activities = [self.main_activity_id]
         self.timepoints = {}
+        self.timepoint_width_s = 60
+        self.path_index = None  # See _path_index
         self.date = datetime.datetime.min
         self.timezone_delta = None
+        self.decimation = {}  # See _decimate
 
         if self.mode == "empty":
             return
@@ -2341,17 +2484,28 @@ class Track(object):
 
         print_filename = os.path.split(infile)[1]
         comment = self.kwargs.get('comment', "")
-        if not kwargs.get('server_level') == True:
+        progress = kwargs.get('progress')
+        if progress is not None and progress.in_place:
+            pass  # The progress line tells which file
+        elif not kwargs.get('server_level') == True:
             print("%s - %s: Track(%s) " % (comment, fmt.current_time_hm(),
                                      print_filename))
 
         # Start all over: read "skimmed" first trackpoint again from scratch
+        if self.kwargs.get('stream') is not None:
+            self.kwargs['stream'].rewind()  # Last read of the stream
         self._import_file(infile, mode=self.mode,
                          timezone_delta=self.timezone_delta)
-        self.map_area = geo.calc_nwse(self.trackpoints)
-        p1 = Point(self.map_area['min']['lat'], self.map_area['min']['lon'])
-        p2 = Point(self.map_area['max']['lat'], self.map_area['max']['lon'])
-        self.relevant_places = Places("copy", original=_places, p1=p1, p2=p2)
+        if self.mode == "parse":
+            return  # To be analysed later, see merge
+        self._analyse()
+
+    def _analyse(self):
+        """Segments, activities and compressed versions of the track"""
+        if isinstance(self.trackpoints, SpilledTrackpoints):
+            self._analyse_in_chunks()
+            return
+        self._find_relevant_places()
         if self.mode == "diary":
             return
         #self.create_timepoints()
@@ -2361,17 +2515,17 @@ class Track(object):
             segment = Segment(self, 0, self.count() -1, self.activity_id,
                               "cache")
             self.segments.append(segment)
+            self.calc_track_net()
+            self.compressed = self  # Cached segments are compressed already
             return
         if self.sub_format == "Plan":
             self.compressed = self
         else:
-            self._suggest_segments()
-            for seg in self.segments:
-                seg.parse_segment_for_transits()
-            self._split_track_at_transits()
-            if self.activity_id in ['downhill', 'snowboard']:
-                self._split_track_at_peaks()
-            self.eliminate_too_short_segments()
+            split = self.kwargs.get('split', _split)
+            if split is not None and self.mode in ("", "segment"):
+                self._find_segments_by_day(split)
+            else:
+                self._find_segments()
             self.update_previous_next_pointers()
             self.calc_track_net()
             self._adjust_segment_activities()
@@ -2381,13 +2535,129 @@ class Track(object):
             self.zipped = self._compress_track(0.05)
         if self.mode == "tour":
             tick = 0.1  # 0.1 = 100 m
-            self.equi = self.equidistant_points(self.trackpoints, tick,
-                                                type_="Point")
-            self.running = self.running_average(self.equi, window_points=21)
-            self.trackpoints = self.running
+            self.trackpoints = self.smoothed_equidistant_points(
+                tick, window_points=21)
             self._create_tour()
         # todo faster directly from .compressed?
 
+    def _find_relevant_places(self):
+        self.map_area = geo.calc_nwse(self.trackpoints)
+        p1 = Point(self.map_area['min']['lat'], self.map_area['min']['lon'])
+        p2 = Point(self.map_area['max']['lat'], self.map_area['max']['lon'])
+        with lib.Span("relevant places"):
+            self.relevant_places = Places("copy", original=_places,
+                                          p1=p1, p2=p2)
+
+    def _find_segments(self):
+        self._suggest_segments()
+        with lib.Span("transits"):
+            for seg in self.segments:
+                seg.parse_segment_for_transits()
+            self._split_track_at_transits()
+        if self.activity_id in ['downhill', 'snowboard']:
+            self._split_track_at_peaks()
+        self.eliminate_too_short_segments()
+
+    def _day_ranges(self, split):
+        """
+        (first, stop) trackpoint indexes of each day, or with split in
+        hours, of each part between breaks longer than that
+        """
+        tps = self.trackpoints
+        ranges = []
+        first = 0
+        for i in range(1, len(tps)):
+            if split == "day":
+                new_part = tps[i].datetime.date() != tps[i - 1].datetime.date()
+            else:
+                new_part = tps[i].seconds(tps[i - 1]) > 3600 * split
+            if new_part:
+                ranges.append((first, i))
+                first = i
+        ranges.append((first, len(tps)))
+        return ranges
+
+    @logged
+    def _find_segments_by_day(self, split):
+        """
+        _find_segments of each day (see _day_ranges) as a track of its
+        own, with the timezone (see _shift_to_day_timezones) and activity
+        of its _day_metadata, the days in parallel processes forked from
+        this one. The segments found are then those of this track, from
+        the first day to the last.
+        """
+        global _day_track
+        self._shift_to_day_timezones()
+        parts = []
+        for first, stop in self._day_ranges(split):
+            activity_id = self.activity_id
+            date = self.trackpoints[first].date_yymd()
+            if _day_metadata[date] != "":
+                activity_id = _day_metadata[date].activity_id
+            parts.append((first, stop, activity_id))
+        lib.count("days", len(parts))
+        _day_track = self
+        processes = min(multiprocessing.cpu_count(), len(parts))
+        # Pool processes (see Batch) cannot have processes of their own
+        if (processes > 1 and hasattr(os, 'fork') and
+                not multiprocessing.current_process().daemon):
+            sys.stdout.flush()
+            pool = multiprocessing.Pool(processes)
+            results = pool.map(_find_day_segments, parts)
+            pool.close()
+            pool.join()
+        else:
+            results = [_find_day_segments(part) for part in parts]
+        _day_track = None
+        activity = _activities[self.activity_id]
+        if isinstance(activity, str):
+            activity = _activities['run']
+        minimum_break_s = float(activity.minimum_break_s.replace("s", ""))
+        ranges = []
+        for (first, stop, activity_id), segments in zip(parts, results):
+            for j, (i_first_tp, i_last_tp, seg_activity_id) in enumerate(
+                    segments):
+                i_first_tp += first
+                i_last_tp += first
+                # The first segment of a day may go on from the day before:
+                # no break, or too short a one (as in _suggest_segments)
+                if j == 0 and len(ranges) > 0 and self.trackpoints[
+                        ranges[-1][1]].seconds(self.trackpoints[
+                            i_first_tp]) < minimum_break_s:
+                    ranges[-1][1] = i_last_tp
+                else:
+                    ranges.append([i_first_tp, i_last_tp, seg_activity_id])
+        for i_first_tp, i_last_tp, activity_id in ranges:
+            self.segments.append(Segment(self, i_first_tp, i_last_tp,
+                                         activity_id, "day"))
+
+    def _shift_to_day_timezones(self):
+        """
+        Trackpoints of each day (from source) moved from the timezone of
+        the first day, applied on import, to the timezone of their own
+        day. Not where the time would then go backwards.
+        """
+        if not self.from_source:
+            return
+        tps = self.trackpoints
+        timezone_delta = self.timezone_delta or datetime.timedelta(0)
+        for first, stop in self._day_ranges("day"):
+            date = tps[first].date_yymd()
+            if _day_metadata[date] == "":
+                continue
+            shift = datetime.timedelta(
+                seconds=60 * int(_day_metadata[date].timezone)
+            ) - timezone_delta
+            if shift == datetime.timedelta(0):
+                continue
+            if first > 0 and tps[first].datetime + shift <= tps[
+                    first - 1].datetime:
+                userbug.add("Track %s: timezone of %s not applied, as the "
+                            "time would go backwards" % (self.filename, date))
+                continue
+            for tp in tps[first:stop]:
+                tp.datetime += shift
+
     def __str__(self):
         s = "Track (%s trackpoints) " % len(self.trackpoints)
         s += "mode %s activity_id %s " % (self.mode, self.activity_id)
@@ -2404,33 +2674,29 @@ class Track(object):
             return self.as_svg()
         elif fmt == 'json':
             return self.as_json()
+        elif fmt == 'gpx':
+            return self.as_gpx()
 
     def __getitem__(self, index):
         if isinstance(index, int):
             return self.trackpoints[index]
 
-    def append(self, other_track):
-        other_start = other_track.trackpoints[0].datetime
-        this_start = self.trackpoints[0].datetime
-        other_is_later = other_start > this_start
-        if other_is_later:
-            for other_tp in other_track.trackpoints:
-                self.trackpoints.append(other_tp)
-            self.map_area = geo.calc_nwse(self.trackpoints)
-            self.calc_track_net()
-            self._suggest_segments()
-            self.compressed_track = self._compress_track()
-            self.zipped_track = self._compress_track(0.05)
-        else:
-            e = "Track.append(): To be appended track %s (%s) starts "
-            e += "before base track %s (%s)"
-            e %= (other_track.name, other_start, self.name, this_start)
-            raise Exception(e)
+    def merge(self, later_tracks, mode="segment"):
+        """
+        Trackpoints of later_tracks appended, then the whole track
+        analysed once. All tracks of mode "parse", sorted by time and
+        not overlapping (see Command.merge_tracks).
+        """
+        for track in later_tracks:
+            self.trackpoints += track.trackpoints
+        self.mode = mode
+        self.kwargs['mode'] = mode
+        self._analyse()
 
     @logged
     def save_as(self, filename):
         file_format = filename.split(".")[-1]
-        if file_format == 'svg':
+        if file_format in ('svg', 'svgz'):
             a_str = self.as_svg()
         elif file_format == 'kml':
             a_str = self.as_kml()
@@ -2443,6 +2709,7 @@ class Track(object):
             a_str = "unknown format %s" % str(file_format)
         lib.save_as(filename, a_str, verbose=True)
 
+    @lib.timed("export csv")
     def save_as_csv(self, filename, compressed=False):
         with open(filename, 'w') as csvfile:
             fieldnames = ['date', 'time', 'lat', 'lon', 'alt', 'text']
@@ -2522,28 +2789,169 @@ class Track(object):
                               fmt.hm(last_trackpoint.datetime.time()))
         return "%s %s" % (date, hm_to_hm)
 
+    def _open(self, filename, open_=open):
+        """The file, or the stream given as Track(stream=...)"""
+        stream = self.kwargs.get('stream')
+        return open_(filename) if stream is None else stream
+
     @logged
+    @lib.timed("import")
     def _import_file(self, filename, mode="segment", timezone_delta=None):
-        filetype = filename.split(".")[-1]
+        filetype = (self.kwargs.get('input_format') or
+                    filename.split(".")[-1])
         timezone_delta = (datetime.timedelta(seconds=0)
                           if timezone_delta is None else timezone_delta)
         if filetype == "gpx":
+            self._spill_over_budget(mode)
             self._import_gpx(filename, timezone_delta, mode)
         elif filetype == "csv":
             self._import_csv(filename, timezone_delta, mode)
         elif filetype == "CSV":
+            self._spill_over_budget(mode)
             self._import_columbus(filename, timezone_delta, mode)
         elif filetype == "kml":
             self._import_kml_plan(filename)
         elif filetype == "json":
             self._import_json(filename)
+        spilled = self.trackpoints
+        if (isinstance(spilled, SpilledTrackpoints) and
+                not spilled.is_spilled()):  # Within the budget
+            self.trackpoints = spilled.trackpoints(0, len(spilled))
+        lib.count("points parsed", self.count())
         if self.count() == 0:
             msg = "import_file: Cannot import file %s - zero trackpoints."
             userbug.add(msg % filename)
             return 0
         self.date = self.trackpoints[0].datetime.date()
+        if isinstance(self.trackpoints, SpilledTrackpoints):
+            return  # Cleaned chunk by chunk, see _analyse_in_chunks
+        self._clean_imported(mode)
+
+    def _spill_over_budget(self, mode):
+        """
+        Recorded trackpoints (not plans or tours) beyond the memory
+        budget into a temporary file, see _analyse_in_chunks
+        """
+        if (mode in ("", "segment") and
+                self.kwargs.get('budget_mb', _budget_mb) is not None):
+            self.trackpoints = SpilledTrackpoints(self._chunk_points())
+
+    def _clean_imported(self, mode):
+        """Decimated if asked for, without still points"""
+        decimate = self.kwargs.get('decimate', _decimate)
+        if (decimate is not None and mode not in ("skim", "read") and
+                self.sub_format == "Normal"):
+            self._decimate(*decimate)
         self._eliminate_still_points()
 
+    def _chunk_points(self):
+        """Points analysed at a time within the memory budget (MB)"""
+        budget_mb = self.kwargs.get('budget_mb', _budget_mb)
+        return max(int(budget_mb * 1e6 / self.CHUNK_POINT_BYTES),
+                   self.CHUNK_MIN_POINTS)
+
+    @logged
+    def _analyse_in_chunks(self):
+        """
+        _analyse of a track too big for the memory budget: each chunk of
+        points is analysed as a track of its own, with CHUNK_OVERLAP_S of
+        points before and after it so that segments are found as if the
+        track went on. Only the compressed points within the chunk are
+        kept, with the distances along the points of the chunk (see
+        _path_index), so that segments and totals are those of the whole
+        track. A segment running over the end of a chunk continues with
+        the segment of the next chunk starting before it.
+
+        The trackpoints are then the compressed ones: exports point by
+        point have the points of .compressed, not those recorded.
+        """
+        spilled = self.trackpoints
+        chunk_points = self._chunk_points()
+        overlap = datetime.timedelta(seconds=self.CHUNK_OVERLAP_S)
+        kwargs = dict(self.kwargs, mode="empty")
+        del kwargs['infile']
+        pieces = []  # [trackpoints, km from the point before, activity_id,
+        #             runs over the chunk end]
+        for first in range(0, len(spilled), chunk_points):
+            stop = min(first + chunk_points, len(spilled))
+            chunk_start = spilled[first].datetime
+            chunk_end = (spilled[stop].datetime if stop < len(spilled)
+                         else datetime.datetime.max)
+            chunk = Track(None, **kwargs)
+            chunk.mode = self.mode
+            chunk.trackpoints = spilled.trackpoints(
+                spilled.index(chunk_start - overlap),
+                stop if stop == len(spilled) else
+                spilled.index(chunk_end + overlap))
+            chunk.date = self.date
+            chunk._clean_imported(self.mode)
+            if chunk.count() < 2:
+                continue
+            with lib.Span("chunk"):
+                chunk._analyse()
+            index = chunk._path_index()  # Distances along all points
+            i_chunk_tp = dict((id(tp), i)
+                              for i, tp in enumerate(chunk.trackpoints))
+            compressed = chunk.compressed
+            segments = sorted(compressed.segments,
+                              key=lambda seg: seg.i_first_tp)
+            for segment in segments:
+                tps = compressed.trackpoints[segment.i_first_tp:
+                                             segment.i_last_tp + 1]
+                kept = [tp for tp in tps
+                        if chunk_start <= tp.datetime < chunk_end]
+                if len(kept) == 0:
+                    continue
+                kms = [index['dists'][i_chunk_tp[id(tp)]] for tp in kept]
+                continues = (tps[0].datetime < chunk_start and
+                             len(pieces) > 0 and pieces[-1][3])
+                if continues:  # From the last point kept, in this chunk
+                    second = (pieces[-1][0][-1].datetime -
+                              index['first_datetime']).total_seconds()
+                    i_last = bisect_left(index['seconds'], second)
+                    kms.insert(0, index['dists'][i_last])
+                    pieces[-1][0].extend(kept)
+                    pieces[-1][1].extend(
+                        kms[i] - kms[i - 1] for i in range(1, len(kms)))
+                else:
+                    pieces.append([kept, [0.0] + [
+                        kms[i] - kms[i - 1] for i in range(1, len(kms))],
+                        segment.activity_id, False])
+                pieces[-1][3] = tps[-1].datetime >= chunk_end
+        spilled.close()
+        lib.count("chunks", (len(spilled) - 1) // chunk_points + 1)
+
+        self.trackpoints = []
+        for tps, steps, activity_id, runs_over in pieces:
+            self.trackpoints.extend(tps)
+        index = self._path_index()
+        dists = []  # Within pieces as recorded, between as compressed
+        for tps, steps, activity_id, runs_over in pieces:
+            for i, step in enumerate(steps):
+                i_tp = len(dists)
+                if i_tp == 0:
+                    dists.append(0.0)
+                elif i == 0:
+                    dists.append(dists[-1] + index['dists'][i_tp] -
+                                 index['dists'][i_tp - 1])
+                else:
+                    dists.append(dists[-1] + step)
+        index['dists'] = dists
+        self._find_relevant_places()
+        i_first_tp = 0
+        for tps, steps, activity_id, runs_over in pieces:
+            i_last_tp = i_first_tp + len(tps) - 1
+            if i_last_tp > i_first_tp:
+                self.segments.append(Segment(self, i_first_tp, i_last_tp,
+                                             activity_id, "chunks"))
+            i_first_tp = i_last_tp + 1
+        self.update_previous_next_pointers()
+        self.calc_track_net()
+        self._sort_by_activity()
+        self._calc_activities()
+        self.compressed = self  # Made of compressed chunks
+        self.zipped = self._compress_track(0.05)
+
     @logged
     def _import_gpx(self, filename, timezone_delta, mode="segment"):
         """Import from a GPX file between start and stop (times)"""
@@ -2554,7 +2962,7 @@ class Track(object):
         # <time>2014-04-19T10:06:20.45</time>
         # </trkpt>
         a_datetime = datetime.datetime.min
-        with open(filename) as gpxfile:
+        with self._open(filename) as gpxfile:
             i = 0
             f_hr = f_temp = ""
             for line in gpxfile:
@@ -2608,7 +3016,7 @@ class Track(object):
     @logged
     def _import_columbus(self, filename, timezone_delta, mode="segment"):
         """Import from a CSV file between start and stop (times)"""
-        with open(filename) as columbusfile:
+        with self._open(filename) as columbusfile:
             i = 0
             for line in columbusfile:
                 is_header = not line[0].isdigit()
@@ -2643,7 +3051,7 @@ class Track(object):
     @logged
     def _import_csv(self, filename, timezone_delta, mode="segment"):
         """Import from a csv file"""
-        with open(filename) as csvfile:
+        with self._open(filename) as csvfile:
             reader = csv.DictReader(csvfile)
             sub_format = 'Normal'
             for row in reader:
@@ -2657,7 +3065,8 @@ class Track(object):
         if sub_format == "Tour":
             self._import_csv_tour(filename)
             return
-        with open(filename) as csvfile:
+        self._spill_over_budget(mode)
+        with self._open(filename) as csvfile:
             for i, line in enumerate(csvfile):
                 is_header = not line[0].isdigit()
                 if not is_header:
@@ -2681,7 +3090,7 @@ class Track(object):
 
     @logged
     def _import_json(self, filename):
-        with open(filename) as f:
+        with self._open(filename) as f:
             content = f.read()
             j = json.loads(content)
 
@@ -2694,7 +3103,7 @@ class Track(object):
 
     def _import_csv_plan(self, filename):
         f_date = ""
-        with open(filename) as csvfile:
+        with self._open(filename) as csvfile:
             reader = csv.DictReader(csvfile)
             last_date = last_time = ""
             speed = 0
@@ -2767,7 +3176,7 @@ class Track(object):
             self.name = f_date + " " + self.name
 
     def _import_csv_tour(self, filename):
-        with open(filename) as csvfile:
+        with self._open(filename) as csvfile:
             reader = csv.DictReader(csvfile)
             i_tp = 0
             look_pm  = Placemark("Equator", 0, 0)
@@ -2900,7 +3309,7 @@ class Track(object):
         self.tour.append(pt_look_at)
 
     def _import_csv_tour_g(self, filename):
-        with open(filename) as csvfile:
+        with self._open(filename) as csvfile:
             reader = csv.DictReader(csvfile)
             i_tp = 0
             last_pt = Point(0, 0)
@@ -2933,7 +3342,7 @@ class Track(object):
                 i_tp += 1
 
     def _import_kml_plan(self, filename):
-        f = codecs.open(filename, 'r')
+        f = self._open(filename, codecs.open)
         last_date = last_time = ""
         speed = 0
         tp = Trackpoint(0, 0, "2016-01-01 00:00:00")  # To shut up PyCharm
@@ -3062,25 +3471,46 @@ class Track(object):
         p2 = Point(int(tp.lat) + 1, int(tp.lon) + 1)
         self.relevant_places = Places("copy", original=_places, p1=p1, p2=p2)
 
-    def create_timepoints(self):
-        def reset_values():
-            for field in fields:
-                values[field] = 0
-
-        def accumulate_values():
+    def create_timepoints(self, bucket_s=60):
+        """
+        Sums and maxima per bucket_s seconds (10, 60, 300...) into
+        self.timepoints, in one pass over the trackpoint columns. Keys
+        are "hh:mm", or "hh:mm:ss" if bucket_s is not whole minutes.
+        """
+        def new_values():
+            return {'count': 0, 'distance': 0, 'hm_up': 0, 'hm_down': 0,
+                    'max_slope_up': 0, 'max_slope_down': 0, 'max_speed': 0,
+                    'dist_n': 0, 'dist_e': 0, 'dist_s': 0, 'dist_w': 0}
+
+        def accumulate_values(values, i):
+            distance = distances[i]
+            alt_diff = alt_diffs[i]
             values['count'] += 1
             values['distance'] += distance
-            values['hm_up'] += hm_up
-            values['hm_down'] += hm_down
-            values['max_slope_up'] = max(slope, values['max_slope_up'])
-            values['max_slope_down'] = min(slope, values['max_slope_down'])
-            values['max_speed'] = max(speed, values['max_speed'])
-            values['dist_n'] += dist_n
-            values['dist_e'] += dist_e
-            values['dist_s'] += dist_s
-            values['dist_w'] += dist_w
-
-        def cap_values():
+            if alt_diff > 0:
+                values['hm_up'] += alt_diff
+            else:
+                values['hm_down'] += alt_diff
+            if distance != 0:  # Slope as ratio, atan() once per bucket
+                ratio = 0.001 * alt_diff / distance
+                if ratio > values['max_slope_up']:
+                    values['max_slope_up'] = ratio
+                if ratio < values['max_slope_down']:
+                    values['max_slope_down'] = ratio
+            if speeds[i] > values['max_speed']:
+                values['max_speed'] = speeds[i]
+            if dists_ns[i] > 0:
+                values['dist_n'] += dists_ns[i]
+            else:
+                values['dist_s'] += dists_ns[i]
+            if dists_ew[i] > 0:
+                values['dist_e'] += dists_ew[i]
+            else:
+                values['dist_w'] += dists_ew[i]
+
+        def cap_values(values):
+            values['max_slope_up'] = degrees(atan(values['max_slope_up']))
+            values['max_slope_down'] = degrees(atan(values['max_slope_down']))
             movement_m = values['distance'] * 1000
             if movement_m < 50:  # Movement < 50 m, i.e. speed < 3 km/h
                 values['max_slope_down'] = 0
@@ -3095,53 +3525,54 @@ class Track(object):
                     values['max_slope_up'] = 0
                     values['max_speed'] = 0
 
-        fields = ['count', 'distance', 'dist_n', 'dist_e', 'dist_s', 'dist_w',
-                  'hm_up', 'hm_down', 'max_slope_up', 'max_slope_down',
-                  'max_speed']
-        values = {}
-        reset_values()
-        last_tp = self.trackpoints[0]
-        last_minute = ""
-        last_dateandtime = datetime.datetime.min
-        # Just to indicate the right type of last_dateandtime
-        for tp in self.trackpoints:
-            lat, lon, alt = tp.lat, tp.lon, tp.alt
-            dateandtime = tp.datetime
-            second = dateandtime.strftime('%S')
-            distance = tp.distance(last_tp)
-            alt_diff = tp.alt - last_tp.alt
-            alt_diff = 0 if alt_diff is None else alt_diff
-            hm_up = alt_diff if alt_diff > 0 else 0
-            hm_down = alt_diff if alt_diff < 0 else 0
-            slope = (degrees(atan(0.001 * alt_diff / distance))
-                     if distance != 0 else 0)
-            dist_ns = geo.lat_diff2km(tp.lat - last_tp.lat)
-            dist_ew = geo.lon_diff2km(tp.lon - last_tp.lon, tp.lat)
-            dist_n = dist_ns if dist_ns > 0 else 0
-            dist_s = dist_ns if dist_ns < 0 else 0
-            dist_e = dist_ew if dist_ew > 0 else 0
-            dist_w = dist_ew if dist_ew < 0 else 0
-            duration = tp.seconds(last_tp)
-            speed = distance * 3600 / duration if duration != 0 else 0
-            minute = tp.time_hm()
-            if minute != last_minute:
-                if last_minute != "":
-                    if second == "00" and duration <= 60:
-                        accumulate_values()
-                    time_just_minute = last_dateandtime.replace(second=0,
-                                                                microsecond=0)
-                    closest_pm = self.relevant_places.closest_placemark(tp)
-                    text = closest_pm.text
-                    cap_values()
-                    time_pt = Timepoint(lat, lon, time_just_minute, alt,
-                                        text, **values)
-                    minute = time_pt.minute
-                    self.timepoints[minute] = time_pt
-                    reset_values()
-            accumulate_values()
-            last_tp = tp
-            last_minute = minute
-            last_dateandtime = dateandtime
+        self.timepoints = {}
+        self.timepoint_width_s = bucket_s
+        tps = self.trackpoints
+        count = len(tps)
+        if count == 0:
+            return
+        midnight = datetime.datetime.combine(tps[0].datetime.date(),
+                                             datetime.time(0))
+        seconds = [(tp.datetime - midnight).total_seconds() for tp in tps]
+        lats = [tp.lat for tp in tps]
+        lons = [tp.lon for tp in tps]
+        alts = [tp.alt for tp in tps]
+        distances = geo.distances(lats, lons)
+        durations = [0] + [seconds[i] - seconds[i - 1]
+                           for i in range(1, count)]
+        alt_diffs = [0] + [alts[i] - alts[i - 1] for i in range(1, count)]
+        speeds = [distances[i] * 3600 / durations[i] if durations[i] != 0
+                  else 0 for i in range(count)]
+        dists_ns = [0] + [geo.lat_diff2km(lats[i] - lats[i - 1])
+                          for i in range(1, count)]
+        dists_ew = [0] + [geo.lon_diff2km(lons[i] - lons[i - 1], lats[i])
+                          for i in range(1, count)]
+
+        buckets = []  # (bucket, index of first trackpoint after, values)
+        values = new_values()
+        last_bucket = int(seconds[0]) // bucket_s
+        for i in range(count):
+            bucket = int(seconds[i]) // bucket_s
+            if bucket != last_bucket:
+                on_boundary = int(seconds[i]) % bucket_s == 0
+                if on_boundary and durations[i] <= bucket_s:
+                    accumulate_values(values, i)  # Counts in both buckets
+                buckets.append((last_bucket, i, values))
+                values = new_values()
+            accumulate_values(values, i)
+            last_bucket = bucket
+        buckets.append((last_bucket, count - 1, values))
+
+        closest_pms = self.relevant_places.closest_placemarks(
+            [tps[i] for _, i, _ in buckets])
+        with_seconds = bucket_s % 60 != 0
+        for (bucket, i, values), closest_pm in zip(buckets, closest_pms):
+            cap_values(values)
+            start = midnight + datetime.timedelta(seconds=bucket * bucket_s)
+            time_pt = Timepoint(lats[i], lons[i], start, alts[i],
+                                closest_pm.text, **values)
+            key = fmt.hms(start) if with_seconds else time_pt.minute
+            self.timepoints[key] = time_pt
 
     def _calc_timepoints(self):
         timepoint_list = list(self.timepoints)
@@ -3167,98 +3598,66 @@ class Track(object):
     def calc_milestones(self):
         tick_long = _activities[self.activity_id].tick_long.replace("km", "")
         tick_long = float(tick_long)
-        trackpoints = self.compressed.trackpoints
-        self.milestones = self.equidistant_points(trackpoints, tick_long)
+        self.milestones = self.compressed.equidistant_points(tick_long)
 
-    def equidistant_points(self, trackpoints, equidistance, type_="Placemark"):
+    def equidistant_points(self, equidistance, type_="Placemark"):
+        """Every equidistance km along the path, see position_at_distance"""
         result_points = []
-        acc_dist = 0
-        last_tp = trackpoints[0]
-        prev_datetime = last_tp.datetime
-        for i, tp in enumerate(trackpoints):
-            if i > 0:
-                prev_tick = int(acc_dist / equidistance)
-                dist = tp.distance(last_tp)
-                new_tick = int((acc_dist + dist) / equidistance)
-                if prev_tick != new_tick:
-                    for tick in range(prev_tick + 1, new_tick + 1):
-                        xtra_dist = tick*equidistance - acc_dist
-                        lat_diff = tp.lat - last_tp.lat
-                        lon_diff = tp.lon - last_tp.lon
-                        seconds_diff = tp.seconds(last_tp)
-                        mid_lat = last_tp.lat + xtra_dist / dist * lat_diff
-                        mid_lon = last_tp.lon + xtra_dist / dist * lon_diff
-                        mid_seconds = int(xtra_dist / dist * seconds_diff)
-                        mid_delta = datetime.timedelta(seconds=mid_seconds)
-                        mid_datetime = last_tp.datetime + mid_delta
-                        text = fmt.hm(mid_datetime)
-                        diff = mid_datetime - prev_datetime
-                        km_seconds = abs(diff).total_seconds()
-                        duration = fmt.sec_as_hm(km_seconds)
-                        text += " (%s)" % duration
-                        placetype_id = tick % 10
-                        if placetype_id == 0:
-                            placetype_id = 10
-                        descr = "%s km" % int(tick * equidistance)
-                        placetype_id = str(placetype_id)
-                        if type_ == "Placemark":
-                            pm = Placemark(text, mid_lat, mid_lon, descr=descr,
-                                           placetype_id=placetype_id)
-                            result_points.append(pm)
-                        else:
-                            e_tp = Trackpoint(mid_lat, mid_lon, mid_datetime)
-                            result_points.append(e_tp)
-                        prev_datetime = mid_datetime
-                acc_dist += dist
-                last_tp = tp
+        first_datetime = self.trackpoints[0].datetime
+        prev_datetime = first_datetime
+        total = self._path_index()['dists'][-1]
+        for tick in range(1, int(total / equidistance) + 1):
+            tp = self.position_at_distance(tick * equidistance)
+            if tp is None:  # Rounded over the end
+                break
+            mid_datetime = first_datetime + datetime.timedelta(
+                seconds=int((tp.datetime - first_datetime).total_seconds()))
+            if type_ != "Placemark":
+                result_points.append(Trackpoint(tp.lat, tp.lon,
+                                                mid_datetime))
+                continue
+            text = fmt.hm(mid_datetime)
+            km_seconds = abs(mid_datetime - prev_datetime).total_seconds()
+            text += " (%s)" % fmt.sec_as_hm(km_seconds)
+            placetype_id = tick % 10
+            if placetype_id == 0:
+                placetype_id = 10
+            descr = "%s km" % int(tick * equidistance)
+            result_points.append(Placemark(text, tp.lat, tp.lon,
+                                           descr=descr,
+                                           placetype_id=str(placetype_id)))
+            prev_datetime = mid_datetime
         return result_points
 
     def running_average(self, points, window_points=21):
-        window = []
-        running = []
-        look_ahead = (window_points - 1) / 2
-        count = len(points)
-        window_size = 0
-        tot_lat = 0  # first_pt.lat * window_points
-        tot_lon = 0  # first_pt.lon * window_points
-        for i, pt in enumerate(points):
-            window.append(pt)
-            window_size += 1
-            tot_lat += pt.lat
-            tot_lon += pt.lon
-            past_start = i >= window_points
-            if past_start:
-                drop_pt = window.pop(0)
-                window_size -= 1
-                tot_lat -= drop_pt.lat
-                tot_lon -= drop_pt.lon
-                mid_pt = window[look_ahead]
-                avg_pt = Trackpoint(tot_lat / window_size,
-                                    tot_lon / window_size,
-                                    mid_pt.datetime)
-                running.append(avg_pt)
-                at_end = i == count - 1
-                if at_end:
-                    for j in range(0, look_ahead):
-                        for k in range(0, 2):
-                            drop_pt = window.pop(0)
-                            window_size -= 1
-                            tot_lat -= drop_pt.lat
-                            tot_lon -= drop_pt.lon
-                        mid_pt = window[(window_size - 1)/2]
-                        avg_pt = Trackpoint(tot_lat / window_size,
-                                            tot_lon / window_size,
-                                            mid_pt.datetime)
-                        running.append(avg_pt)
-            else:
-                just_grow_window = i % 2 == 0
-                if not just_grow_window:
-                    mid_pt = window[(i - 1)/2]
-                    avg_pt = Trackpoint(tot_lat / window_size,
-                                        tot_lon / window_size,
-                                        mid_pt.datetime)
-                    running.append(avg_pt)
-        return running
+        lats, lons, _ = self.columns(points)
+        lats = resample.moving_average(lats, window_points)
+        lons = resample.moving_average(lons, window_points)
+        return [Trackpoint(lat, lon, pt.datetime)
+                for lat, lon, pt in zip(lats, lons, points)]
+
+    def smoothed_equidistant_points(self, equidistance, window_points=21):
+        """equidistant_points and running_average, as Trackpoints once"""
+        lats, lons, seconds = self.columns(self.trackpoints)
+        dists = resample.cumulative_distances(lats, lons)
+        _, (lats, lons, seconds) = resample.resample(
+            dists, [lats, lons, seconds], equidistance)
+        lats = resample.moving_average(lats, window_points)
+        lons = resample.moving_average(lons, window_points)
+        first_datetime = self.trackpoints[0].datetime
+        return [Trackpoint(lat, lon, first_datetime +
+                           datetime.timedelta(seconds=int(second)))
+                for lat, lon, second in zip(lats, lons, seconds)]
+
+    @staticmethod
+    def columns(points):
+        """lats, lons and seconds from the first point"""
+        first_datetime = points[0].datetime
+        lats = [pt.lat for pt in points]
+        lons = [pt.lon for pt in points]
+        seconds = [(pt.datetime - first_datetime).total_seconds()
+                   for pt in points]
+        return lats, lons, seconds
 
     def color(self, tp):
         if self.activity_id in ['downhill', 'snowboard']:
@@ -3269,15 +3668,24 @@ class Track(object):
         return "#" + color1
 
     def timepoint_color(self, tp):
-        time = tp.time_hm()
-        timepoint = self.timepoints.get(time)
-        if timepoint is None:
+        """
+        Colour of the slope down (degrees) around tp, over
+        timepoint_width_s, see position_at_time
+        """
+        half = datetime.timedelta(seconds=self.timepoint_width_s / 2.0)
+        before = (self.position_at_time(tp.datetime - half) or
+                  self.trackpoints[0])
+        after = (self.position_at_time(tp.datetime + half) or
+                 self.trackpoints[-1])
+        distance = before.distance(after)
+        if distance == 0:
             return "Grey"
-        max_slope_down = abs(timepoint.max_slope_down)
-        color = ("black" if max_slope_down > 24 else
-            "Red" if max_slope_down > 16 else
-            "Blue" if max_slope_down > 8 else
-            "Green" if max_slope_down > 1 else "Grey")
+        slope_down = degrees(atan(0.001 * (float(before.alt or 0) -
+                                           float(after.alt or 0)) / distance))
+        color = ("black" if slope_down > 24 else
+            "Red" if slope_down > 16 else
+            "Blue" if slope_down > 8 else
+            "Green" if slope_down > 1 else "Grey")
         return color
 
     def distance_along_path(self, i_from, i_to):
@@ -3298,14 +3706,129 @@ class Track(object):
             userbug.add("Track.distance_along_path: cnt = 0 (zero) " +
                         "in filename %s" % self.filename)
             return 0
-        prev_tp = self.trackpoints[i_from]
-        for i_tp in range(i_from + 1, i_to + 1):
-            tp = self.trackpoints[i_tp]
-            s += tp.distance(prev_tp)
-            prev_tp = tp
-        return s
+        dists = self._path_index()['dists']
+        return s + dists[i_to] - dists[i_from]
+
+    def position_at_time(self, a_datetime):
+        """Interpolated Trackpoint at a_datetime, None if outside track"""
+        index = self._path_index()
+        if not index['seconds']:
+            return None
+        second = (a_datetime - index['first_datetime']).total_seconds()
+        if not index['seconds'][0] <= second <= index['seconds'][-1]:
+            return None
+        (lat, ), (lon, ), (alt, ) = resample.interpolate(
+            index['seconds'], [index['lats'], index['lons'], index['alts']],
+            [second])
+        return Trackpoint(lat, lon, a_datetime, alt)
+
+    def position_at_distance(self, km):
+        """Interpolated Trackpoint km along the path, None if outside"""
+        index = self._path_index()
+        if not index['dists']:
+            return None
+        if not 0 <= km <= index['dists'][-1]:
+            return None
+        (lat, ), (lon, ), (alt, ), (second, ) = resample.interpolate(
+            index['dists'], [index['lats'], index['lons'], index['alts'],
+                             index['seconds']], [km])
+        a_datetime = (index['first_datetime'] +
+                      datetime.timedelta(seconds=second))
+        return Trackpoint(lat, lon, a_datetime, alt)
+
+    def _path_index(self):
+        """
+        Columns of the trackpoints for bisect lookups: lats, lons, alts,
+        seconds from the first trackpoint, and cumulative km (dists).
+        Extended when trackpoints have only been appended, otherwise
+        rebuilt when the trackpoints have changed.
+        """
+        tps = self.trackpoints
+        index = self.path_index
+        count = len(tps)
+        is_current = (index is not None and index['list_id'] == id(tps) and
+                      index['count'] <= count and
+                      (index['count'] == 0 or
+                       (tps[0] is index['first_tp'] and
+                        tps[index['count'] - 1] is index['last_tp'])))
+        if not is_current:
+            index = {'list_id': id(tps), 'count': 0, 'first_tp': None,
+                     'last_tp': None, 'first_datetime': None, 'lats': [],
+                     'lons': [], 'alts': [], 'seconds': [], 'dists': []}
+            self.path_index = index
+        if index['count'] == count:
+            return index
+        if index['count'] == 0:
+            index['first_tp'] = tps[0]
+            index['first_datetime'] = tps[0].datetime
+        new_tps = tps[index['count']:]
+        lats = [tp.lat for tp in new_tps]
+        lons = [tp.lon for tp in new_tps]
+        dists = geo.distances(index['lats'][-1:] + lats,
+                              index['lons'][-1:] + lons)
+        dists = dists[1:] if index['count'] > 0 else dists
+        last_dist = index['dists'][-1] if index['count'] > 0 else 0
+        index['dists'] += resample.cumulative([last_dist] + dists)[1:]
+        index['lats'] += lats
+        index['lons'] += lons
+        index['alts'] += [float(tp.alt or 0) for tp in new_tps]
+        first_datetime = index['first_datetime']
+        index['seconds'] += [(tp.datetime - first_datetime).total_seconds()
+                             for tp in new_tps]
+        index['count'] = count
+        index['last_tp'] = tps[-1]
+        return index
 
     @logged
+    @lib.timed("decimation")
+    def _decimate(self, metres=0, seconds=0):
+        """
+        Fewer points from fast-recording devices: one point per second
+        (the first one), and none within metres or seconds of the last
+        point kept. The breaks found stay: a point is kept at least every
+        DECIMATE_MAX_GAP_S, and after standing still for DECIMATE_STILL_S
+        the last still point is kept as well. Segment starts and ends can
+        move by up to metres/speed (or seconds), and slow tracks may get
+        another activity. The last point is always kept.
+        """
+        tps = self.trackpoints
+        km = metres / 1000.0
+        kept = [tps[0]]
+        last = dropped = tps[0]  # Last kept, last dropped after it
+        same_second = close = 0
+        end = len(tps) - 1  # First point of the last second, always kept
+        while end > 0 and tps[end].datetime == tps[end - 1].datetime:
+            end -= 1
+        for i in range(1, len(tps)):
+            tp = tps[i]
+            if tp.datetime == tps[i - 1].datetime:
+                same_second += 1
+                continue
+            gap_s = tp.seconds(last)
+            if (i < end and gap_s < self.DECIMATE_MAX_GAP_S and
+                    (gap_s < seconds or tp.distance(last) < km)):
+                close += 1
+                dropped = tp
+                continue
+            if (dropped is not last and dropped.distance(last) < km and
+                    dropped.seconds(last) >= self.DECIMATE_STILL_S):
+                kept.append(dropped)
+                close -= 1
+            kept.append(tp)
+            last = dropped = tp
+        self.trackpoints = kept
+        self.decimation = {'kept': len(kept), 'same second': same_second,
+                           'close': close}
+        lib.count("points kept", len(kept))
+        lib.count("points dropped, same second", same_second)
+        lib.count("points dropped, close", close)
+        if not self.kwargs.get('server_level') == True:
+            print("Decimated %s -> %s points (%s same second, %s close)" % (
+                lib.i1000(len(tps)), lib.i1000(len(kept)),
+                lib.i1000(same_second), lib.i1000(close)))
+
+    @logged
+    @lib.timed("still points")
     def _eliminate_still_points(self):
         """Skip still points at beginning and end, and middle points
         surrounded by points at exact same location"""
@@ -3338,6 +3861,7 @@ class Track(object):
                     recent_movement = True
 
     @logged
+    @lib.timed("segmentation")
     def _suggest_segments(self):
         # First segment start: mode 'before_first_start'
         # - "If in the last 60 seconds movement is more than 20 metres, find
@@ -3582,6 +4106,7 @@ class Track(object):
                 self.activities.append(activity_id)
 
     @logged
+    @lib.timed("peaks")
     def _split_track_at_peaks(self):
         seg_count = len(self.segments)
         for i_seg in range(seg_count - 1, -1, -1):
@@ -3629,6 +4154,7 @@ class Track(object):
         self.segments.insert(i_seg + 1, new_segment)
 
     @logged
+    @lib.timed("compression")
     def _compress_track(self, c_t_ratio=None):
         if c_t_ratio is None:
             c_t_ratio = 0.00001
@@ -3729,7 +4255,12 @@ class Track(object):
             self._compress_section(i_pi, i_p2, c_t, c_l)
             # After the chosen intermediate point
 
+    @lib.timed("export json")
     def as_json(self):
+        return "".join(self.json_chunks())
+
+    def json_chunks(self):
+        """as_json in pieces, to be written out one at a time"""
         tp_date = self.trackpoints[0].date_dmyy()
         try:
             activity_name = _activities[self.activity_id].name
@@ -3755,8 +4286,8 @@ class Track(object):
                      self.map_area['min']['lat'], self.map_area['min']['lon'],
                      self.map_area['max']['lat'], self.map_area['max']['lon']]
         lats_lons = map(geo.lat_lon_5, lats_lons)
-        k = k % tuple(lats_lons)
-        k += '''\
+        yield k % tuple(lats_lons)
+        k = '''\
     "layers": {
         "segments": {
             "layer_type": "track",
@@ -3779,6 +4310,7 @@ class Track(object):
             k = k % (label, start_point.lat_5(), start_point.lon_5(),
                      start_time, start_time,
                      end_point.lat, end_point.lon, label, end_time)
+        yield k
         c = len(self.compressed.segments)
         i = 0
         for segment in self.compressed.segments:
@@ -3794,16 +4326,16 @@ class Track(object):
                     "point_label": "%s", "point_datetime": "%s"}]'''
             s = s % (segment.last['tp'].lat, segment.last['tp'].lon, label,
                      segment.last['tp'].datetime)
-            k += s
+            yield s
 
-        k += '''\
+        yield '''\
                 ]
             }'''
 
         i_segment = 0
         for segment in self.compressed.segments:
             i_segment += 1
-            k += ''',
+            k = ''',
             "track%s": {
                 "layer_type": "track",
                 "layer_title": "%s",
@@ -3825,11 +4357,12 @@ class Track(object):
             k += '''
                 ]
                 }\n'''
+            yield k
 
         i_segment = 0
         for segment in self.zipped.segments:
             i_segment += 1
-            k += ''',
+            k = ''',
             "trackzip%s": {
                 "layer_type": "trackzip",
                 "layer_title": "zip%s",
@@ -3851,12 +4384,17 @@ class Track(object):
             k += '''
                 ]
                 }\n'''
-        k += '''\
+            yield k
+        yield '''\
         }
     }'''
-        return k
 
+    @lib.timed("export gpx")
     def as_gpx(self):
+        return "".join(self.gpx_chunks())
+
+    def gpx_chunks(self):
+        """as_gpx in pieces, to be written out one at a time"""
         g = """
 <?xml version="1.0" encoding="UTF-8" standalone="no"?>
 <gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" creator="Green Elk" version="1.1" xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd http://www.garmin.com/xmlschemas/TrackPointExtension/v1 http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd">
@@ -3870,14 +4408,23 @@ class Track(object):
   <trk>
     <trkseg>\n"""
         g %= (self.name, fmt.current_timestamp())
+        yield g
         for tp in self.trackpoints:
-            g += tp.as_gpx()
-        g += """
+            yield tp.as_gpx()
+        yield """
     </trkseg>
   </trk>
 </gpx>"""
-        return g
 
+    def output_chunks(self, fmt_):
+        """format(self, fmt_) in pieces, where the format allows that"""
+        if fmt_ == 'json':
+            return self.json_chunks()
+        elif fmt_ == 'gpx':
+            return self.gpx_chunks()
+        return [format(self, fmt_)]
+
+    @lib.timed("export kml")
     def as_kml(self):
         if self.mode == "tour":
             return self.as_kml_tour()
@@ -3966,6 +4513,7 @@ class Track(object):
         k += kml.doc_footer()
         return k
 
+    @lib.timed("export kml tour")
     def as_kml_tour(self):
         header = self.kwargs['header']
         k = kml.doc_header(header, version="2.2")
@@ -3982,6 +4530,7 @@ class Track(object):
         k += kml.doc_footer()
         return k
 
+    @lib.timed("export svg")
     def as_svg(self, map_area=None, fixed=None, title=None, desc=None,
                append=False, final=True):
 
@@ -3999,7 +4548,8 @@ class Track(object):
             return sg
 
         def breaks():
-            br = "\n<!-- Breaks -->\n"
+            # Queued; placed together with placemarks by draw_placemarks()
+            priority = SVGMap.BREAK_PRIORITY
             for seg in self.compressed.segments:
                 is_first_segment = seg.previous_segment is None
                 is_last_segment = seg.next_segment is None
@@ -4007,40 +4557,34 @@ class Track(object):
                     text = seg.first['tp'].time_hm()
                     lat = seg.first['tp'].lat
                     lon = seg.first['tp'].lon
-                    br += svg_map.plot_marker_latlon(lat, lon, text,
+                    svg_map.queue_marker_latlon(priority, lat, lon, text,
                             {'fill': 'black', 'font-size': 2.5},
                             radius=2, icon='start')
                 if is_last_segment:
                     text = seg.last['tp'].time_hm() + " " + fmt.km(self.net_dist)
-                    br += svg_map.plot_marker_latlon(seg.last['tp'].lat,
+                    svg_map.queue_marker_latlon(priority, seg.last['tp'].lat,
                             seg.last['tp'].lon, text,
                             {'fill': 'black', 'font-size': 2.5},
                             radius=2, icon='stop', force_write=True)
                 elif seg.break_duration_hm() != "0:00":
                     text = seg.break_label()
-                    br += svg_map.plot_marker_latlon(seg.last['tp'].lat,
+                    svg_map.queue_marker_latlon(priority, seg.last['tp'].lat,
                             seg.last['tp'].lon, text,
                             {'fill': 'black', 'font-size': 2},
                             radius=2, icon='pause', force_write=True)
-            return br
 
         def milestones():
-            s = ""
             style_dict = {'font-size': 2, 'fill': 'Red'}
             for milestone in self.milestones:
                 text = milestone.descr + " " + milestone.text
-                s += svg_map.plot_marker_latlon(milestone.lat, milestone.lon,
-                                                text, style_dict=style_dict,
-                                                radius=1)
-            return s
-
-        if os.path.exists(_svg_icon_file):
-            with codecs.open(_svg_icon_file) as f:
-                svg_icons = f.read()
-        else:
+                svg_map.queue_marker_latlon(milestone.tot_prominence,
+                                            milestone.lat, milestone.lon,
+                                            text, style_dict=style_dict,
+                                            radius=1)
+
+        if not os.path.exists(_svg_icon_file):
             print("Track as_svg missing icons file %s" % _svg_icon_file)
             # todo Userbug
-            svg_icons = ""
 
         title = self.name if title is None else title
         desc = self.duration() if desc is None else desc
@@ -4055,15 +4599,15 @@ class Track(object):
         svg.set_title(title, desc)
         s = ""
         if not append:
-            s += svg.doc_header(more_defs=svg_icons)
+            s += svg.doc_header()
             s += svg_map.svg_comment
             s += svg_map.draw_map_frame()
             s += svg_map.plot_map_grid(svg_map.spread_km)
             s += svg_map.draw_header(title, desc)
             s += svg_map.plot_scale()
         s += segments()
-        s += breaks()
-        s += milestones()
+        breaks()
+        milestones()
         #s += svg_map.svg.draw_pixels()  # For verifying non-printing
         if final:
             s += svg_map.draw_placemarks(_places)
@@ -4074,6 +4618,8 @@ class Track(object):
 class SVGMap(object):
     """Map plotting lats and lons on SVG"""
 
+    BREAK_PRIORITY = 0  # Start, stop and breaks go before all placemarks
+
     def __init__(self, svg_, fixed=None, map_area=None, icon=None):
         """
         Set up a map in an existing SVG object, either
@@ -4256,14 +4802,16 @@ class SVGMap(object):
             cy = y + 24
             r = 15
             s += svg.plot_blue_sign(cx, cy, r)
-            s += use_template % (self.icon , "white", cx - 14, cy - 13, 5.0)
+            s += use_template % (svg.use_icon(self.icon), "white",
+                                 cx - 14, cy - 13, 5.0)
         dimensions = "%s km x %s km" % (
             fmt.onedecimal(svg.canvas['inner']['km']['width']),
             fmt.onedecimal(svg.canvas['inner']['km']['height']))
         s += svg.plot_header(dimensions, 'outer', 'right', 'top',
                              dy = -5, style_dict={'font-size': 4})
         y = svg.canvas['outer']['mm']['bottom'] + 6
-        s += use_template % ("elk-inv", lib.app_color(_colors, 'Green'),
+        s += use_template % (svg.use_icon("elk-inv"),
+                             lib.app_color(_colors, 'Green'),
                              x - 4, y - 5, 1.7)
 
         s += svg.plot_header("Green Elk %s " % fmt.current_timestamp(),
@@ -4272,7 +4820,8 @@ class SVGMap(object):
         return s
 
     def draw_placemarks(self, places):
-        s = "\n<!-- Placemarks -->\n"
+        """Queue placemarks, then place all queued markers by prominence"""
+        s = "\n<!-- Placemarks, milestones and breaks -->\n"
         has_map_area = self.map_area is not None
         if has_map_area:
             min_lat = self.map_area['min']['lat']
@@ -4306,9 +4855,10 @@ class SVGMap(object):
                 icon = pm.placetype['svg']
                 icon = icon.replace('.svg', '')
                 use_frame = pm.placetype_id in ["village", "island"]
-                s += self.plot_marker_latlon(pm.lat, pm.lon, text,
-                    {'fill': color, 'font-size': size}, radius=r, icon=icon,
-                    use_frame=use_frame)
+                self.queue_marker_latlon(pm.tot_prominence, pm.lat, pm.lon,
+                    text, {'fill': color, 'font-size': size}, radius=r,
+                    icon=icon, use_frame=use_frame)
+        s += svg.plot_queued_markers()
         return s
 
     def _plot_text_latlon(self, lat, lon, rotation, size_mm, anchor="left"):
@@ -4320,34 +4870,21 @@ class SVGMap(object):
     def plot_marker_latlon(self, lat, lon, txt, style_dict=None,
                            angle=0, radius=2.5, icon="circle",
                            use_frame=False, force_write=False):
-        max_y = svg.canvas['inner']['mm']['bottom']
-        if style_dict is None:
-            style_dict = {}
         x, y = self.latlon2xy(lat, lon)
-        if use_frame:
-            return svg.plot_framed_sign_mm(x, y, txt)
-        font_size = style_dict.get('font-size', 3)
-        color = style_dict.get('fill', 'Red')
-        x_text = x + radius * 1.2
-        y_text = y + font_size * 0.4
-        color = lib.app_color(_colors, color)
-        s1 = s2 = ""
-        done = False
-        while not done:
-            s1 = svg.plot_icon_mm(x, y, r=radius, icon=icon, color=color)
-            done = s1 != "" or not force_write
-            if not done:
-                y += 1  # Try 1 mm lower
-                y_text += 1  # Keep text aligned
-            done = done or y > max_y
-        done = False
-        while not done:
-            s2 = svg.plot_text_mm(x_text, y_text, txt, style_dict, angle=angle)
-            done = s2 != "" or not force_write
-            if not done:
-                y_text += 1  # Try 1 mm lower
-            done = done or y_text > max_y
-        return s1+s2
+        style_dict = {} if style_dict is None else style_dict
+        color = lib.app_color(_colors, style_dict.get('fill', 'Red'))
+        return svg.plot_marker_mm(x, y, txt, style_dict, angle, radius,
+                                  icon, color, use_frame, force_write)
+
+    def queue_marker_latlon(self, priority, lat, lon, txt, style_dict=None,
+                            angle=0, radius=2.5, icon="circle",
+                            use_frame=False, force_write=False):
+        """As plot_marker_latlon, but placed later in order of priority"""
+        x, y = self.latlon2xy(lat, lon)
+        style_dict = {} if style_dict is None else style_dict
+        color = lib.app_color(_colors, style_dict.get('fill', 'Red'))
+        svg.queue_marker_mm(priority, x, y, txt, style_dict, angle, radius,
+                            icon, color, use_frame, force_write)
 
     def plot_line_latlon(self, p1, p2, style_dict=None):
         x1, y1 = self.latlon2xy(p1.lat, p1.lon)
@@ -4466,6 +5003,15 @@ class SVGMap(object):
         y = (self.mid_lat - lat) * self.lat_to_mm + self.ymid_mm
         return x, y
 
+    def latlons2xys(self, lats, lons):
+        """latlon2xy for whole columns of lats and lons"""
+        lat_to_mm, lon_to_mm = self.lat_to_mm, self.lon_to_mm
+        mid_lat, mid_lon = self.mid_lat, self.mid_lon
+        xmid_mm, ymid_mm = self.xmid_mm, self.ymid_mm
+        xs = [(lon - mid_lon) * lon_to_mm + xmid_mm for lon in lons]
+        ys = [(mid_lat - lat) * lat_to_mm + ymid_mm for lat in lats]
+        return xs, ys
+
     def xy2latlon(self, x, y):
         lat = self.mid_lat - (y - self.ymid_mm) / self.lat_to_mm
         lon = self.mid_lon + (x - self.xmid_mm) / self.lon_to_mm
@@ -4485,14 +5031,23 @@ class SVGMap(object):
 class Timetable(object):
     """SVG matrix with days as columns, hours as rows"""
     def __init__(self, infile, outfile, mode="", header="",
-                 activity="downhill", param="portrait"):
+                 activity_id="downhill", parameters="", **kwargs):
+        """
+        :param infile: directory of tracks, as for Tracklist
+        :param parameters: portrait or landscape, and optionally a track
+         cache directory (see TrackCache), e.g. "landscape ~/gps/cache":
+         the segments are then read from its ge_segments.csv, without
+         reading the tracks
+        """
         self.infile = infile
         self.outfile = outfile
         self.mode = mode
         self.hdr = header
-        self.activity = activity
+        self.activity = activity_id
+        orientation, self.cache_dir = self.split_parameters(parameters)
+        self.tracklist = None  # See _tracklist
         svg.set_canvas("A4")
-        svg.set_orientation(param)
+        svg.set_orientation(orientation)
         svg.reset_margins()
         svg.def_margins('outer', 'mm', 15, 13, 15, 8)
         svg.def_margins('inner', 'mm', 30, 19, 21, 14)
@@ -4503,114 +5058,131 @@ class Timetable(object):
         return s % (self.infile, self.outfile, self.mode, self.hdr,
                     self.activity)
 
+    @staticmethod
+    def split_parameters(parameters):
+        """orientation, track cache directory ("" if none)"""
+        orientation = "portrait"
+        cache_dir = []
+        for word in parameters.split():
+            if word in ("portrait", "landscape"):
+                orientation = word
+            else:
+                cache_dir.append(word)
+        return orientation, os.path.expanduser(" ".join(cache_dir))
+
+    @lib.timed("export svg")
     def as_svg(self):
         svg.set_title(self.hdr, "Timetable")
         s = svg.doc_header()
         s += self._header()
         s += self._frame_page()
         s += self._day_grid()
-        field = self.activity
-        tracklist = Tracklist(self.infile, mode="segments")
+        s += svg.comment('Mode %s activity %s' % (self.mode, self.activity))
+        if self.mode in ["hours", "profile"]:
+            s += self._plot_timepoints()
+        if self.mode != "profile":
+            s += self._plot_segments()
+        s += svg.doc_footer()
+        return s
+
+    def _tracklist(self):
+        """Tracklist of infile, read once for all plots"""
+        if self.tracklist is None:
+            self.tracklist = Tracklist(self.infile, mode="segments",
+                                       parameters="")
+        return self.tracklist
+
+    def _seg_dicts(self):
+        """From the track cache metadata if given, else from the tracks"""
+        if self.cache_dir:
+            return Segment.read_csv(os.path.join(self.cache_dir,
+                                                 "ge_segments.csv"))
+        return [seg.as_dict() for track in self._tracklist().tracks
+                for seg in track['track'].compressed.segments]
+
+    def _plot_segments(self):
+        """One block per segment"""
+        s = ""
+        date_from = fmt.datetime_from_ymd(self.date_from)
+        seg_dicts = self._seg_dicts()
+        seg_dicts.sort(key=lambda seg: (seg['date'], seg['time_start']))
+        for seg_dict in seg_dicts:
+            start_time, end_time = Segment.start_end_datetimes(seg_dict)
+            start_date = start_time.date()
+            time_origo = datetime.datetime.combine(start_date,
+                                                   datetime.time(0))
+            days = (start_date - date_from.date()).days
+            start_hour = (start_time - time_origo).total_seconds() / 3600.0
+            end_hour = (end_time - time_origo).total_seconds() / 3600.0
+            name = seg_dict['name']
+            activity_id = seg_dict['activity_id']
+            s += self._plot(days, start_hour, end_hour, activity_id, name)
+        return s
+
+    def _plot_timepoints(self):
+        """
+        Minute squares, 10 minutes per row within the hour. Consecutive
+        minutes of the same colour and opacity are one rect.
+        """
+        s = ""
+        tracklist = self._tracklist()
+        for track in tracklist.tracks:
+            if not track['track'].timepoints:
+                track['track'].create_timepoints()
         date_from = fmt.datetime_from_ymd(self.date_from)
         date_to = fmt.datetime_from_ymd(self.date_to)
         examined_date = date_from
-        hours_origo = datetime.time(0)  # self.hour_from)
         last_minute_delta = datetime.timedelta(hours=self.hour_to)
-        s += svg.comment('Mode %s activity %s' % (self.mode, self.activity))
-        if self.mode == "hours":
-            while examined_date <= date_to:
-                for track in tracklist.tracks:
-                    track_date = track['date']
-                    if track_date != examined_date.date():
-                        continue
-                    minute_examined = (examined_date +
-                                       datetime.timedelta(
-                                           hours=self.hour_from))
-                    last_minute = examined_date + last_minute_delta
-                    while minute_examined < last_minute:
-                        minute_hm = fmt.hm(minute_examined)
-                        timepoint = track['track'].timepoints.get(minute_hm)
-                        if timepoint is not None:
-                            minute_dict = timepoint.as_dict()
-                            distance = timepoint.distance
-                            hm_up = timepoint.hm_up
-                            hm_down = abs(timepoint.hm_down)
-                            max_speed = timepoint.max_speed
-                            max_slope_up = timepoint.max_slope_up
-                            max_slope_down = abs(timepoint.max_slope_down)
-                            max_slope = (max_slope_down if hm_down > hm_up else
-                                         max_slope_up)
-                            speed = distance * 60
-                            alt = timepoint.alt
-                            day = (examined_date - date_from).days
-                            hour = int(minute_hm[0:2])
-                            minute = int(minute_hm[3:5])
-                            color = 'Green' if hm_up > hm_down else 'Red'
-                            # opacity = min(speed / 30, 1)
-                            opacity = max(0, max_slope / 30)
-
-                            s += self._plot_minute(day, hour, minute,
-                                                  opacity, color)
-                        minute_examined += datetime.timedelta(minutes=1)
-                examined_date += datetime.timedelta(days=1)
-        if self.mode == "profile":
-            while examined_date <= date_to:
-                for track in tracklist.tracks:
-                    track_date = track['date']
-                    if track_date != examined_date.date():
+        while examined_date <= date_to:
+            day = (examined_date - date_from).days
+            for track in tracklist.tracks:
+                if track['date'] != examined_date.date():
+                    continue
+                minute_examined = (examined_date +
+                                   datetime.timedelta(hours=self.hour_from))
+                last_minute = examined_date + last_minute_delta
+                run = None  # [hour, first minute, count, opacity, color]
+                while minute_examined < last_minute:
+                    minute_hm = fmt.hm(minute_examined)
+                    timepoint = track['track'].timepoints.get(minute_hm)
+                    minute_examined += datetime.timedelta(minutes=1)
+                    if timepoint is None:
+                        s += self._plot_minutes(day, run)
+                        run = None
                         continue
-                    minute_examined = (examined_date +
-                                       datetime.timedelta(
-                                           hours=self.hour_from))
-                    last_minute = examined_date + last_minute_delta
-                    last_color = ""
-                    while minute_examined < last_minute:
-                        minute_hm = fmt.hm(minute_examined)
-                        timepoint = track['track'].timepoints.get(minute_hm)
-                        if timepoint is not None:
-                            minute_dict = timepoint.as_dict()
-                            distance = timepoint.distance
-                            hm_up = timepoint.hm_up
-                            hm_down = abs(timepoint.hm_down)
-                            max_speed = timepoint.max_speed
-                            max_slope_up = timepoint.max_slope_up
-                            max_slope_down = abs(timepoint.max_slope_down)
-                            max_slope = (max_slope_down if hm_down > hm_up else
-                                         max_slope_up)
-                            speed = distance * 60
-                            alt = timepoint.alt
-                            day = (examined_date - date_from).days
-                            hour = int(minute_hm[0:2])
-                            minute = int(minute_hm[3:5])
-                            color = ("black" if max_slope_down > 24 else
-                                     "Red" if max_slope_down > 16 else
-                                     "Blue" if max_slope_down > 8 else
-                                     "Green" if max_slope_down > 1 else "Grey")
-                            # color = 'Green' if hm_up > hm_down else 'Red'
-                            #opacity = min(speed / 30, 1)
-                            #opacity = max(0, max_slope/30)
-                            opacity = 1
-
-                            s += self._plot_minute(day, hour, minute,
-                                                  opacity, color)
-                        minute_examined += datetime.timedelta(minutes=1)
-                examined_date += datetime.timedelta(days=1)
-        else:
-            for seg_dict in tracklist.segments:
-                start_date = seg_dict['start_datetime'].date()
-                time_origo = datetime.datetime.combine(start_date, hours_origo)
-                start_time = seg_dict['start_datetime']
-                end_time = seg_dict['end_datetime']
-                days = (start_date - date_from).days
-                start_hour = (start_time - time_origo).total_seconds() / 3600.0
-                end_hour = (end_time - time_origo).total_seconds() / 3600.0
-                name = seg_dict['short_name']
-                dist = seg_dict['distance']
-                activity_id = seg_dict['activity_id']
-                s += self._plot(days, start_hour, end_hour, activity_id, name)
-        s += svg.doc_footer()
+                    hour = int(minute_hm[0:2])
+                    minute = int(minute_hm[3:5])
+                    opacity, color = self._minute_style(timepoint)
+                    continues_run = (run is not None and run[0] == hour and
+                                     run[1] + run[2] == minute and
+                                     minute % 10 != 0 and
+                                     run[3:] == [opacity, color])
+                    if continues_run:
+                        run[2] += 1
+                    else:
+                        s += self._plot_minutes(day, run)
+                        run = [hour, minute, 1, opacity, color]
+                s += self._plot_minutes(day, run)
+            examined_date += datetime.timedelta(days=1)
         return s
 
+    def _minute_style(self, timepoint):
+        """opacity (rounded to 0.1, so that minutes can merge) and colour"""
+        hm_up = timepoint.hm_up
+        hm_down = abs(timepoint.hm_down)
+        max_slope_up = timepoint.max_slope_up
+        max_slope_down = abs(timepoint.max_slope_down)
+        if self.mode == "profile":
+            color = ("black" if max_slope_down > 24 else
+                     "Red" if max_slope_down > 16 else
+                     "Blue" if max_slope_down > 8 else
+                     "Green" if max_slope_down > 1 else "Grey")
+            return 1, color
+        max_slope = max_slope_down if hm_down > hm_up else max_slope_up
+        color = 'Green' if hm_up > hm_down else 'Red'
+        opacity = min(1, max(0, round(max_slope / 30.0, 1)))
+        return opacity, color
+
     def save_as(self, filename):
         s = self.as_svg()
         lib.save_as(filename, s, verbose=True)
@@ -4627,7 +5199,8 @@ class Timetable(object):
         s += svg.plot_header("ngt", 'outer', 'right', 'top',
                              style_dict={'font-size': 4})
         y = svg.canvas['outer']['mm']['bottom'] + 6
-        s += use_template % ("elk-inv", lib.app_color(_colors, 'Green'),
+        s += use_template % (svg.use_icon("elk-inv"),
+                             lib.app_color(_colors, 'Green'),
                              x - 4, y - 5, 1.7)
         s += svg.plot_header("Green Elk %s " % fmt.current_timestamp(),
                              'outer', 'left', 'bottom',
@@ -4728,13 +5301,17 @@ class Timetable(object):
         _last_text = text if text != "" else _last_text
         return s
 
-    def _plot_minute(self, day, hour, minute, opacity, color):
+    def _plot_minutes(self, day, run):
+        """run: [hour, first minute, count, opacity, color] or None"""
+        if run is None:
+            return ""
+        hour, minute, count, opacity, color = run
         canvas_mm = svg.canvas['inner']['mm']
         minute_column = float(minute % 10) / 10
         minute_row = float(int(minute / 10)) / 6
         column = day + 1 + minute_column
         row = hour - self.hour_from + 1 + minute_row
-        width = self.column_width / 10
+        width = self.column_width / 10 * count
         height = self.row_height / 6
         x = canvas_mm['left'] + column * self.column_width
         y = canvas_mm['top'] + row * self.row_height
@@ -4742,13 +5319,478 @@ class Timetable(object):
         return svg.plot_rect_mm(x, y, width, height, style)
 
 
+class Geotag(object):
+    """Positions of photos, by time stamp, from the tracks of a TrackCache"""
+    MAX_GAP_S = 15 * 60  # No position if trackpoints further apart
+    PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".tif", ".tiff",
+                        ".dng", ".cr2", ".nef", ".arw")
+
+    def __init__(self, infile, **kwargs):
+        """
+        :param infile: directory of photos (EXIF DateTimeOriginal of
+         JPEGs, in local time, else the file time taken as UTC), or a csv
+         file with the columns filename,timestamp
+        :param kwargs: parameters = track cache directory, with
+         ge_segments.csv (see TrackCache)
+        """
+        self.infile = infile
+        self.kwargs = kwargs
+        self.header = kwargs.get('header', "") or "Geotag"
+        self.cache_dir = os.path.expanduser(kwargs.get('parameters', ""))
+        self.photos = self._read_photos(infile)
+        self.photos.sort(key=lambda photo: photo['datetime'])
+        self.points = self._read_points()
+        self._merge_join()
+
+    def __str__(self):
+        matched = len([photo for photo in self.photos if photo['lat'] != ""])
+        return "Geotag %s: %s of %s photos matched, %s trackpoints" % (
+            self.infile, matched, len(self.photos), len(self.points))
+
+    def _read_photos(self, infile):
+        photos = []
+        if os.path.isdir(infile):
+            file_times = 0
+            for just_filename in sorted(os.listdir(infile)):
+                if not just_filename.lower().endswith(self.PHOTO_EXTENSIONS):
+                    continue
+                filename = os.path.join(infile, just_filename)
+                try:
+                    local = self._parse_timestamp(self._exif_datetime(
+                        filename) or "")
+                except ValueError:  # No EXIF time
+                    utc = datetime.datetime.utcfromtimestamp(
+                        os.path.getmtime(filename))
+                    photos.append(self._photo(just_filename, utc, True))
+                    file_times += 1
+                    continue
+                photos.append(self._photo(just_filename, local, False))
+            if file_times > 0:
+                userbug.add("Geotag: %s photos in %s without EXIF time, "
+                            "file time taken as UTC" % (file_times, infile))
+            return photos
+        if not os.path.exists(infile):
+            raise Exception("Geotag: File '%s' missing" % infile)
+        with open(infile) as csvfile:
+            reader = csv.DictReader(csvfile)
+            for i, row in enumerate(reader):
+                filename = (row.get('filename') or "").strip()
+                if filename == "" or filename.startswith("#"):
+                    continue
+                timestamp = (row.get('timestamp') or "").strip()
+                is_utc = timestamp.endswith("Z")
+                try:
+                    a_datetime = self._parse_timestamp(timestamp)
+                except ValueError:
+                    userbug.add("Geotag: row %s bad timestamp '%s' in %s" %
+                                (i, timestamp, infile))
+                    continue
+                photos.append(self._photo(filename, a_datetime, is_utc))
+        return photos
+
+    @staticmethod
+    def _exif_datetime(filename):
+        """DateTimeOriginal in the EXIF (APP1) of a JPEG file, or None"""
+        try:
+            with open(filename, "rb") as f:
+                if f.read(2) != b"\xff\xd8":
+                    return None
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0:1] != b"\xff":
+                        return None
+                    if marker[1:2] in (b"\xda", b"\xd9"):  # Image data
+                        return None
+                    length = struct.unpack(">H", f.read(2))[0]
+                    data = f.read(length - 2)
+                    if (marker[1:2] == b"\xe1" and
+                            data.startswith(b"Exif\x00\x00")):
+                        return Geotag._tiff_datetime(data[6:])
+        except (IOError, struct.error, IndexError, UnicodeDecodeError):
+            return None
+
+    @staticmethod
+    def _tiff_datetime(tiff):
+        """
+        DateTimeOriginal (tag 0x9003 of the EXIF IFD) of the TIFF
+        structure within APP1, else DateTime (0x0132) of IFD0, or None
+        """
+        order = "<" if tiff[:2] == b"II" else ">"
+
+        def entries(offset):  # tag, count, value or offset
+            count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+            for i in range(count):
+                start = offset + 2 + 12 * i
+                tag, type_, n, value = struct.unpack(
+                    order + "HHII", tiff[start:start + 12])
+                yield tag, n, value
+
+        def ascii_value(n, offset):
+            return tiff[offset:offset + n].rstrip(b"\x00 ").decode("ascii")
+
+        date_time = None
+        for tag, n, value in entries(struct.unpack(order + "I",
+                                                   tiff[4:8])[0]):
+            if tag == 0x0132:
+                date_time = ascii_value(n, value)
+            elif tag == 0x8769:
+                for exif_tag, exif_n, exif_value in entries(value):
+                    if exif_tag == 0x9003:
+                        return ascii_value(exif_n, exif_value)
+        return date_time
+
+    @staticmethod
+    def _parse_timestamp(timestamp):
+        """2015-06-01 10:11:12, 2015-06-01T10:11:12Z or EXIF 2015:06:01 ..."""
+        timestamp = timestamp.replace("T", " ").replace("Z", "").strip()
+        date, time = (timestamp.split(" ", 1) + [""])[:2]
+        timestamp = date.replace(":", "-") + " " + time.split(".")[0]
+        return fmt.datetime_from_ymd_hms(timestamp)
+
+    @staticmethod
+    def _photo(filename, a_datetime, is_utc):
+        """Photo dict, in local time (as tracks) by the day's time zone"""
+        if is_utc:
+            date = fmt.yymd(a_datetime)
+            if _day_metadata[date] == "":
+                userbug.add("Geotag: no day metadata (time zone) for %s" %
+                            date)
+            else:
+                minutes = int(_day_metadata[date].timezone)
+                a_datetime += datetime.timedelta(minutes=minutes)
+        return {'filename': filename, 'datetime': a_datetime,
+                'lat': "", 'lon': "", 'alt': "", 'gap_s': ""}
+
+    def _read_points(self):
+        """(datetime, lat, lon, alt) of cached tracks near photo times"""
+        points = []
+        if not self.photos:
+            return points
+        infile = os.path.join(self.cache_dir, "ge_segments.csv")
+        seg_dicts = Segment.read_csv(infile)
+        photo_times = [photo['datetime'] for photo in self.photos]
+        max_gap = datetime.timedelta(seconds=self.MAX_GAP_S)
+        for seg_dict in seg_dicts:
+            start, end = Segment.start_end_datetimes(seg_dict)
+            i_photo = bisect_left(photo_times, start - max_gap)
+            has_photos = (i_photo < len(photo_times) and
+                          photo_times[i_photo] <= end + max_gap)
+            if not has_photos:
+                continue
+            activity_id = seg_dict['activity_id']
+            filename = os.path.join(self.cache_dir, activity_id,
+                                    Segment.csv_filename(seg_dict))
+            track = Track(filename, activity_id=activity_id, mode="read",
+                          main_activity_id=activity_id,
+                          comment="Geotag %s" % seg_dict['name'])
+            points += [(tp.datetime, tp.lat, tp.lon, float(tp.alt or 0))
+                       for tp in track.trackpoints]
+        points.sort(key=lambda point: point[0])
+        return points
+
+    def _merge_join(self):
+        """One pass over photos and trackpoints, both sorted by time"""
+        points = self.points
+        count = len(points)
+        j = 0
+        for photo in self.photos:
+            a_datetime = photo['datetime']
+            while j < count and points[j][0] <= a_datetime:
+                j += 1
+            if j == 0:
+                continue  # Before the first trackpoint
+            before = points[j - 1]
+            if before[0] == a_datetime:
+                photo.update({'lat': before[1], 'lon': before[2],
+                              'alt': before[3], 'gap_s': 0})
+                continue
+            if j == count:
+                continue  # After the last trackpoint
+            after = points[j]
+            gap_s = (after[0] - before[0]).total_seconds()
+            if gap_s > self.MAX_GAP_S:
+                continue
+            share = (a_datetime - before[0]).total_seconds() / gap_s
+            photo.update({'lat': before[1] + share * (after[1] - before[1]),
+                          'lon': before[2] + share * (after[2] - before[2]),
+                          'alt': before[3] + share * (after[3] - before[3]),
+                          'gap_s': int(gap_s)})
+
+    def save_as(self, filename):
+        file_format = filename.split(".")[-1]
+        if file_format == 'csv':
+            self.save_as_csv(filename)
+            return
+        if file_format == 'kml':
+            a_str = self.as_kml()
+        else:
+            raise Exception("Unknown file format %s" % file_format)
+        lib.save_as(filename, a_str, verbose=True)
+
+    @lib.timed("export csv")
+    def save_as_csv(self, filename):
+        fields = ['filename', 'datetime', 'lat', 'lon', 'alt', 'gap_s']
+        with open(filename, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fields)
+            writer.writeheader()
+            for photo in self.photos:
+                row = dict(photo)
+                row['datetime'] = self._fmt_datetime(photo['datetime'])
+                if photo['lat'] != "":
+                    row['lat'] = geo.lat_lon_5(photo['lat'])
+                    row['lon'] = geo.lat_lon_5(photo['lon'])
+                    row['alt'] = int(photo['alt'])
+                writer.writerow(row)
+        print("%s photos saved into file %s" % (len(self.photos), filename))
+
+    @staticmethod
+    def _fmt_datetime(a_datetime):
+        return fmt.yymd(a_datetime) + " " + fmt.hms(a_datetime)
+
+    @lib.timed("export kml")
+    def as_kml(self):
+        k = kml.doc_header(self.header)
+        placetype = _placetypes['photo']
+        icon_url = placetype.url if placetype != "" else ""
+        for photo in self.photos:
+            if photo['lat'] == "":
+                continue
+            k += kml.placemark_header(photo['filename'].replace("&", "&amp;"))
+            coordinates = "%s,%s" % (geo.lat_lon_5(photo['lon']),
+                                     geo.lat_lon_5(photo['lat']))
+            k += kml.point_header_footer(coordinates, icon_url)
+            k += kml.placemark_description(
+                self._fmt_datetime(photo['datetime']))
+            k += kml.placemark_footer()
+        k += kml.doc_footer()
+        return k
+
+
+class Batch(object):
+    """
+    Rows of ge_commands.csv, planned: rows reading the same input form
+    one group, which reads the input once. Groups that do not depend
+    on each other run in parallel processes, forked from this one (they
+    find this Batch as _batch), else one after another.
+    """
+    SHARED_INPUT = ['Track', 'Places', 'Geotag']  # See execute_rows
+
+    def __init__(self, rows, command, processes=None):
+        self.rows = list(rows)
+        self.command = command
+        self.processes = processes or multiprocessing.cpu_count()
+        self.groups = []  # {'rows': [i], 'phase': n, 'level': n, ...}
+        self.timings = {}  # i: (seconds, process, shared input)
+        self.seconds = 0.0
+        self._plan()
+
+    def __str__(self):
+        s = "Batch: %s rows in %s groups, up to %s processes"
+        return s % (len(self.rows), len(self.groups), self.processes)
+
+    @staticmethod
+    def is_barrier(row):
+        """Rows changing the globals used by all later rows"""
+        return row.command == 'Places' and row.outfile == ""
+
+    @staticmethod
+    def input_key(row):
+        """Rows with the same key can share one read of the input"""
+        if row.command not in Batch.SHARED_INPUT or Batch.is_barrier(row):
+            return None
+        return (row.command, row.mode, row.parameters, row.header,
+                row.activity, row.lat, row.lon, row.km, row.infile)
+
+    @staticmethod
+    def reads(row):
+        paths = [row.infile]
+        if row.command == 'Geotag':
+            paths.append(row.parameters)  # Track cache directory
+        if row.command == 'Timetable':
+            paths.append(Timetable.split_parameters(row.parameters)[1])
+        if row.outfile.endswith((".svg", ".svgz")):
+            paths.append(_svg_icon_file)  # Icons, as merged by SVGMerge
+        return [os.path.abspath(os.path.expanduser(path))
+                for path in paths if path != ""]
+
+    @staticmethod
+    def writes(row):
+        paths = [row.outfile]
+        if row.command == 'Tracklist':
+            paths.append(row.outfile.replace(".html", "_missing.csv"))
+        if row.command == 'Cache':
+            paths.append(row.infile)  # ge_segments.csv, in mode edit
+        if row.command == 'SVGMerge':
+            paths.append(row.outfile.replace(".svg", "-demo.svg"))
+        return [os.path.abspath(os.path.expanduser(path))
+                for path in paths if path != ""]
+
+    @staticmethod
+    def overlap(paths_1, paths_2):
+        """True if any path is the same as, or inside, any other"""
+        for path_1 in paths_1:
+            for path_2 in paths_2:
+                if (path_1 == path_2 or path_1.startswith(path_2 + os.sep)
+                        or path_2.startswith(path_1 + os.sep)):
+                    return True
+        return False
+
+    @staticmethod
+    def depends(earlier, later):
+        """True if group later must wait for group earlier"""
+        return (Batch.overlap(earlier['writes'], later['reads']) or
+                Batch.overlap(earlier['reads'], later['writes']) or
+                Batch.overlap(earlier['writes'], later['writes']))
+
+    def _plan(self):
+        phase = 0
+        phase_groups = []
+        for i, row in enumerate(self.rows):
+            group = {'rows': [i], 'reads': self.reads(row),
+                     'writes': self.writes(row), 'key': self.input_key(row),
+                     'phase': phase, 'level': 0}
+            if self.is_barrier(row):
+                group['phase'] = phase + 1
+                self.groups.append(group)
+                phase += 2
+                phase_groups = []
+                continue
+            shared = None
+            for j, other in enumerate(phase_groups):
+                later = phase_groups[j + 1:]
+                if (group['key'] is not None and other['key'] == group['key']
+                        and not [g for g in later if self.depends(g, group)]):
+                    shared = other
+            if shared is not None:
+                shared['rows'].append(i)
+                shared['writes'] += group['writes']
+            else:
+                phase_groups.append(group)
+                self.groups.append(group)
+            self._set_levels(phase_groups)
+
+    def _set_levels(self, phase_groups):
+        """Level 0 runs first, then 1 etc., groups of a level in parallel"""
+        for j, group in enumerate(phase_groups):
+            group['level'] = 0
+            for earlier in phase_groups[:j]:
+                if self.depends(earlier, group):
+                    group['level'] = max(group['level'],
+                                         earlier['level'] + 1)
+
+    def run(self):
+        global _batch
+        _batch = self
+        started = time.time()
+        self.progress = lib.Progress("Batch", len(self.rows), shared=True)
+        steps = {}
+        for group_no, group in enumerate(self.groups):
+            step = (group['phase'], group['level'])
+            steps.setdefault(step, []).append(group_no)
+        for step in sorted(steps):
+            group_nos = steps[step]
+            in_parallel = (len(group_nos) > 1 and self.processes > 1 and
+                           hasattr(os, 'fork'))
+            if in_parallel:
+                _load_lazy_config()  # Once here, not once per process
+                sys.stdout.flush()
+                pool = multiprocessing.Pool(min(self.processes,
+                                                len(group_nos)))
+                mapped = pool.map_async(_run_batch_group, group_nos)
+                while not mapped.ready():  # Workers count, this one shows
+                    mapped.wait(lib.Progress.INTERVAL_S)
+                    self.progress.show()
+                results = mapped.get()
+                pool.close()
+                pool.join()
+            else:
+                results = []
+                for group_no in group_nos:
+                    results.append(self.run_group(group_no))
+                    self.progress.show()
+            for result in results:
+                self.timings.update(result['timings'])
+                for bug in result['userbugs']:
+                    userbug.list.append(bug)
+                    userbug.bug_count += 1
+        self.progress.done()
+        self.seconds = time.time() - started
+
+    def run_group(self, group_no):
+        """
+        :return: {'timings': {i: (seconds, process, shared)},
+        'userbugs': [text]}, the userbugs only if run in another process
+        """
+        rows = [self.rows[i] for i in self.groups[group_no]['rows']]
+        bug_count = len(userbug.list)
+        seconds = self.command.execute_rows(rows)
+        self.progress.add(files=len(rows))
+        pid = os.getpid()
+        process = "main" if pid == _main_pid else str(pid)
+        timings = {}
+        for j, i in enumerate(self.groups[group_no]['rows']):
+            timings[i] = (seconds[j], process, j > 0)
+        userbugs = [] if process == "main" else userbug.list[bug_count:]
+        sys.stdout.flush()
+        return {'timings': timings, 'userbugs': userbugs}
+
+    def timing_summary(self):
+        s = "\n%s, %.2f s\n" % (self, self.seconds)
+        s += "%4s %-10s %-40s %8s %s\n" % ("Row", "Command", "Outfile",
+                                           "Seconds", "Process")
+        for i, row in enumerate(self.rows):
+            seconds, process, shared = self.timings.get(i, (0.0, "-", False))
+            outfile = row.outfile if len(row.outfile) <= 40 else (
+                "..." + row.outfile[-37:])
+            line = "%4s %-10s %-40s %8.2f %-8s %s" % (
+                i + 1, row.command, outfile, seconds, process,
+                "(input shared)" if shared else "")
+            s += line.rstrip() + "\n"
+        return s
+
+
+def _find_day_segments(part):
+    """
+    Segments of the trackpoints first...stop - 1 of _day_track, maybe in
+    a pool process forked from Track._find_segments_by_day
+    :return: [(i_first_tp, i_last_tp, activity_id)] from first
+    """
+    first, stop, activity_id = part
+    try:
+        if stop - first < 2:
+            return []
+        day = Track(None, mode="empty", activity_id=activity_id,
+                    diary=_day_track.diary)
+        day.mode = _day_track.mode
+        day.trackpoints = _day_track.trackpoints[first:stop]
+        day.date = day.trackpoints[0].datetime.date()
+        day._find_relevant_places()
+        day._find_segments()
+        return [(seg.i_first_tp, seg.i_last_tp, seg.activity_id)
+                for seg in day.segments]
+    except Exception:
+        print(traceback.format_exc())  # Lost on the way back otherwise
+        raise
+
+
+def _run_batch_group(group_no):
+    """Runs in a pool process, forked from the one running Batch.run"""
+    lib.Progress.silent = True  # One line at a time: Batch.run shows
+    try:
+        return _batch.run_group(group_no)
+    except Exception:
+        print(traceback.format_exc())  # Lost on the way back otherwise
+        raise
+
+
 class Command(object):
     """User command"""
 
     def __init__(self, user_input, invoked_from_outside=False):
         self.user_input = user_input
         self.params = {'i': None, 'o': None, 'log': None, 'f': None,
-                      'iactivity': 'run', 'ifmt': 'gpx', 'ofmt': 'json'}
+                      'iactivity': 'run', 'ifmt': 'gpx', 'ofmt': 'json',
+                      'serve': None, 'root': None}
         if invoked_from_outside:
             self._server_level_code(argv=user_input)
         elif user_input == "check":
@@ -4773,78 +5815,148 @@ class Command(object):
                 'outfile': os.path.expanduser(row.outfile)}
 
     def _execute_commands(self, user_input):
-        global _debug_object, _day_metadata, _time_metadata, _svg_icon_file
-        global _places
         lib.start_log("_execute_commands")
-        for row in user_input:
-            command = row.command
-            infile = os.path.expanduser(row.infile)
-            outfile = os.path.expanduser(row.outfile)
-            _debug_object = row.command
+        batch = Batch(user_input, self)
+        batch.run()
+        print(batch.timing_summary())
+
+    def execute_rows(self, rows):
+        """
+        Rows with the same input (see Batch): the input is read once,
+        then each row saves its own outfile
+        :return: seconds per row, the first one including the reading
+        """
+        global _debug_object
+        seconds = []
+        shared = [None]
+        for row in rows:
+            started = time.time()
             params = self.as_dict(row)
-            lib.log_event(command + " " + infile)
+            _debug_object = row.command
+            lib.log_event(row.command + " " + params['infile'])
+            # Gzipped .svgz maps also get the compact <path> writer
+            svg.compact = params['outfile'].endswith(".svgz")
 
-            dir_ = infile
-            if not os.path.isdir(dir_):
-                dir_ = os.path.dirname(dir_)
-
-            if command == 'Places':
-                place = Places(**params)
-                change_global_places_file = outfile == ""
-                if change_global_places_file:
-                    _places = place
+            def execute():
+                if shared[0] is None:
+                    shared[0] = self._execute_row(row, params)
                 else:
-                    place.save_as(outfile)
-            elif command == 'Tracklist':
-                tracklist = Tracklist(**params)
-                tracklist.save_as(outfile)
-                if row.parameters == "missing":
-                    outfile_2 = outfile.replace(".html", "_missing.csv")
-                    tracklist.mode = "missing"
-                    tracklist.save_as(outfile_2)
-            elif command == 'Timetable':
-                timetable = Timetable(**params)
-                timetable.save_as(outfile)
-            elif command == 'Cache':
-                cache = TrackCache(**params)
-                if cache.count == 0:
-                    print("No rows matching criteria %s" % self.str_(row))
-                elif params['mode'] != "edit":
-                    cache.save_as(outfile)
-            elif command == 'SVG':
-                svg_map = self._svg_test_output()
-                lib.save_as(outfile, svg_map, verbose=True)
-            elif command == 'Track':
-                params['main_activity_id'] = params['activity_id']
-                track = Track(**params)
-                if params['mode'] != "tour":
-                    track.calc_milestones()
-                track.save_as(outfile)
-            elif command == 'Config':
-                config_entity = row.mode
-                infile = config_files[config_entity]['filename']
-                fields = config_files[config_entity]['fields']
-                dir_ = config_files[config_entity]['dir_']
-                enumerate_rows = config_entity in "Commands Time_metadata"
-                print("Config %s %s" % (infile, fields))
-                config = lib.Config(config_entity, fields, infile,
-                                    enumerate_rows, dir_)
-                field_transformations = None
-                if config_entity == "Placetype":
-                    field_transformations = [
-                        ['url', Placetypes.img_url],
-                        ['svg', Placetypes.svg_img_with_text]]
-                config.save_as(outfile, subhead_field=row.parameters,
-                               field_transformations=field_transformations)
-            elif command == 'SVGMerge':
-                dir_ = infile
-                svg_files = []
-                for placetype in _placetypes:
-                    icon_file = placetype.svg
-                    if icon_file != "":
-                        svg_files.append(icon_file)
-                kajsvg.merge(dir_, svg_files, outfile)
-            lib.log_event(" - Done: " + row.command + " " + outfile)
+                    shared[0].save_as(params['outfile'])
+            row_no = int(row.z_rowno_) + 1  # As in Batch.timing_summary
+            report_name = "row_%s_%s" % (row_no, row.command)
+            headers = {'row': row_no,
+                       'command': row.command, 'infile': params['infile'],
+                       'outfile': params['outfile'],
+                       'input_shared': shared[0] is not None}
+            self.instrumented(report_name, row.command, execute, headers)
+            lib.log_event(" - Done: " + row.command + " " + params['outfile'])
+            seconds.append(time.time() - started)
+        return seconds
+
+    @staticmethod
+    def instrumented(report_name, span, func, headers):
+        """
+        func() as one Span, with a report of its spans and counters saved
+        as log/stats/report_name.json (or .csv), and its cProfile
+        statistics as report_name.pstats, if asked for (see _instrument).
+        With -memprofile the spans of the report also measure memory.
+        """
+        stats_fmt = _instrument['stats']
+        profile = cProfile.Profile() if _instrument['profile'] else None
+        if stats_fmt is None and profile is None:
+            return func()
+        if stats_fmt is not None:
+            lib.start_stats(counted=_COUNTED,
+                            memory=_instrument['memory'])
+        if profile is not None:
+            profile.enable()
+        try:
+            with lib.Span(span):
+                return func()
+        finally:
+            if profile is not None:
+                profile.disable()
+            lib.ensure_dir(_instrument['dir_'])
+            filename = os.path.join(_instrument['dir_'], report_name)
+            if stats_fmt is not None:
+                stats = lib.stop_stats()
+                report = lib.stats_report(stats, stats_fmt, **headers)
+                lib.save_as(filename + "." + stats_fmt, report)
+            if profile is not None:
+                profile.dump_stats(filename + ".pstats")
+
+    def _execute_row(self, row, params):
+        """
+        :return: the object read from the input, for the commands in
+        Batch.SHARED_INPUT
+        """
+        global _places
+        command = row.command
+        infile = params['infile']
+        outfile = params['outfile']
+        if command == 'Places':
+            place = Places(**params)
+            change_global_places_file = outfile == ""
+            if change_global_places_file:
+                _places = place
+            else:
+                place.save_as(outfile)
+                return place
+        elif command == 'Tracklist':
+            tracklist = Tracklist(**params)
+            tracklist.save_as(outfile)
+            if row.parameters == "missing":
+                outfile_2 = outfile.replace(".html", "_missing.csv")
+                tracklist.mode = "missing"
+                tracklist.save_as(outfile_2)
+        elif command == 'Timetable':
+            timetable = Timetable(**params)
+            timetable.save_as(outfile)
+        elif command == 'Geotag':
+            geotag = Geotag(**params)
+            print(str(geotag))
+            geotag.save_as(outfile)
+            return geotag
+        elif command == 'Cache':
+            cache = TrackCache(**params)
+            if cache.count == 0:
+                print("No rows matching criteria %s" % self.str_(row))
+            elif params['mode'] != "edit":
+                cache.save_as(outfile)
+        elif command == 'SVG':
+            svg_map = self._svg_test_output()
+            lib.save_as(outfile, svg_map, verbose=True)
+        elif command == 'Track':
+            params['main_activity_id'] = params['activity_id']
+            track = Track(**params)
+            if params['mode'] != "tour":
+                track.calc_milestones()
+            track.save_as(outfile)
+            return track
+        elif command == 'Config':
+            config_entity = row.mode
+            infile = config_files[config_entity]['filename']
+            fields = config_files[config_entity]['fields']
+            dir_ = config_files[config_entity]['dir_']
+            enumerate_rows = config_entity in "Commands Time_metadata"
+            print("Config %s %s" % (infile, fields))
+            config = lib.Config(config_entity, fields, infile,
+                                enumerate_rows, dir_)
+            field_transformations = None
+            if config_entity == "Placetype":
+                field_transformations = [
+                    ['url', Placetypes.img_url],
+                    ['svg', Placetypes.svg_img_with_text]]
+            config.save_as(outfile, subhead_field=row.parameters,
+                           field_transformations=field_transformations)
+        elif command == 'SVGMerge':
+            dir_ = infile
+            svg_files = []
+            for placetype in _placetypes:
+                icon_file = placetype.svg
+                if icon_file != "":
+                    svg_files.append(icon_file)
+            kajsvg.merge(dir_, svg_files, outfile)
 
     def _server_level_code(self, argv):
         def translate_argv_find_config_py():
@@ -4868,12 +5980,80 @@ class Command(object):
 
         config_py = translate_argv_find_config_py()
         import_right_config_py(config_py)
+        lib.Progress.silent = True  # stdout is the output
+
+        if self.params['serve']:
+            self._serve(self.params['serve'])
+            return
+        headers = {'i': self.params['i'], 'o': self.params['o'],
+                   'ofmt': self.params['ofmt']}
+        self.instrumented("server_level", "server_level",
+                          self._server_level_run, headers)
+
+    def _server_level_run(self):
+        input_format = self.params['ifmt']
+        if self.params['i'] == 'stdin':
+            input_files = [lib.StreamInput(sys.stdin)]
+        elif self.params['i'] == '-':  # Several inputs, one after another
+            input_files = lib.split_documents(sys.stdin, input_format)
+        else:
+            input_files = self.params['i'].split(",")
+        complete_track, error = self.merge_tracks(
+            input_files, self.params['iactivity'], input_format)
+        output_chunks = ([error] if error else
+                         complete_track.output_chunks(self.params['ofmt']))
+
+        output_to_stdout = (self.params['o'] == 'stdout')
+        if not output_to_stdout:  # Comments on screen are OK
+            print(complete_track)
+        if output_to_stdout:
+            with lib.Span("export " + self.params['ofmt']):
+                for chunk in output_chunks:  # Written as soon as formatted
+                    sys.stdout.write(chunk)
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+        else:
+            output_file = self.params['o']
+            lib.save_as(output_file, "".join(output_chunks))
+        # Append log to end of log file
+        log_file = self.params['log']
+        # log_content = str(complete_track.logger)
+        #with open(log_file, "a") as f:
+        #    f.write(log_content)
+
+    @staticmethod
+    def merged_tracks(input_files, activity_id, output_format,
+                      input_format=""):
+        """
+        Tracks of input_files appended into one, in time order
+        :return: complete Track, output as output_format ("" if error),
+        JSON error ("" if none)
+        """
+        complete_track, error = Command.merge_tracks(input_files,
+                                                     activity_id, input_format)
+        output = "" if error else format(complete_track, output_format)
+        return complete_track, output, error
 
-        input_files = self.params['i'].split(",")
+    @staticmethod
+    def merge_tracks(input_files, activity_id, input_format=""):
+        """
+        Tracks of input_files merged into one, in time order: each file
+        is only parsed, and the merged track is analysed once
+        :param input_files: filenames or lib.StreamInputs (of
+        input_format, as are files without a Track.INPUT_FORMATS suffix)
+        :return: complete Track, JSON error ("" if none)
+        """
         tracklist = []
         for input_file in input_files:
-            one_track = Track(input_file, server_level=True,
-                              activity_id=self.params['iactivity'])
+            stream_kwargs = {}
+            if isinstance(input_file, lib.StreamInput):
+                stream_kwargs = {'stream': input_file,
+                                 'input_format': input_format}
+                input_file = input_file.name
+            elif input_file.split(".")[-1] not in Track.INPUT_FORMATS:
+                stream_kwargs = {'input_format': input_format}
+            one_track = Track(input_file, mode="parse", server_level=True,
+                              activity_id=activity_id, **stream_kwargs)
             first_tp = one_track.trackpoints[0]
             last_tp = one_track.trackpoints[len(one_track.trackpoints) - 1]
             a_track = {'track': one_track,
@@ -4886,8 +6066,7 @@ class Command(object):
         prev_last_time = tracklist[0]['first_time']
         prev_file = ""
         input_is_valid = False
-        output = ""
-        complete_track = Track(None)  # We append all tracks to this one
+        error = ""
         for track_dict in tracklist:
             filename = track_dict['filename'].split("/")[-1]
             # Strip away the path
@@ -4899,33 +6078,46 @@ class Command(object):
                 errmsg += "These two files cannot be merged."
                 errmsg = errmsg % (filename, prev_file, first_time,
                                    prev_last_time)
-                output = '{"success": false, "errcode": 7001, "error": "%s"}'
-                output %= errmsg
+                error = '{"success": false, "errcode": 7001, "error": %s}'
+                error %= json.dumps(errmsg)
                 break
-            first_file = (prev_file == "")
-            if first_file:
-                complete_track = track_dict['track']
-            else:
-                complete_track.append(track_dict['track'])
             prev_file = filename
             prev_last_time = track_dict['last_time']
-
-        output_to_stdout = (self.params['o'] == 'stdout')
-        if not output_to_stdout:  # Comments on screen are OK
-            print(complete_track)
-        output_format = self.params['ofmt']
+        complete_track = tracklist[0]['track']  # The others merged into it
         if input_is_valid:
-            output = format(complete_track, output_format)
-        if output_to_stdout:
-            print(output)
+            complete_track.merge([track_dict['track']
+                                  for track_dict in tracklist[1:]])
+        return complete_track, error
+
+    def _serve(self, address):
+        """
+        Long-running server: config, places and icons are read once (and
+        again only when the config files change), and each request is
+        handled in a process forked from the warm one. address is
+        host:port for HTTP over TCP, or the path of a Unix socket.
+        Requests take the parameters i, iactivity, ifmt, ofmt and o, e.g.
+        GET /?i=a.gpx,b.gpx&ofmt=kml (or the same as a POST body). Files
+        i and o are within -root=dir (by default the current directory),
+        as anyone who can connect can make requests.
+        """
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+            server = _HTTPDaemon((host, int(port)), _DaemonRequest)
         else:
-            output_file = self.params['o']
-            lib.save_as(output_file, output)
-        # Append log to end of log file
-        log_file = self.params['log']
-        # log_content = str(complete_track.logger)
-        #with open(log_file, "a") as f:
-        #    f.write(log_content)
+            if os.path.exists(address):
+                os.remove(address)  # Left behind by a previous daemon
+            server = _UnixDaemon(address, _DaemonRequest)
+        server.defaults = dict(self.params)
+        server.root = os.path.realpath(self.params['root'] or os.getcwd())
+        print("kajgps serving on %s (stop with Ctrl-C)" % address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if ":" not in address and os.path.exists(address):
+                os.remove(address)
 
     def check_status(self, verbose=False):
 
@@ -5087,6 +6279,103 @@ class Command(object):
         return s
 
 
+class _ConfigReloader(ForkingMixIn):
+    """Forks per request, after reading changed config files again"""
+
+    def process_request(self, request, client_address):
+        _reload_config_if_changed()
+        ForkingMixIn.process_request(self, request, client_address)
+
+
+class _HTTPDaemon(_ConfigReloader, HTTPServer):
+    pass
+
+
+class _UnixDaemon(_ConfigReloader, UnixStreamServer):
+    pass
+
+
+class _DaemonRequest(BaseHTTPRequestHandler):
+    """One request to the kajgps server, see Command._serve"""
+
+    content_types = {'json': 'application/json',
+                     'kml': 'application/vnd.google-earth.kml+xml',
+                     'svg': 'image/svg+xml', 'html': 'text/html'}
+
+    def do_GET(self):
+        self._respond(urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not isinstance(body, str):
+            body = body.decode('utf-8')
+        self._respond(body)
+
+    def _respond(self, query):
+        params = dict(self.server.defaults)
+        for param, values in parse_qs(query).items():
+            params[param] = values[-1]
+        status = 200
+        output_to_file = params['o'] not in [None, "", "stdout"]
+        input_files = (params['i'] or "").split(",")
+        outside = [filename for filename in input_files +
+                   ([params['o']] if output_to_file else [])
+                   if not self._within_root(filename)]
+        if not params['i']:
+            status = 400
+            output = self._json(success=False, error="Parameter i missing")
+        elif outside:
+            status = 403
+            output = self._json(success=False,
+                                error="Outside the root: %s" % outside[0])
+        else:
+            try:
+                complete_track, output, error = Command.merged_tracks(
+                    [self._path(filename) for filename in input_files],
+                    params['iactivity'], params['ofmt'], params['ifmt'])
+            except Exception as e:
+                status = 500
+                output = self._json(success=False, error=str(e))
+            else:
+                if error:  # Overlapping track times
+                    status = 409
+                    output = error
+        output_to_file = status == 200 and output_to_file
+        if output_to_file:
+            lib.save_as(self._path(params['o']), output)
+            output = self._json(success=True, file=params['o'])
+        content_type = 'application/json'
+        if status == 200 and not output_to_file:
+            content_type = self.content_types.get(params['ofmt'],
+                                                  'text/plain')
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def _path(self, filename):
+        """filename relative to the root of the server, see Command._serve"""
+        return os.path.realpath(os.path.join(self.server.root, filename))
+
+    def _within_root(self, filename):
+        return self._path(filename).startswith(
+            os.path.join(self.server.root, ""))
+
+    @staticmethod
+    def _json(**kwargs):
+        return json.dumps(kwargs, sort_keys=True)
+
+    def log_message(self, format_, *args):
+        client = self.client_address  # "" for a Unix socket
+        client = client[0] if isinstance(client, tuple) else "unix socket"
+        sys.stderr.write("%s - - [%s] %s\n" % (
+            client, self.log_date_time_string(), format_ % args))
+
+
 html = kajhtml.HTML()
 kml = geo.KML()
 
@@ -5134,52 +6423,349 @@ _icon_dir = os.path.join(_py_dir, "svg")
 for conf in config_files:
     config_files[conf]['dir_'] = _config_file_dir
 
-_check = (sys.argv[-1] == "check" and len(sys.argv) > 1)
-if _check:
-    Command("check")
-    print("Exiting (no commands will be executed after 'check')")
-    exit()
-
-filename = os.path.join(_config_file_dir,config_files['Area']['filename'])
-_areas = {}
-with open(filename) as csvfile:
-    for i, row in enumerate(csvfile):
-        row = row.strip()
-        area = row.split(",")[0]
-        comment_or_empty = (area + " ")[0] in ["#", " "]
-        if not comment_or_empty:
-            _areas[area] = {'order': i, 'sub_areas': []}
-            for j, sub_area in enumerate(row.split(",")[1:]):
-                order = i * 100 + j
-                _areas[sub_area] = {'area': area, 'order_area': i,
-                                    'order_sub_area': order}
-_placetypes = Placetypes(**config_files['Placetype'])
-_places = Places(os.path.join(_config_file_dir, 'ge_places.csv'))
-_day_metadata = lib.Config(**config_files['Day_metadata'])
-_time_metadata = lib.Config(enumerate_rows=True,
-                            **config_files['Time_metadata'])
-_activities = lib.Config(**config_files['Activity'])
-_forced_breaks = lib.Config(**config_files['Forced_break'])
-_svg_icon_file = os.path.join(_config_file_dir, svg_filename['svg_icons'])
+class _LazyGlobal(object):
+    """
+    Stand-in for a module global that is expensive to set up, such as a
+    config table. On first use, loader() is called and the global is
+    replaced by its result, so each command reads only what it uses.
+    """
+
+    def __init__(self, name, loader):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_value', None)
+
+    def _load(self):
+        if self._value is None:
+            object.__setattr__(self, '_value', self._loader())
+            if globals().get(self._name) is self:
+                globals()[self._name] = self._value
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __contains__(self, item):
+        return item in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
 
-colors = lib.Config(**config_files['Colors'])
-_colors = {}
-for color in colors:
-    _colors[color.color] = color.hex
-svg = kajsvg.SVG(_colors)
+    def __len__(self):
+        return len(self._load())
+
+    def __format__(self, fmt_):
+        return format(self._load(), fmt_)
+
+    def __str__(self):
+        return str(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+def _loaded(value):
+    """The object behind a _LazyGlobal, loading it if needed"""
+    return value._load() if isinstance(value, _LazyGlobal) else value
+
+
+def _file_stamp(filename):
+    """(mtime, size) of a config file, None if missing"""
+    try:
+        stat = os.stat(os.path.join(_config_file_dir, filename))
+        return stat.st_mtime, stat.st_size
+    except OSError:
+        return None
+
+
+def _config_mtimes():
+    """(mtime, size) of each config file, to tell when it has changed"""
+    filenames = [conf['filename'] for conf in config_files.values()]
+    return dict((filename, _file_stamp(filename))
+                for filename in filenames + [svg_filename['svg_icons']])
 
+
+def _read_snapshot():
+    """The compiled config snapshot, read from file at most once"""
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = {'format': _SNAPSHOT_FORMAT, 'tables': {}}
+        try:
+            with open(_config_snapshot_file, 'rb') as f:
+                snapshot = marshal.load(f)
+            if snapshot.get('format') == _SNAPSHOT_FORMAT:
+                _snapshot = snapshot
+        except (IOError, EOFError, ValueError, TypeError, AttributeError):
+            pass  # Missing or unreadable: tables are read from .csv
+    return _snapshot
+
+
+def _save_snapshot():
+    """Write the compiled snapshot, if some table was read from .csv"""
+    global _snapshot_changed
+    if not _snapshot_changed:
+        return
+    temp_file = "%s.%s" % (_config_snapshot_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as f:
+            marshal.dump(_snapshot, f)
+        os.rename(temp_file, _config_snapshot_file)
+    except (IOError, OSError):
+        pass  # E.g. a read-only installation: do without the snapshot
+    _snapshot_changed = False
+
+
+@lib.timed("config")
+def _compiled(name, filenames, build, dump=None, restore=None):
+    """
+    Config table from the compiled snapshot if none of its files has
+    changed since, otherwise from build(), which reads the .csv files
+    :param dump: value -> plain data that marshal can save
+    :param restore: plain data -> value (dump and restore default to
+    the value itself)
+    """
+    global _snapshot_changed
+    key = [_file_stamp(filename) for filename in filenames]
+    tables = _read_snapshot()['tables']
+    if name in tables and tables[name][0] == key:
+        data = marshal.loads(tables[name][1])
+        return data if restore is None else restore(data)
+    value = build()
+    data = value if dump is None else dump(value)
+    tables[name] = (key, marshal.dumps(data))
+    _snapshot_changed = True
+    return value
+
+
+def _read_table(name, class_=lib.Config, enumerate_rows=False):
+    conf = config_files[name]
+    return _compiled(
+        name, [conf['filename']],
+        lambda: class_(enumerate_rows=enumerate_rows, **conf),
+        lambda table: table.snapshot(),
+        lambda rows: class_(enumerate_rows=enumerate_rows, rows=rows,
+                            **conf))
+
+
+def _read_areas():
+    def build():
+        filename = os.path.join(_config_file_dir,
+                                config_files['Area']['filename'])
+        areas = {}
+        with open(filename) as csvfile:
+            for i, row in enumerate(csvfile):
+                row = row.strip()
+                area = row.split(",")[0]
+                comment_or_empty = (area + " ")[0] in ["#", " "]
+                if not comment_or_empty:
+                    areas[area] = {'order': i, 'sub_areas': []}
+                    for j, sub_area in enumerate(row.split(",")[1:]):
+                        order = i * 100 + j
+                        areas[sub_area] = {'area': area, 'order_area': i,
+                                           'order_sub_area': order}
+        return areas
+    return _compiled('Area', [config_files['Area']['filename']], build)
+
+
+def _read_places():
+    filename = os.path.join(_config_file_dir, 'ge_places.csv')
+    bugs = []
+
+    def build():
+        bug_count = len(userbug.list)
+        places = Places(filename)
+        bugs.extend(userbug.list[bug_count:])
+        return places
+
+    def restore(data):
+        for bug in data['userbugs']:  # Same complaints as from the .csv
+            userbug.add(bug)
+        return Places(filename, snapshot=data['placemarks'])
+
+    return _compiled(
+        'Places', ['ge_places.csv', config_files['Area']['filename'],
+                   config_files['Placetype']['filename']], build,
+        lambda places: {'placemarks': places.snapshot(), 'userbugs': bugs},
+        restore)
+
+
+def _read_colors():
+    def build():
+        colors = {}
+        for color in lib.Config(**config_files['Colors']):
+            colors[color.color] = color.hex
+        return colors
+    return _compiled('Colors', [config_files['Colors']['filename']], build)
+
+
+def _new_svg():
+    an_svg = kajsvg.SVG(_loaded(_colors))
+    an_svg.icon_file = _svg_icon_file
+    return an_svg
+
+
+def _lazy_config():
+    """Config globals as stand-ins, each read from file on first use"""
+    global _areas, _placetypes, _places, _day_metadata, _time_metadata
+    global _activities, _forced_breaks, _colors, svg
+    _areas = _LazyGlobal('_areas', _read_areas)
+    _placetypes = _LazyGlobal('_placetypes', lambda: _read_table(
+        'Placetype', Placetypes))
+    _places = _LazyGlobal('_places', _read_places)
+    _day_metadata = _LazyGlobal('_day_metadata', lambda: _read_table(
+        'Day_metadata'))
+    _time_metadata = _LazyGlobal('_time_metadata', lambda: _read_table(
+        'Time_metadata', enumerate_rows=True))
+    _activities = _LazyGlobal('_activities', lambda: _read_table(
+        'Activity'))
+    _forced_breaks = _LazyGlobal('_forced_breaks', lambda: _read_table(
+        'Forced_break'))
+    _colors = _LazyGlobal('_colors', _read_colors)
+    svg = _LazyGlobal('svg', _new_svg)
+
+
+def _load_config():
+    """Read all config files now, as a long-running server wants them"""
+    global _loaded_config_mtimes
+    mtimes = _config_mtimes()
+    _lazy_config()
+    _load_lazy_config()
+    _loaded_config_mtimes = mtimes
+
+
+def _load_lazy_config():
+    """
+    Read the config globals not read yet, such as before forking. Those
+    set by a command, such as _places by a Places row, stay as they are.
+    """
+    for name in ['_areas', '_placetypes', '_places', '_day_metadata',
+                 '_time_metadata', '_activities', '_forced_breaks',
+                 '_colors', 'svg']:
+        _loaded(globals()[name])
+    if os.path.isfile(_svg_icon_file):
+        kajsvg.load_sprite(_svg_icon_file)
+    _save_snapshot()
+
+
+def _reload_config_if_changed():
+    """For long-running processes: read config again if files changed"""
+    changed = _config_mtimes() != _loaded_config_mtimes
+    if changed:
+        _load_config()
+    return changed
+
+
+_svg_icon_file = os.path.join(_config_file_dir, svg_filename['svg_icons'])
+_config_snapshot_file = os.path.join(_py_dir, 'config_snapshot.marshal')
+_SNAPSHOT_FORMAT = (1, marshal.version, sys.version_info[0])
+_snapshot = None  # See _compiled
+_snapshot_changed = False
+_loaded_config_mtimes = {}
+_lazy_config()
+
+_main_pid = os.getpid()
+_batch = None  # Batch being run, for _run_batch_group
+_decimate = None  # (metres, seconds) from -decimate, see Track._decimate
+_budget_mb = None  # From -budget, see Track._analyse_in_chunks
+_split = None  # "day" or hours, from -split, see Track._find_segments_by_day
+_day_track = None  # Track being split, for _find_day_segments
+_instrument = {'stats': None, 'memory': False,  # See Command.instrumented
+               'profile': False,
+               'dir_': os.path.join(_py_dir, 'log', 'stats')}
+_COUNTED = [  # Hot paths counted while collecting stats, see lib.start_stats
+    (geo, 'distance', "haversine calls", None),
+    (geo, 'distances', "haversine calls",
+     lambda lats, lons: max(len(lats) - 1, 0)),
+    (Places, 'closest_placemark', "closest_placemark calls", None),
+    (Places, 'closest_placemarks', "closest_placemark calls",
+     lambda places, points: len(points)),
+    (Segment, '__init__', "Segment constructions", None)]
 _debug_object = ""
 _current_object = ""
 _log = {}
 _last_text = ""
 
-_invoked_from_outside = len(sys.argv) > 1
-if _invoked_from_outside:
-    Command(sys.argv, invoked_from_outside=True)
-else:
+
+def _instrument_options(argv):
+    """
+    -stats=json (or csv), -memprofile and -profile, see
+    Command.instrumented
+    :return: argv without them
+    """
+    rest = []
+    for arg in argv:
+        if arg.startswith("-stats="):
+            _instrument['stats'] = arg.split("=", 1)[1]
+            if _instrument['stats'] not in ("json", "csv"):
+                raise Exception("%s: -stats=json or -stats=csv" % arg)
+        elif arg == "-memprofile":
+            _instrument['memory'] = True
+        elif arg == "-profile":
+            _instrument['profile'] = True
+        else:
+            rest.append(arg)
+    if _instrument['memory'] and _instrument['stats'] is None:
+        _instrument['stats'] = "json"
+    return rest
+
+
+def _track_options(argv):
+    """
+    -decimate (one point per second), -decimate=metres or
+    -decimate=metres,seconds, see Track._decimate, -budget=MB, see
+    Track._analyse_in_chunks, and -split=day or -split=hours, see
+    Track._find_segments_by_day (not with -budget: chunks are not split)
+    :return: argv without them
+    """
+    global _decimate, _budget_mb, _split
+    rest = []
+    for arg in argv:
+        if arg == "-decimate" or arg.startswith("-decimate="):
+            values = arg.partition("=")[2].split(",") + ["0", "0"]
+            try:
+                _decimate = (float(values[0] or 0), float(values[1] or 0))
+            except ValueError:
+                raise Exception("%s: -decimate=metres,seconds" % arg)
+        elif arg.startswith("-budget="):
+            try:
+                _budget_mb = float(arg.split("=", 1)[1])
+            except ValueError:
+                raise Exception("%s: -budget=MB" % arg)
+        elif arg.startswith("-split="):
+            _split = arg.split("=", 1)[1]
+            if _split != "day":
+                try:
+                    _split = float(_split)
+                except ValueError:
+                    raise Exception("%s: -split=day or -split=hours" % arg)
+        else:
+            rest.append(arg)
+    if _budget_mb is not None and _split is not None:
+        raise Exception("-budget and -split cannot be used together")
+    return rest
+
+
+def main():
+    argv = _track_options(_instrument_options(sys.argv))
+    check = (argv[-1] == "check" and len(argv) > 1)
+    if check:
+        Command("check")
+        print("Exiting (no commands will be executed after 'check')")
+        return
+    invoked_from_outside = len(argv) > 1
+    if invoked_from_outside:
+        Command(argv, invoked_from_outside=True)
+        return
     user_input = lib.Config(enumerate_rows=True,
                             **config_files['Commands'])
     Command(user_input)
+    _save_snapshot()
     if _log != {}:
         print("Ended %s, response time %s" % (
             datetime.datetime.now().strftime("%H:%M:%S"),
@@ -5191,4 +6777,8 @@ else:
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
         filename = os.path.join(log_dir, 'userbugs.txt')
-        lib.save_as(filename, repr(userbug), True)
\ No newline at end of file
+        lib.save_as(filename, repr(userbug), True)
+
+
+if __name__ == '__main__':
+    main()
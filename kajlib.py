@@ -9,11 +9,24 @@ from functools import wraps
 from collections import namedtuple
 
 import datetime
+import time
+import json
 import codecs
 import sys
 import errno
 import os
 import csv
+import gzip
+import gc
+import multiprocessing
+import mmap
+import tempfile
+import array
+import struct
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 import kajfmt as fmt
 import kajhtml
@@ -78,6 +91,282 @@ def logged(func):
     return wrapper
 
 
+_stats = None  # See start_stats
+
+
+def start_stats(counted=(), memory=False):
+    """
+    Collect timing spans (see Span) and counters (see count) from now on
+    :param counted: (owner, attribute, counter, weight) of functions to
+    count the calls of while collecting, weight(*args) if not 1 per call
+    :param memory: spans also measure memory (slower), see memory_kb
+    """
+    global _stats
+    _stats = {'spans': {}, 'order': [], 'path': [], 'counters': {},
+              'originals': [], 'memory': memory, 'start_time': time.time()}
+    for owner, attribute, counter, weight in counted:
+        original = vars(owner)[attribute]
+        _stats['originals'].append((owner, attribute, original))
+        setattr(owner, attribute, _counting(original, counter, weight))
+
+
+def _counting(func, counter, weight):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        count(counter, 1 if weight is None else weight(*args))
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def stop_stats():
+    """
+    :return: {'seconds': s, 'spans': [{'span': "a/b", 'depth': 2,
+    'calls': n, 'seconds': s}], 'counters': {name: n}}, or None if
+    start_stats was not called. With memory, each span also has
+    retained_kb, peak_kb, peak_raised_kb and top_objects (see Span).
+    """
+    global _stats
+    stats, _stats = _stats, None
+    if stats is None:
+        return None
+    for owner, attribute, original in reversed(stats['originals']):
+        setattr(owner, attribute, original)
+    spans = [stats['spans'][path] for path in stats['order']]
+    for span in spans:
+        if 'objects' in span:
+            growing = [(n, name) for name, n in span.pop('objects').items()
+                       if n > 0]
+            span['top_objects'] = [[name, n] for n, name
+                                   in sorted(growing, reverse=True)[:5]]
+    return {'seconds': time.time() - stats['start_time'],
+            'spans': spans, 'counters': stats['counters']}
+
+
+def memory_kb():
+    """
+    (resident memory of this process now, highest resident memory of
+    this process so far), in kB, None where the platform does not tell
+    """
+    rss_kb = None
+    peak_kb = None
+    if resource is not None:
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak_kb //= 1024  # In bytes, not kB
+        try:
+            with open("/proc/self/statm") as f:  # Linux: size resident ...
+                pages = int(f.read().split()[1])
+            rss_kb = pages * resource.getpagesize() // 1024
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+    return rss_kb, peak_kb
+
+
+def object_counts():
+    """Objects tracked by the garbage collector, by type name"""
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def _memory_state():
+    gc.collect()
+    return memory_kb() + (object_counts(),)
+
+
+def count(counter, n=1):
+    """Add n to counter, if collecting (see start_stats)"""
+    if _stats is not None:
+        counters = _stats['counters']
+        counters[counter] = counters.get(counter, 0) + n
+
+
+class Span(object):
+    """
+    Timed part of the work, nested in the spans open when entered:
+    with Span("import"): ... Repeated spans add up their calls and seconds.
+    If measuring memory (see start_stats), after a garbage collection:
+    retained_kb = resident memory after - before, summed over the calls
+    peak_kb = highest resident memory of the process at the end of a call
+    peak_raised_kb = how much the calls raised the highest resident memory
+    objects = growth in the count of objects, by type
+    """
+    def __init__(self, name):
+        self.name = name
+        self.stats = None
+        self.started = None
+        self.memory = None
+
+    def __enter__(self):
+        self.stats = _stats
+        if self.stats is not None:
+            stack = self.stats['path']
+            stack.append(self.name)
+            path = "/".join(stack)
+            if path not in self.stats['spans']:
+                self.stats['spans'][path] = {
+                    'span': path, 'depth': len(stack),
+                    'calls': 0, 'seconds': 0.0}
+                if self.stats['memory']:
+                    self.stats['spans'][path].update(
+                        retained_kb=0, peak_kb=0, peak_raised_kb=0,
+                        objects={})
+                self.stats['order'].append(path)
+            if self.stats['memory']:
+                self.memory = _memory_state()
+            self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.stats is None:
+            return False
+        seconds = time.time() - self.started
+        stack = self.stats['path']
+        span = self.stats['spans']["/".join(stack)]
+        stack.pop()
+        span['calls'] += 1
+        span['seconds'] += seconds
+        if self.memory is not None:
+            self._add_memory(span)
+        return False
+
+    def _add_memory(self, span):
+        rss_before, peak_before, objects_before = self.memory
+        rss_after, peak_after, objects_after = _memory_state()
+        if rss_after is not None:
+            span['retained_kb'] += rss_after - rss_before
+        if peak_after is not None:
+            span['peak_kb'] = max(span['peak_kb'], peak_after)
+            span['peak_raised_kb'] += peak_after - peak_before
+        objects = span['objects']
+        for name, n in objects_after.items():
+            growth = n - objects_before.get(name, 0)
+            if growth != 0:
+                objects[name] = objects.get(name, 0) + growth
+
+
+def timed(name):
+    """Decorator: each call is a Span(name)"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _stats is None:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats_report(stats, fmt_="json", **headers):
+    """stop_stats() result as JSON or CSV, headers such as row=3 first"""
+    if fmt_ == "csv":
+        lines = ["type,name,depth,calls,seconds,"
+                 "retained_kb,peak_kb,peak_raised_kb,top_objects"]
+        for key in sorted(headers):
+            value = str(headers[key])
+            if "," in value or '"' in value:
+                value = '"%s"' % value.replace('"', '""')
+            lines.append("header,%s,,,%s" % (key, value))
+        lines.append("total,,,,%.6f" % stats['seconds'])
+        for span in stats['spans']:
+            line = "span,%s,%s,%s,%.6f" % (
+                span['span'], span['depth'], span['calls'], span['seconds'])
+            if 'top_objects' in span:
+                line += ",%s,%s,%s,%s" % (
+                    span['retained_kb'], span['peak_kb'],
+                    span['peak_raised_kb'],
+                    " ".join("%s:%+d" % (name, n)
+                             for name, n in span['top_objects']))
+            lines.append(line)
+        for counter in sorted(stats['counters']):
+            lines.append("counter,%s,,%s," % (counter,
+                                              stats['counters'][counter]))
+        return "\n".join(lines) + "\n"
+    report = dict(headers)
+    report.update(stats)
+    return json.dumps(report, indent=1, sort_keys=True,
+                      separators=(",", ": ")) + "\n"
+
+
+class Progress(object):
+    """
+    Work known up front, as files (or rows) and bytes, shown on one line
+    updated in place: done, points/s, MB/s and the remaining time (ETA).
+    shared=True: processes forked later (Pool) add to the same counts,
+    shown by the process calling show(). Every INTERVAL_S at most; as
+    separate lines every LOG_INTERVAL_S if not on a terminal.
+    """
+    silent = False  # Server level: stdout is the output
+    INTERVAL_S = 0.5
+    LOG_INTERVAL_S = 10
+
+    def __init__(self, text, total_files, total_bytes=0, shared=False):
+        self.text = text
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.stream = sys.stdout
+        self.in_place = self.stream.isatty()
+        self.started = time.time()
+        self.shown = self.started
+        self.shown_chars = 0
+        # files, bytes and points done
+        self.counts = (multiprocessing.Array('d', 3) if shared else
+                       [0.0, 0.0, 0.0])
+
+    def __str__(self):
+        files, n_bytes, points = self.counts[:]
+        seconds = max(time.time() - self.started, 0.001)
+        s = "%s %d/%d" % (self.text, files, self.total_files)
+        if self.total_bytes > 0:
+            s += " %s MB/s" % fmt.onedecimal(n_bytes / 1e6 / seconds)
+        if points > 0:
+            s += " %s points/s" % i1000(int(points / seconds))
+        share = (n_bytes / self.total_bytes if self.total_bytes > 0 else
+                 files / float(self.total_files) if self.total_files > 0
+                 else 1.0)
+        if 0 < share < 1:
+            s += " %d%% ETA %s" % (100 * share, fmt.sec_as_hms(
+                int(seconds * (1 - share) / share)))
+        else:
+            s += " in %s" % fmt.sec_as_hms(int(seconds))
+        return s
+
+    def add(self, files=1, n_bytes=0, points=0):
+        """Work done, shown unless shared (see show)"""
+        if hasattr(self.counts, 'get_lock'):
+            with self.counts.get_lock():
+                self._add(files, n_bytes, points)
+            return
+        self._add(files, n_bytes, points)
+        self.show()
+
+    def _add(self, files, n_bytes, points):
+        self.counts[0] += files
+        self.counts[1] += n_bytes
+        self.counts[2] += points
+
+    def show(self, final=False):
+        now = time.time()
+        interval_s = self.INTERVAL_S if self.in_place else self.LOG_INTERVAL_S
+        if Progress.silent or (now - self.shown < interval_s and not final):
+            return
+        self.shown = now
+        line = str(self)
+        if self.in_place:
+            self.stream.write("\r" + line.ljust(self.shown_chars) +
+                              ("\n" if final else ""))
+            self.shown_chars = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def done(self):
+        self.show(final=True)
+
+
 def rgb2aabbggrr(rgb_str):  # colour conversion for KML
     return "ff" + rgb_str[4:6] + rgb_str[2:4] + rgb_str[0:2]
 
@@ -109,12 +398,23 @@ def ensure_dir(dir_name):
             raise
 
 
+@timed("write")
 def save_as(filename, a_str, verbose=False):
     a_unicode = a_str
     if sys.version_info < (3,):
         if type(a_str) is str:
             a_unicode = unicode(a_str, "utf-8")
 
+    if filename.endswith(".svgz"):  # Gzipped SVG
+        f = gzip.open(filename, "wb")
+        try:
+            val = f.write(a_unicode.encode("utf8"))
+        finally:
+            f.close()
+        if verbose:
+            chars = i1000((len(a_str)))
+            print("%s chars saved gzipped into file %s" % (chars, filename))
+        return val
     with codecs.open(filename, "w", "utf8") as f:
         val = f.write(a_unicode)
         if verbose:
@@ -123,6 +423,169 @@ def save_as(filename, a_str, verbose=False):
     return val
 
 
+class StreamInput(object):
+    """
+    One input read from a stream that can be read only once, such as
+    sys.stdin, used in place of an open file. The lines read before
+    rewind() are kept, to be read again from the start, as Track does
+    after skimming the first trackpoint. After rewind() the lines pass
+    straight through, so memory stays bounded without a temp file.
+    """
+
+    def __init__(self, lines, name="stdin"):
+        self.lines = iter(lines)
+        self.name = name
+        self.kept = []
+        self.keeping = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False  # The stream is not ours to close
+
+    def __iter__(self):
+        for line in list(self.kept):
+            yield line
+        for line in self.lines:
+            if self.keeping:
+                self.kept.append(line)
+            yield line
+
+    def rewind(self):
+        """Read the last time from the start: stop keeping lines"""
+        self.keeping = False
+
+    def read(self):
+        return "".join(self)
+
+    def close(self):
+        pass
+
+
+_DOCUMENT_ENDS = {'gpx': '</gpx>', 'kml': '</kml>'}
+
+
+def split_documents(lines, file_format):
+    """
+    StreamInputs of the documents of file_format concatenated in lines,
+    such as sys.stdin. gpx and kml documents end with their root end
+    tag; csv (and Columbus CSV) documents start with a header line. A
+    document must be read before the next one is requested.
+    """
+    lines = iter(lines)
+    pending = []  # First line of the next document, if already read
+    count = 0
+
+    def document():
+        end_tag = _DOCUMENT_ENDS.get(file_format.lower())
+        has_data = False
+        for line in _chain(pending, lines):
+            if end_tag is None and file_format.lower() == 'csv':
+                is_header = not line[:1].isdigit()
+                if is_header and has_data:
+                    pending.append(line)
+                    return
+                has_data = has_data or not is_header
+            yield line
+            if end_tag is not None and end_tag in line:
+                return
+
+    while True:
+        for line in _chain(pending, lines):
+            if line.strip() != "":
+                pending.append(line)
+                break
+        if not pending:
+            return
+        count += 1
+        stream = StreamInput(document(), "stdin-%s" % count)
+        yield stream
+        for _ in stream.lines:  # Skip what was left unread
+            pass
+
+
+def _chain(pending, lines):
+    """pending (emptied on the way), then lines"""
+    while pending:
+        yield pending.pop(0)
+    for line in lines:
+        yield line
+
+
+class ColumnSpill(object):
+    """
+    Rows of floats kept in a temporary file instead of memory, and read
+    back through mmap a window at a time. Appending comes first, then
+    reading, when the file is mapped.
+    """
+    BUFFER_ROWS = 4096  # Written to the file in batches of rows
+
+    def __init__(self, columns, dir_=None):
+        self.columns = tuple(columns)
+        self.row_bytes = struct.calcsize("%dd" % len(self.columns))
+        self.file = tempfile.TemporaryFile(prefix="spill", dir=dir_)
+        self.buffer = array.array('d')
+        self.count = 0
+        self.mapped = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        if self.mapped is not None:
+            raise Exception("ColumnSpill: append after reading")
+        self.buffer.extend(row)
+        self.count += 1
+        if len(self.buffer) >= self.BUFFER_ROWS * len(self.columns):
+            self._flush()
+
+    def _flush(self):
+        self.file.write(self.buffer.tostring())
+        self.buffer = array.array('d')
+
+    def _map(self):
+        if self.mapped is None:
+            self._flush()
+            self.file.flush()
+            self.mapped = (mmap.mmap(self.file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+                           if self.count > 0 else "")
+
+    def rows(self, first=0, stop=None):
+        """Rows first...stop - 1 as tuples"""
+        self._map()
+        stop = self.count if stop is None else min(stop, self.count)
+        values = array.array('d')
+        values.fromstring(self.mapped[first * self.row_bytes:
+                                      stop * self.row_bytes])
+        width = len(self.columns)
+        return [tuple(values[i:i + width])
+                for i in range(0, len(values), width)]
+
+    def value(self, i, column):
+        self._map()
+        offset = i * self.row_bytes + 8 * self.columns.index(column)
+        return struct.unpack_from("d", self.mapped, offset)[0]
+
+    def bisect(self, column, value):
+        """First row with column >= value, the column ascending"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.value(middle, column) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def close(self):
+        if self.mapped:
+            self.mapped.close()
+        self.mapped = None
+        self.file.close()
+
+
 def append_to_hh_mm_ss(a_time_str):
     if a_time_str.count(":") < 1:
         return a_time_str + ":00:00"
@@ -172,7 +635,7 @@ def csv_header_instructions(count, item, filename):
 
 class Config(object):
     def __init__(self, item, fields, filename, enumerate_rows=False,
-                 dir_=None):
+                 dir_=None, rows=None):
         full_filename = os.path.join(dir_, filename)
         self.item = item
         self.fields = fields
@@ -193,6 +656,9 @@ class Config(object):
         self.index_field_name = self.field_list[0]
         self.field_count = len(self.field_list)
 
+        if rows is not None:  # As returned by snapshot(), no file read
+            self.restore(rows)
+            return
         if not os.path.exists(self.filename):
             e = "Config %s missing file %s" % (item, full_filename)
             raise Exception(e)
@@ -310,6 +776,17 @@ class Config(object):
                     self.list.append(index_field)
                     self.dict[index_field] = r
 
+    def snapshot(self):
+        """Rows as plain tuples, to be saved with marshal, see restore"""
+        return [tuple(self.dict[index_field]) for index_field in self.list]
+
+    def restore(self, rows):
+        named_t = namedtuple(self.item, self.fields)
+        for row in rows:
+            r = named_t._make(row)
+            self.list.append(r[0])
+            self.dict[r[0]] = r
+
     def missing_fields(self):
         count = 0
         msg = []
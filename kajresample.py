@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: latin-1 -*-
+
+"""
+Resampling and smoothing of tracks as columns (lists of floats)
+"""
+
+from bisect import bisect_left
+
+import kajgeo as geo
+
+
+def cumulative(values):
+    """[1, 2, 3] -> [1, 3, 6]"""
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+
+def cumulative_distances(lats, lons):
+    """km along the path from the first point, one item per point"""
+    return cumulative(geo.distances(lats, lons))
+
+
+def ticks(xs, step):
+    """step, 2 * step ... up to xs[-1]; xs non-decreasing, from xs[0]"""
+    if len(xs) == 0 or step <= 0:
+        return []
+    count = int((xs[-1] - xs[0]) / step)
+    return [xs[0] + tick * step for tick in range(1, count + 1)]
+
+
+def interpolate(xs, columns, new_xs):
+    """
+    Columns (lists parallel to xs) linearly interpolated at new_xs
+    :param xs: non-decreasing, such as cumulative km or seconds
+    :param new_xs: non-decreasing, within xs[0]..xs[-1]
+    :return: list of new columns, parallel to new_xs
+    """
+    new_columns = [[] for _ in columns]
+    last = len(xs) - 1
+    i = 1
+    for x in new_xs:
+        i = min(max(bisect_left(xs, x, i), 1), last)
+        x1 = xs[i - 1]
+        x2 = xs[i]
+        share = (x - x1) / float(x2 - x1) if x2 != x1 else 0.0
+        for column, new_column in zip(columns, new_columns):
+            y1 = column[i - 1]
+            new_column.append(y1 + share * (column[i] - y1))
+    return new_columns
+
+
+def resample(xs, columns, step):
+    """
+    Equidistant points every step of xs, such as every 0.1 km of
+    cumulative_distances (equidistant in distance) or every 10 s of
+    seconds (equidistant in time)
+    :return: new_xs, list of new columns
+    """
+    new_xs = ticks(xs, step)
+    return new_xs, interpolate(xs, columns, new_xs)
+
+
+def moving_average(values, window_points=21):
+    """
+    Centered average over window_points (odd) values, in O(n) using
+    prefix sums. Near the ends the window shrinks symmetrically, so the
+    first and last values are kept as they are.
+    """
+    count = len(values)
+    half = (window_points - 1) // 2
+    prefix = [0.0] + cumulative(values)
+    result = []
+    for i in range(count):
+        reach = min(half, i, count - 1 - i)
+        first = i - reach
+        after_last = i + reach + 1
+        result.append((prefix[after_last] - prefix[first]) /
+                      (after_last - first))
+    return result
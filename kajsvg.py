@@ -6,6 +6,7 @@ Geodata analysis of tracks; management of placemarks
 """
 
 import os.path
+import re
 from time import strftime
 
 import kajfmt as fmt
@@ -21,6 +22,10 @@ def merge(dir_, svg_files, filename, prominence=9):
     """
     dir_ = os.path.abspath(dir_)  # should there be a ~/ home reference
 
+    if merged_is_up_to_date(dir_, svg_files, filename):
+        print("merge: %s is up to date" % filename)
+        return
+
     defs = ""
     use = ""
     icons = []
@@ -98,6 +103,70 @@ def merge(dir_, svg_files, filename, prominence=9):
     lib.save_as(demo_filename, contents, True)
 
 
+def merged_is_up_to_date(dir_, svg_files, filename):
+    """True if filename is newer than all svg_files and has the same icons"""
+    if not os.path.isfile(filename):
+        return False
+    merged_mtime = os.path.getmtime(filename)
+    for svg_file in svg_files:
+        svg_input_file = os.path.join(dir_, svg_file)
+        if not os.path.isfile(svg_input_file):
+            return False  # merge() reports it
+        if os.path.getmtime(svg_input_file) > merged_mtime:
+            return False
+    icon_ids = set([svg_file.replace(".svg", "") for svg_file in svg_files])
+    return set(load_sprite(filename)) == icon_ids
+
+
+_sprites = {}  # filename: (mtime, {icon_id: '<g id=...>...</g>'})
+
+_G_TAG = re.compile(r'<g(?:\s[^>]*)?>|</g\s*>')
+_ID_ATTRIBUTE = re.compile(r'\sid="([^"]*)"')
+
+
+def load_sprite(filename):
+    """
+    Icons of a sprite file, as written by merge(), as a dict of icon id
+    and <g> element. Parsed once per process; read again only if the
+    file's mtime has changed.
+    """
+    if not os.path.isfile(filename):
+        return {}
+    mtime = os.path.getmtime(filename)
+    cached = _sprites.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(filename) as f:
+            cached = (mtime, parse_sprite(f.read()))
+        _sprites[filename] = cached
+    return cached[1]
+
+
+def parse_sprite(text):
+    """Top level <g id="..."> elements of text as {icon_id: element}"""
+    icons = {}
+    depth = 0
+    icon_id = None
+    start = 0
+    for match in _G_TAG.finditer(text):
+        tag = match.group(0)
+        if tag.startswith("</"):
+            depth -= 1
+            if depth == 0 and icon_id is not None:
+                icons[icon_id] = text[start:match.end()]
+                icon_id = None
+        elif tag.endswith("/>"):
+            id_match = _ID_ATTRIBUTE.search(tag)
+            if depth == 0 and id_match:
+                icons[id_match.group(1)] = tag
+        else:
+            if depth == 0:
+                id_match = _ID_ATTRIBUTE.search(tag)
+                icon_id = id_match.group(1) if id_match else None
+                start = match.start()
+            depth += 1
+    return icons
+
+
 class SVG(object):
     """Output class for SVG"""
 
@@ -109,12 +178,19 @@ class SVG(object):
         self.colors = colors
         self.map = None
         self.pixels = None
-        self.last_within = False
-        self.mid_points = []
+        self.markers = []
+        self.min_vertex_mm = MIN_VERTEX_MM
+        self.compact = False  # <path> with relative moves, style classes
+        self.precision = 2  # Decimals of mm in compact paths
+        self.style_classes = {}
+        self.icon_file = ""  # Sprite as written by merge()
+        self.used_icons = set()
 
         self.set_canvas()
 
     def doc_header(self, more_defs=""):
+        self.style_classes = {}
+        self.used_icons = set()
         height = self.canvas['mm']['height']
         width = self.canvas['mm']['width']
         return """\
@@ -144,9 +220,41 @@ class SVG(object):
  </defs>\n""" % (width, height, width, height, self.title, self.desc,
                  fmt.current_timestamp(), more_defs)
 
-    @staticmethod
-    def doc_footer(comment=""):
-        return "%s\n</svg>" % comment
+    def doc_footer(self, comment=""):
+        return "%s%s%s\n</svg>" % (self.style_class_defs(), self.icon_defs(),
+                                   comment)
+
+    def use_icon(self, icon):
+        """Icon id for xlink:href, noted for icon_defs"""
+        self.used_icons.add(icon)
+        return icon
+
+    def icon_defs(self):
+        """<defs> with the sprite icons used since doc_header"""
+        sprite = load_sprite(self.icon_file) if self.icon_file else {}
+        icons = [sprite[icon] for icon in sorted(self.used_icons)
+                 if icon in sprite]
+        if not icons:
+            return ""
+        return " <defs>\n  %s\n </defs>\n" % "\n  ".join(icons)
+
+    def style_class(self, style_dict):
+        """Name of a shared CSS class for style_dict, created if needed"""
+        css = self.css(style_dict)
+        if css not in self.style_classes:
+            self.style_classes[css] = "s%d" % len(self.style_classes)
+        return self.style_classes[css]
+
+    def style_class_defs(self):
+        """<style> with the classes given out by style_class()"""
+        if not self.style_classes:
+            return ""
+        rows = sorted([(int(name[1:]), name, css)
+                       for css, name in self.style_classes.items()])
+        s = ' <style type="text/css"><![CDATA[\n'
+        for _, name, css in rows:
+            s += "    .%s { fill: none; %s}\n" % (name, css)
+        return s + "    ]]></style>\n"
 
     @staticmethod
     def comment(text):
@@ -197,11 +305,13 @@ class SVG(object):
                 trbl['aspect_ratio'] = float(trbl['height']) / trbl['width']
                 self.canvas[frame][unit] = trbl
 
-    def empty_canvas(self):
+    def empty_canvas(self, resolution=1):
+        # resolution = occupancy grid cells per mm (see class Pixels)
         self.pixels = Pixels(self.canvas['mm']['width'],
-                             self.canvas['mm']['height'])
+                             self.canvas['mm']['height'], resolution)
         self.icon_pixels = Pixels(self.canvas['mm']['width'],
-                             self.canvas['mm']['height'])
+                             self.canvas['mm']['height'], resolution)
+        self.markers = []
 
     def set_title(self, title, desc):
         self.title = title
@@ -211,6 +321,10 @@ class SVG(object):
         pass
 
     def style(self, style_dict):
+        s = self.css(style_dict)
+        return ' style="%s"' % s if s != "" else ""
+
+    def css(self, style_dict):
         if style_dict is None:
             return ""
         s = ""
@@ -220,10 +334,10 @@ class SVG(object):
                 value = lib.app_color(self.colors, value)
             if value is not None:
                 s += "%s: %s; " % (property_, value)
-        return ' style="%s"' % s if s != "" else ""
+        return s
 
     def plot_text_mm(self, x, y, text, style_dict=None, class_=None,
-                     angle=0.0, dy=0.0):
+                     angle=0.0, dy=0.0, force=False):
         class_ = "" if class_ is None else ' class="%s"' % class_
         transform = ("" if angle == 0 else
                      ' transform="rotate(%s %s %s)"' % (angle, x, y))
@@ -240,7 +354,7 @@ class SVG(object):
         x2 = x + x2_factor * length * font_size / 2
         y2 = y + 1
         #print "set-pixels x1-x2 %s-%s y1-y2 %s-%s" % (x1, x2, y1, y2)
-        if self.pixels is None:
+        if self.pixels is None or force:
             is_free = True
         else:
             is_free = self.pixels.rectangle_is_empty(x1, y1, x2, y2)
@@ -252,9 +366,10 @@ class SVG(object):
         return s % (fmt.mm2(x), fmt.mm2(y), self.style(style_dict),
                     class_, transform, text)
 
-    def plot_icon_mm(self, cx, cy, r=2.5, icon="circle", color="Red"):
+    def plot_icon_mm(self, cx, cy, r=2.5, icon="circle", color="Red",
+                     force=False):
         x1, y1, x2, y2 = cx - r, cy - r, cx + r, cy + r
-        if self.pixels is None:
+        if self.pixels is None or force:
             is_free = True
         else:
             is_free = self.pixels.rectangle_is_empty(x1, y1, x2, y2)
@@ -272,7 +387,57 @@ class SVG(object):
             s = '<use xlink:href="#%s" x="%s" y="%s" style="fill:%s;" %s/>\n'
             s = '<use xlink:href="#{}" transform="translate({:.1f},{:.1f}) '
             s += 'scale({:.1f})" style="fill:{};" />\n'
-            return s.format(icon, cx - r, cy - r, scale, color)
+            return s.format(self.use_icon(icon), cx - r, cy - r, scale,
+                            color)
+
+    def queue_marker_mm(self, priority, x, y, text, style_dict=None,
+                        angle=0, radius=2.5, icon="circle", color="Red",
+                        use_frame=False, force_write=False):
+        """Collect a marker; plot_queued_markers() places them all"""
+        self.markers.append({'priority': priority, 'x': x, 'y': y,
+                             'text': text, 'style_dict': style_dict,
+                             'angle': angle, 'radius': radius, 'icon': icon,
+                             'color': color, 'use_frame': use_frame,
+                             'force_write': force_write})
+
+    def plot_queued_markers(self):
+        """Place queued markers, most prominent (lowest priority) first"""
+        markers = self.markers
+        self.markers = []
+        markers.sort(key=lambda marker: marker['priority'])  # Stable sort
+        s = ""
+        for marker in markers:
+            marker.pop('priority')
+            s += self.plot_marker_mm(**marker)
+        return s
+
+    def plot_marker_mm(self, x, y, text, style_dict=None, angle=0,
+                       radius=2.5, icon="circle", color="Red",
+                       use_frame=False, force_write=False):
+        """Icon at (x, y), text at the first free of LABEL_ANCHORS"""
+        if use_frame:
+            return self.plot_framed_sign_mm(x, y, text)
+        style_dict = {} if style_dict is None else style_dict
+        font_size = style_dict.get('font-size', 3)
+        s = self.plot_icon_mm(x, y, r=radius, icon=icon, color=color,
+                              force=force_write)
+        for dx, dy, text_anchor in LABEL_ANCHORS:
+            x_text = x + dx[0] * radius + dx[1] * font_size
+            y_text = y + dy[0] * radius + dy[1] * font_size
+            style = dict(style_dict)
+            if text_anchor != 'left':
+                style['text-anchor'] = text_anchor
+            s_text = self.plot_text_mm(x_text, y_text, text, style,
+                                       angle=angle)
+            if s_text != "":
+                return s + s_text
+        if force_write:  # Nothing free around the icon: overwrite
+            dx, dy, text_anchor = LABEL_ANCHORS[0]
+            x_text = x + dx[0] * radius + dx[1] * font_size
+            y_text = y + dy[0] * radius + dy[1] * font_size
+            s += self.plot_text_mm(x_text, y_text, text, style_dict,
+                                   angle=angle, force=True)
+        return s
 
     def plot_line_mm(self, x1, y1, x2, y2, style_dict=None):
         line = ' <line x1="%s" y1="%s" x2="%s" y2="%s" %s/>\n'
@@ -319,117 +484,92 @@ class SVG(object):
         s += 'stroke="white" stroke-width="0.0" />\n'
         return (s % (cx, cy, r, FI_BLUE))
 
-    def polyline_begin(self, style_dict=None, class_="", marker=""):
-        self.last_within = False
-        self.is_first = True
-        self.canvas['polyline'] = {'style': self.style(style_dict),
-                                   'marker': marker,
-                                   'class_': class_, 'points': []}
-
-    def polyline_add_point(self, x, y):
-        border = self.canvas['inner']['mm']
-        just_went_outside = False
-        within = (border['left'] < x < border['right'] and
-                  border['bottom'] > y > border['top'])
-        if within:
-            just_came_inside = not self.last_within and not self.is_first
-            if just_came_inside:
-                print "just came inside"
-                x_mid, y_mid = self.mid_point(x, y, self.prev_x, self.prev_y)
-                self.canvas['polyline']['points'].append([x_mid, y_mid])
-                print "xmid %s ymid %s" % (x_mid, y_mid)
-            self.canvas['polyline']['points'].append([x, y])
-        else:
-            just_went_outside = self.last_within
-            if just_went_outside:
-                print "just went outside"
-                x_mid, y_mid = self.mid_point(self.prev_x, self.prev_y, x, y)
-                self.canvas['polyline']['points'].append([x_mid, y_mid])
-                print "xmid %s ymid %s" % (x_mid, y_mid)
-        self.prev_x = x
-        self.prev_y = y
-        self.last_within = within
-        self.is_first = False
-        return just_went_outside
-
-    def mid_point(self, x_in, y_in, x_out, y_out):
-        border = self.canvas['inner']['mm']
-        west_mm = border['left']
-        east_mm = border['right']
-        north_mm = border['top']
-        south_mm = border['bottom']
-        x_border = west_mm if x_out < west_mm else east_mm
-        y_border = north_mm if y_out < north_mm else south_mm
-        x_diff = x_out - x_in
-        y_diff = y_out - y_in
-        x_is_outside = x_out < west_mm or x_out > east_mm
-        y_is_outside = y_out > south_mm or y_out < north_mm
-        if x_is_outside:
-            if y_is_outside:
-                x_mid = x_in + abs((y_border - y_in) / y_diff) * x_diff
-                y_mid = y_in + abs((x_border - x_in) / x_diff) * y_diff
-            else:
-                x_mid = x_border
-                if y_diff == 0:
-                    y_mid = y_in
-                else:
-                    y_mid = y_in + abs((x_border - x_in) / x_diff) * y_diff
-        else:
-            if y_is_outside:
-                y_mid = y_border
-                if x_diff == 0:
-                    x_mid = x_in
-                else:
-                    x_mid = x_in + abs((y_border - y_in) / y_diff) * x_diff
-            else:
-                print("%s, %s isn't outside at all; trivial case" %
-                      (x_out, y_out))
-                x_mid = x_out
-                y_mid = y_out
-
-        mid_dict = {'border': border,
-                    'x': {'border': x_border, 'in': x_in, 'out': x_out,
-                          'diff': x_diff, 'is_outside': x_is_outside},
-                    'y': {'border': y_border, 'in': y_in, 'out': y_out,
-                          'diff': y_diff, 'is_outside': y_is_outside},
-                    'mid': {'x': x_mid, 'y': y_mid},
-                    'is': {'last': self.last_within, 'first': self.is_first}}
-        self.mid_points.append(mid_dict)
-        return x_mid, y_mid
-
-    def list_midpoints(self):
-        for mid_dict in self.mid_points:
-            border = mid_dict['border']
-            x = mid_dict['x']
-            y = mid_dict['y']
-            mid = mid_dict['mid']
-            is_ = mid_dict['is']
-            xy = "in {in:.1f} out {out:.1f} diff {diff:.1f}"
-            x_f = "\nx %s <- " % (fmt.onedecimal(mid['x']))
-            x_f += xy.format(**x)
-            y_f = "\ny %s <- " % (fmt.onedecimal(mid['y']))
-            y_f += xy.format(**y)
-            x_f += " (%s - %s)" % (border['left'], border['right'])
-            y_f += " (%s - %s)" % (border['top'], border['bottom'])
-            print("%s %s %s" % (x_f, y_f, "last {last} first {first}".format(**is_)))
-
-    def plot_polyline(self):
-        polyline = self.canvas['polyline']
-        class_ = ('class="%s"' % polyline['class_']
-                  if polyline['class_'] != "" else '')
-        points = polyline['points']
-        s = (' <polyline %s %s %s points="' % (polyline['style'],
-                                               polyline['marker'], class_))
+    def plot_polyline(self, points, style_dict=None, class_="", marker=""):
+        """One <polyline> of [x, y] points (mm), no clipping"""
+        if self.compact:
+            return self.plot_path([points], style_dict, class_, marker)
+        class_ = 'class="%s"' % class_ if class_ != "" else ''
+        s = (' <polyline %s %s %s points="' % (self.style(style_dict),
+                                               marker, class_))
         if len(points) == 0:
             return self.comment('No points - Empty%s' % s)
         columns = 6
-        for i, point in enumerate(points):
-            if i % columns == 0:
-                s += "\n   "
-            s += "{:.2f},{:.2f} ".format(*point)
-        s += '" />\n'
+        rows = []
+        for i in range(0, len(points), columns):
+            rows.append("".join(["{:.2f},{:.2f} ".format(*point)
+                                 for point in points[i:i + columns]]))
+        return s + "\n   " + "\n   ".join(rows) + '" />\n'
+
+    def plot_polyline_xy(self, xs, ys, style_dict=None, class_="",
+                         marker=""):
+        """Polylines of the parts of xs, ys (mm) within the inner frame"""
+        kept = thin_polyline(xs, ys, self.min_vertex_mm)
+        runs = clip_polyline([xs[i] for i in kept], [ys[i] for i in kept],
+                             self.canvas['inner']['mm'])
+        if self.compact:
+            return self.plot_path(runs, style_dict, class_, marker)
+        return "".join([self.plot_polyline(run, style_dict, class_, marker)
+                        for run in runs])
+
+    def plot_colored_polyline_xy(self, xs, ys, colors, style_dict=None):
+        """As plot_polyline_xy, with colors[i] as stroke from point i-1 to i
+
+        Consecutive lines of the same colour are joined into one polyline.
+        The line to a kept point has its own colour, also over the dropped
+        (too close) points before it; their colours are not drawn.
+        When compact, all lines of one colour become one <path>.
+        """
+        style_dict = {} if style_dict is None else style_dict
+        kept = thin_polyline(xs, ys, self.min_vertex_mm)
+        xs = [xs[i] for i in kept]
+        ys = [ys[i] for i in kept]
+        colors = [colors[i] for i in kept]
+        frame = self.canvas['inner']['mm']
+        s = ""
+        runs_by_color = {}
+        color_order = []
+        count = len(xs)
+        i_start = 0
+        for i in range(1, count):
+            color_changes = i == count - 1 or colors[i + 1] != colors[i]
+            if color_changes:
+                color = colors[i]
+                runs = clip_polyline(xs[i_start:i + 1], ys[i_start:i + 1],
+                                     frame)
+                if self.compact:
+                    if color not in runs_by_color:
+                        runs_by_color[color] = []
+                        color_order.append(color)
+                    runs_by_color[color] += runs
+                else:
+                    style = dict(style_dict)
+                    style['stroke'] = color
+                    s += "".join([self.plot_polyline(run, style)
+                                  for run in runs])
+                i_start = i
+        for color in color_order:
+            style = dict(style_dict)
+            style['stroke'] = color
+            s += self.plot_path(runs_by_color[color], style)
         return s
 
+    def plot_path(self, runs, style_dict=None, class_="", marker=""):
+        """
+        One <path> with a subpath per run of [x, y] points (mm), no
+        clipping. Relative moves, self.precision decimals, and the style
+        as a shared class (see style_class).
+        """
+        runs = [run for run in runs if run]
+        if not runs:
+            return ""
+        classes = [self.style_class(style_dict)]
+        if class_ != "":
+            classes.append(class_)
+        marker = " " + marker if marker != "" else ""
+        d = path_data(runs, self.precision)
+        return ' <path class="%s"%s d="%s" />\n' % (" ".join(classes),
+                                                   marker, d)
+
     def plot_header(self, text, frame, h, v, dx=0, dy=0,
                     class_=None, style_dict=None):
         if style_dict is None:
@@ -497,40 +637,226 @@ class SVG(object):
 
     def draw_pixels(self):
         s = ""
+        cell_mm = 1.0 / self.pixels.resolution
         for x in range(0, self.pixels.x_max):
             for y in range(0, self.pixels.y_max):
-                if self.pixels.matrix[y][x]:
-                    s += self.plot_rect_mm(x, y, 1, 1, {'fill': 'red',
-                                                        'opacity': 0.2})
+                if self.pixels.is_set(x, y):
+                    s += self.plot_rect_mm(x * cell_mm, y * cell_mm,
+                                           cell_mm, cell_mm,
+                                           {'fill': 'red', 'opacity': 0.2})
         return s
 
 
 class Pixels(object):
-    def __init__(self, x_max=300, y_max=300):
-        self.x_max = x_max
-        self.y_max = y_max
-        self.matrix = [[False for x in range(0, x_max)]
-                       for y in range(0, y_max)]
+    """Occupancy grid of the canvas, one bitmask (Python int) per row
+
+    resolution = cells per mm; 1 gives the classic 1 mm x 1 mm grid.
+    A rectangle is checked with one AND per row, i.e. O(height), and
+    stops at the first occupied row.
+    """
+
+    def __init__(self, x_max=300, y_max=300, resolution=1):
+        self.resolution = resolution
+        self.x_max = int(x_max * resolution)
+        self.y_max = int(y_max * resolution)
+        self.rows = [0] * self.y_max
 
     def clean(self, x1, y1, x2, y2):
-        x1 = max(0, int(x1))
-        x2 = min(self.x_max, int(x2))
-        y1 = max(0, int(y1))
-        y2 = min(self.y_max, int(y2))
+        res = self.resolution
+        x1 = max(0, int(x1 * res))
+        x2 = min(self.x_max, int(x2 * res))
+        y1 = max(0, int(y1 * res))
+        y2 = min(self.y_max, int(y2 * res))
         return x1, y1, x2, y2
 
+    @staticmethod
+    def _row_mask(x1, x2):
+        return ((1 << (x2 - x1)) - 1) << x1
+
     def set(self, x1, y1, x2, y2):
         x1, y1, x2, y2 = self.clean(x1, y1, x2, y2)
-        for x in range(x1, x2):
-            for y in range(y1, y2):
-                self.matrix[y][x] = True
+        if x2 <= x1:
+            return
+        mask = self._row_mask(x1, x2)
+        rows = self.rows
+        for y in range(y1, y2):
+            rows[y] |= mask
 
     def rectangle_is_empty(self, x1, y1, x2, y2):
         x1, y1, x2, y2 = self.clean(x1, y1, x2, y2)
-        no_text = True
-        for x in range(x1, x2):
-            for y in range(y1, y2):
-                no_text = no_text and not self.matrix[y][x]
-        return no_text
+        if x2 <= x1:
+            return True
+        mask = self._row_mask(x1, x2)
+        rows = self.rows
+        for y in range(y1, y2):
+            if rows[y] & mask:
+                return False
+        return True
+
+    def is_set(self, x, y):
+        """Cell (not mm) coordinates"""
+        return bool(self.rows[y] >> x & 1)
+
+
+def path_data(runs, precision=2):
+    """
+    SVG path data for runs of [x, y] points: M to the first point of
+    each run, then relative l moves, rounded to precision decimals.
+    Rounding is done on absolute coordinates so errors do not add up.
+    """
+    scale = 10 ** precision
+    parts = []
+    qx0 = qy0 = 0
+    for i_run, run in enumerate(runs):
+        qx = int(round(run[0][0] * scale))
+        qy = int(round(run[0][1] * scale))
+        if i_run == 0:
+            parts.append("M" + _pair(qx, qy, precision))
+        else:
+            parts.append("m" + _pair(qx - qx0, qy - qy0, precision))
+        qx0, qy0 = qx, qy
+        moves = []
+        for x, y in run[1:]:
+            qx = int(round(x * scale))
+            qy = int(round(y * scale))
+            if qx != qx0 or qy != qy0:
+                moves.append(_pair(qx - qx0, qy - qy0, precision))
+                qx0, qy0 = qx, qy
+        if moves:
+            parts.append("l" + _join_numbers(moves))
+        elif len(run) > 1:
+            parts.append("l0 0")  # Zero length, but keep the dot
+    return "".join(parts)
+
+
+def _pair(qx, qy, precision):
+    return _join_numbers([_number(qx, precision), _number(qy, precision)])
+
+
+def _join_numbers(numbers):
+    """Space separated, except before a minus sign which separates anyway"""
+    s = numbers[0]
+    for number in numbers[1:]:
+        s += number if number[0] == "-" else " " + number
+    return s
+
+
+def _number(q, precision):
+    """Integer q of 10^-precision units as shortest decimal: -0.5 -> -.5"""
+    sign = "-" if q < 0 else ""
+    whole, fraction = divmod(abs(q), 10 ** precision)
+    fraction = ("%0*d" % (precision, fraction)).rstrip("0")
+    s = str(whole) if whole else ""
+    s += "." + fraction if fraction else ""
+    return sign + s if s else "0"
+
+
+def thin_polyline(xs, ys, min_mm):
+    """
+    Indexes of the points to keep when points closer than min_mm to the
+    last kept point are dropped. First and last point are always kept.
+    """
+    count = len(xs)
+    if count < 3 or min_mm <= 0:
+        return range(count)
+    min_sq = min_mm * min_mm
+    kept = [0]
+    x0, y0 = xs[0], ys[0]
+    for i in range(1, count - 1):
+        dx = xs[i] - x0
+        dy = ys[i] - y0
+        if dx * dx + dy * dy >= min_sq:
+            kept.append(i)
+            x0, y0 = xs[i], ys[i]
+    kept.append(count - 1)
+    return kept
+
+
+def clip_line(x1, y1, x2, y2, frame):
+    """
+    Liang-Barsky: the part of the line (x1, y1)-(x2, y2) inside frame
+    :param frame: dict with 'left', 'right', 'top' and 'bottom' (mm)
+    :return: (t1, t2) parameters of the visible part, 0 <= t1 <= t2 <= 1,
+     or None if the line is entirely outside the frame
+    """
+    dx = x2 - x1
+    dy = y2 - y1
+    t1 = 0.0
+    t2 = 1.0
+    for p, q in ((-dx, x1 - frame['left']), (dx, frame['right'] - x1),
+                 (-dy, y1 - frame['top']), (dy, frame['bottom'] - y1)):
+        if p == 0:
+            if q < 0:  # Parallel to and outside this border
+                return None
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > t2:
+                return None
+            t1 = max(t1, t)
+        else:
+            if t < t1:
+                return None
+            t2 = min(t2, t)
+    return t1, t2
+
+
+def clip_polyline(xs, ys, frame):
+    """
+    Split a polyline into runs of [x, y] points within frame, cutting
+    lines that cross the frame border exactly at the border
+    """
+    left, right = frame['left'], frame['right']
+    top, bottom = frame['top'], frame['bottom']
+    runs = []
+    run = []
+    count = len(xs)
+    if count == 1:
+        if left <= xs[0] <= right and top <= ys[0] <= bottom:
+            runs.append([[xs[0], ys[0]]])
+        return runs
+    x1, y1 = xs[0], ys[0]
+    inside_1 = left <= x1 <= right and top <= y1 <= bottom
+    for i in range(1, count):
+        x2, y2 = xs[i], ys[i]
+        inside_2 = left <= x2 <= right and top <= y2 <= bottom
+        if inside_1 and inside_2:  # The common case, no clipping needed
+            if not run:
+                run.append([x1, y1])
+            run.append([x2, y2])
+        else:
+            t = clip_line(x1, y1, x2, y2, frame)
+            if t is not None:
+                dx = x2 - x1
+                dy = y2 - y1
+                if not run:
+                    run.append([x1 + t[0] * dx, y1 + t[0] * dy])
+                run.append([x1 + t[1] * dx, y1 + t[1] * dy])
+            if not inside_2 and run:  # Went outside: lift the pen
+                runs.append(run)
+                run = []
+        x1, y1, inside_1 = x2, y2, inside_2
+    if run:
+        runs.append(run)
+    return runs
+
 
 FI_BLUE = '#0091FF'
+
+# Polyline points closer than this to the previous point are not drawn;
+# 0.1 mm is below what a printer or a screen at 100 % zoom resolves
+MIN_VERTEX_MM = 0.1
+
+# Text positions tried around a marker icon, in order of preference:
+# (x offset, y offset, text-anchor), offsets as (radius factor,
+# font size factor). The first entry is the classic "right of the icon".
+LABEL_ANCHORS = [
+    ((1.2, 0), (0, 0.4), 'left'),      # right
+    ((-1.2, 0), (0, 0.4), 'end'),      # left
+    ((0, 0), (-1.2, 0), 'middle'),     # above
+    ((0, 0), (1.2, 1), 'middle'),      # below
+    ((1, 0), (-1, 0), 'left'),         # above right
+    ((1, 0), (1, 0.8), 'left'),        # below right
+    ((-1, 0), (-1, 0), 'end'),         # above left
+    ((-1, 0), (1, 0.8), 'end'),        # below left
+]
@@ -0,0 +1,129 @@
+# -*- coding: latin-1 -*-
+
+"""
+Shared set-up of the tests: a config directory of their own, and
+synthetic tracks from kajbench
+
+Run from the kajgps directory: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import kajbench
+import kajgps
+
+CONFIG = {
+    'ge_activities.csv': """\
+activity_id,order,name,color1,color2,min_speed,alt_slow,max_speed,alt_fast,\
+tick_long,tick_short,time_window_s,window_dist_m,final_hop_m,minimum_break_s
+run,1,Running,ff0000,00ff00,3,walk,25,cycle,1km,0.5km,60s,20m,1m,120s
+walk,2,Walking,00ff00,00ff00,0,walk,8,run,1km,0.5km,60s,20m,1m,120s
+cycle,3,Cycling,0000ff,00ff00,5,walk,50,car,5km,1km,60s,20m,1m,120s
+car,4,Car,888888,00ff00,0,walk,200,fly,10km,1km,60s,20m,1m,120s
+fly,5,Fly,888888,00ff00,0,walk,2000,fly,10km,1km,60s,20m,1m,120s
+lift,6,Lift,888888,00ff00,0,walk,20,car,1km,1km,60s,20m,1m,120s
+downhill,7,Downhill,0000ff,00ff00,0,walk,200,car,1km,1km,60s,20m,1m,120s
+snowboard,8,Snowboard,0000ff,00ff00,0,walk,200,car,1km,1km,60s,20m,1m,120s
+""",
+    'ge_areas.csv': "# area,sub_areas\nFinland,Nagu,Turku\n",
+    'ge_colors.csv': """\
+color,ge_color,pass_1,hex,pass_2,r,g,b,pass_3,c,m,y,k
+Green,Green,,#668d3c,,,,,,,,,
+Red,Red,,#cf3a27,,,,,,,,,
+""",
+    'ge_day_metadata.csv':
+        "date,activity_id,timezone,name,distance,comment\n",
+    'ge_time_metadata.csv': "date,time,activity_id\n",
+    'ge_forced_breaks.csv':
+        "text,lat,lon,from_activity,to_activity,direction\n",
+    'ge_placetypes.csv': """\
+id,category,url,svg,color,prominence,terra
+start,track,http://x/start.png,start,green,1,
+stop,track,http://x/stop.png,stop,red,1,
+pause,track,http://x/pause.png,pause,blue,1,
+village,place,http://x/v.png,village,black,5,
+gestart,dyn,http://x/s.png,,red,9,
+gepeak,dyn,http://x/s.png,,red,9,
+gebottom,dyn,http://x/s.png,,red,9,
+""",
+    'ge_svg_icons.svg': "",
+}
+
+
+class ConfigTestCase(unittest.TestCase):
+    """
+    kajgps with the config files of CONFIG (and ge_places.csv of a
+    SyntheticTrack) in a temporary directory, self.dir_
+    """
+    PLACES_TRACK = kajbench.SyntheticTrack(2000, places_per_km=2)
+    GLOBALS = ['_config_file_dir', '_svg_icon_file', '_config_snapshot_file',
+               '_snapshot', '_snapshot_changed', '_decimate', '_budget_mb',
+               '_split']
+
+    def setUp(self):
+        self.dir_ = tempfile.mkdtemp(prefix="kajgps_test")
+        self.saved = dict((name, getattr(kajgps, name))
+                          for name in self.GLOBALS)
+        self.saved_dirs = dict((name, conf['dir_']) for name, conf
+                               in kajgps.config_files.items())
+        self.write_config()
+        self.use_config(self.dir_)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(kajgps, name, value)
+        for name, dir_ in self.saved_dirs.items():
+            kajgps.config_files[name]['dir_'] = dir_
+        kajgps._lazy_config()
+        shutil.rmtree(self.dir_)
+
+    def write_config(self, **files):
+        """CONFIG and files ({filename: contents}) into self.dir_"""
+        contents = dict(CONFIG, **files)
+        for filename, text in contents.items():
+            with open(self.path(filename), "w") as f:
+                f.write(text)
+        if 'ge_places.csv' not in files:
+            self.PLACES_TRACK.save_as(self.path('ge_places.csv'))
+
+    def use_config(self, dir_):
+        kajgps._config_file_dir = dir_
+        for conf in kajgps.config_files.values():
+            conf['dir_'] = dir_
+        kajgps._svg_icon_file = os.path.join(dir_, 'ge_svg_icons.svg')
+        kajgps._config_snapshot_file = os.path.join(dir_, 'snapshot.marshal')
+        kajgps._snapshot = None
+        kajgps._snapshot_changed = False
+        kajgps._lazy_config()
+
+    def path(self, filename):
+        return os.path.join(self.dir_, filename)
+
+    def synthetic(self, filename, points, **params):
+        """SyntheticTrack saved as self.dir_/filename"""
+        kajbench.SyntheticTrack(points, **params).save_as(self.path(filename))
+        return self.path(filename)
+
+    def read(self, filename):
+        with open(self.path(filename)) as f:
+            return f.read()
+
+    @staticmethod
+    def track(filename, **kwargs):
+        row = dict(kajbench.Benchmark.ROW, server_level=True)
+        row.update(kwargs)
+        return kajgps.Track(filename, **row)
+
+    @staticmethod
+    def segments(track):
+        """(first time, last time, activity, km) of each segment"""
+        return [(seg.first['tp'].datetime, seg.last['tp'].datetime,
+                 seg.activity_id, round(seg.distance, 3))
+                for seg in track.segments]
@@ -0,0 +1,68 @@
+# -*- coding: latin-1 -*-
+
+"""Batch: parallel groups give what one row after another gives"""
+
+import re
+
+from support import ConfigTestCase, kajbench, kajgps
+
+import kajlib as lib
+
+
+class BatchTest(ConfigTestCase):
+    def commands(self, rows):
+        with open(self.path('ge_commands.csv'), "w") as f:
+            f.write("command,mode,parameters,header,activity,lat,lon,km,"
+                    "infile,outfile\n")
+            for row in rows:
+                f.write(",".join(row) + "\n")
+        return list(lib.Config(enumerate_rows=True,
+                               **kajgps.config_files['Commands']))
+
+    def run_batch(self, rows, processes):
+        kajgps._lazy_config()  # As when kajgps.py starts
+        lib.start_log("BatchTest")
+        batch = kajgps.Batch(rows, kajgps.Command.__new__(kajgps.Command),
+                             processes)
+        batch.run()
+        return batch
+
+    def test_barrier_places_row_parallel(self):
+        """Tracks after a Places row use its places, also in parallel"""
+        other_places = self.path("other_places.csv")
+        with open(other_places, "w") as f:
+            f.write("placemark,descr,placetype_id,prominence,lat,lon,alt,"
+                    "folder,color\nOther start,,village,5,%s,%s,0,,\n" %
+                    (kajbench.SyntheticTrack.LAT, kajbench.SyntheticTrack.LON))
+        infiles = [self.synthetic("a.gpx", 1500),
+                   self.synthetic("b.gpx", 1500, seed=2)]
+        outputs = {}
+        for processes in (1, 4):
+            outfiles = [self.path("%s_%s.kml" % (name, processes))
+                        for name in "ab"]
+            rows = self.commands(
+                [["Places", "", "", "", "", "", "", "", other_places, ""]] +
+                [["Track", "", "", "Test", "run", "", "", "", infile,
+                  outfile] for infile, outfile in zip(infiles, outfiles)])
+            batch = self.run_batch(rows, processes)
+            self.assertEqual(len(batch.groups), 3)
+            outputs[processes] = []
+            for outfile in outfiles:
+                with open(outfile) as f:  # Without the time saved
+                    outputs[processes].append(re.sub(
+                        r"<!-- Copyright .* -->", "", f.read()))
+        for kml in outputs[1]:
+            self.assertIn("Other start", kml)
+        self.assertEqual(outputs[1], outputs[4])
+
+    def test_svg_rows_wait_for_svgmerge(self):
+        icons = kajgps._svg_icon_file
+        rows = self.commands([
+            ["SVGMerge", "", "", "", "", "", "", "", self.dir_, icons],
+            ["Track", "", "", "Test", "run", "", "", "", "a.gpx", "a.svg"],
+            ["Track", "", "", "Test", "run", "", "", "", "b.gpx", "b.kml"]])
+        batch = kajgps.Batch(rows, None, processes=4)
+        levels = [group['level'] for group in batch.groups]
+        self.assertEqual(levels, [0, 1, 0])
+        self.assertIn(icons.replace(".svg", "-demo.svg"),
+                      batch.groups[0]['writes'])
@@ -0,0 +1,57 @@
+# -*- coding: latin-1 -*-
+
+"""kajbench synthetic tracks and baselines, kajdiff comparisons"""
+
+import json
+import re
+
+from support import ConfigTestCase
+
+import kajbench
+import kajdiff
+
+
+class SyntheticTrackTest(ConfigTestCase):
+    def test_deterministic(self):
+        lines = list(kajbench.SyntheticTrack(500).gpx_lines())
+        self.assertEqual(list(kajbench.SyntheticTrack(500).gpx_lines()),
+                         lines)
+        self.assertNotEqual(list(kajbench.SyntheticTrack(
+            500, seed=2).gpx_lines()), lines)
+
+    def test_formats(self):
+        """GPX, kajgps CSV and Columbus CSV give the same track"""
+        segments = [self.segments(self.track(self.synthetic(
+            "track." + file_format, 3000, seconds=5, breaks=2)))
+            for file_format in ("gpx", "csv", "CSV")]
+        self.assertGreater(len(segments[0]), 1)
+        self.assertEqual(segments[1], segments[0])
+        self.assertEqual(segments[2], segments[0])
+
+
+class BenchmarkTest(ConfigTestCase):
+    def test_baseline(self):
+        bench = kajbench.Benchmark([300], formats=("gpx",))
+        results = bench.run()
+        stages = set(result['stage'] for result in results)
+        for stage in ("import", "export json", "Tracklist scan",
+                      "TrackCache svg"):
+            self.assertIn(stage, stages)
+        bench.save_as(self.path("baseline.json"))
+        with open(self.path("baseline.json")) as f:
+            self.assertEqual(json.load(f)['results'], results)
+        lines = bench.compare(self.path("baseline.json")).splitlines()
+        self.assertEqual(len(lines), 3 + len(results))
+
+
+class DifferencesTest(ConfigTestCase):
+    def test_tolerance(self):
+        differences = kajdiff.Differences(0.01, [re.compile(r"\d\d:\d\d")])
+        differences.json("", {'km': 10.0, 'name': "a 1.00 at 12:00"},
+                         {'km': 10.05, 'name': "a 1.001 at 13:30"})
+        self.assertEqual(len(differences), 0)
+        self.assertEqual(differences.tolerated, 2)
+        differences.json("", {'km': 10.0, 'list': [1]},
+                         {'km': 11.0, 'list': [1, 2]})
+        self.assertEqual([path for path, ref, new in differences.list],
+                         ["/km", "/list (length)"])
@@ -0,0 +1,45 @@
+# -*- coding: latin-1 -*-
+
+"""Memory budget (-budget): chunked analysis as of the track in one go"""
+
+from support import ConfigTestCase, kajbench, kajgps
+
+
+class BudgetTest(ConfigTestCase):
+    def test_chunks_as_one_go(self):
+        filename = self.synthetic("long.gpx", 25000, breaks=6)
+        whole = self.track(filename)
+        chunked = self.track(filename, budget_mb=1)  # 10000 points a chunk
+        self.assertEqual(self.segments(whole), self.segments(chunked))
+        self.assertAlmostEqual(whole.net_dist, chunked.net_dist, places=6)
+        self.assertEqual(whole.net_duration_s, chunked.net_duration_s)
+        self.assertLess(len(chunked.trackpoints), len(whole.trackpoints))
+
+    def test_within_budget(self):
+        """Trackpoints as imported, text and all"""
+        filename = self.synthetic("short.gpx", 2000)
+        whole = self.track(filename)
+        within = self.track(filename, budget_mb=100)
+        self.assertEqual([tp.__dict__ for tp in whole.trackpoints],
+                         [tp.__dict__ for tp in within.trackpoints])
+
+    def test_plan(self):
+        lat, lon = kajbench.SyntheticTrack.LAT, kajbench.SyntheticTrack.LON
+        with open(self.path("plan.csv"), "w") as f:
+            f.write("placemark,date,time,lat,lon,break,speed\n"
+                    "Start,2000-01-01,08:00:00,%s,%s,,5\n"
+                    "Lunch,,,%s,%s,01:00:00,\n"
+                    "Stop,,,%s,%s,,\n" % (lat, lon, lat + 0.05, lon,
+                                          lat + 0.05, lon + 0.05))
+        plan = self.track(self.path("plan.csv"), budget_mb=100)
+        self.assertEqual([tp.text for tp in plan.trackpoints],
+                         ["Start", "Lunch", "+ 01:00:00", "Stop"])
+        self.assertEqual(self.segments(self.track(self.path("plan.csv"))),
+                         self.segments(plan))
+
+    def test_not_with_split(self):
+        """Chunks are not split by day, so -split is refused"""
+        self.assertEqual(kajgps._track_options(["kajgps.py", "-budget=1"]),
+                         ["kajgps.py"])
+        with self.assertRaises(Exception):
+            kajgps._track_options(["kajgps.py", "-split=day"])
@@ -0,0 +1,76 @@
+# -*- coding: latin-1 -*-
+
+"""The kajgps server (-serve): files within its root, JSON replies"""
+
+import json
+import os
+import shutil
+import threading
+import urllib
+import urllib2
+
+from support import ConfigTestCase, kajgps
+
+
+class DaemonTest(ConfigTestCase):
+    def setUp(self):
+        super(DaemonTest, self).setUp()
+        self.root = self.path("root")
+        os.mkdir(self.root)
+        shutil.copy(self.synthetic("a.gpx", 1500),
+                    os.path.join(self.root, "a.gpx"))
+        shutil.copy(self.path("a.gpx"), os.path.join(self.root, "a"))
+        command = kajgps.Command.__new__(kajgps.Command)
+        command.params = {'i': None, 'o': None, 'log': None, 'f': None,
+                          'iactivity': 'run', 'ifmt': 'gpx', 'ofmt': 'json',
+                          'serve': None, 'root': self.root}
+        self.server = kajgps._HTTPDaemon(("127.0.0.1", 0),
+                                         kajgps._DaemonRequest)
+        self.server.defaults = dict(command.params)
+        self.server.root = os.path.realpath(self.root)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(DaemonTest, self).tearDown()
+
+    def get(self, **params):
+        """(status, JSON reply)"""
+        url = "http://127.0.0.1:%s/?%s" % (self.server.server_address[1],
+                                          urllib.urlencode(params))
+        try:
+            reply = urllib2.urlopen(url)
+        except urllib2.HTTPError as e:
+            reply = e
+        return reply.getcode(), json.loads(reply.read())
+
+    def test_files_within_root(self):
+        status, reply = self.get(i="a.gpx", o="out.json")
+        self.assertEqual((status, reply['success']), (200, True))
+        self.assertTrue(os.path.exists(os.path.join(self.root, "out.json")))
+        self.assertEqual(self.get(i="../a.gpx")[0], 403)
+        outside = self.path("outside.json")
+        self.assertEqual(self.get(i="a.gpx", o=outside)[0], 403)
+        self.assertFalse(os.path.exists(outside))
+
+    def test_input_format(self):
+        """ifmt for files without a suffix telling the format"""
+        status, reply = self.get(i="a", ifmt="gpx")
+        self.assertEqual(status, 200)
+        self.assertIn('layers', reply)
+
+    def test_error_json(self):
+        status, reply = self.get(i='no "such"\\\nfile.gpx')
+        self.assertEqual(status, 500)
+        self.assertFalse(reply['success'])
+
+    def test_merge_error(self):
+        """Overlapping track times: an error, and no output file"""
+        status, reply = self.get(i="a.gpx,a.gpx", o="out.kml")
+        self.assertEqual((status, reply['errcode']), (409, 7001))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "out.kml")))
+        status, reply = self.get(i="a.gpx,a.gpx", ofmt="kml")
+        self.assertEqual((status, reply['success']), (409, False))
@@ -0,0 +1,70 @@
+# -*- coding: latin-1 -*-
+
+"""Track._decimate: fewer points from fast-recording devices"""
+
+import datetime
+
+from support import ConfigTestCase, kajgps
+
+import kajlib as lib
+
+
+class DecimateTest(ConfigTestCase):
+    START = datetime.datetime(2000, 1, 1, 8, 0, 0)
+
+    def track_of(self, *points):
+        """Track of (lat, lon, seconds from START)"""
+        track = kajgps.Track(None, mode="empty")
+        track.trackpoints = [
+            kajgps.Trackpoint(lat, lon, self.START + datetime.timedelta(
+                seconds=seconds), 0) for lat, lon, seconds in points]
+        return track
+
+    def test_same_second(self):
+        """One point per second, the first one"""
+        track = self.track_of((60.0, 22.0, 0), (60.1, 22.0, 0),
+                              (60.2, 22.0, 1), (60.3, 22.0, 1),
+                              (60.4, 22.0, 1), (60.5, 22.0, 2))
+        track._decimate()
+        self.assertEqual([tp.lat for tp in track.trackpoints],
+                         [60.0, 60.2, 60.5])
+        self.assertEqual(track.decimation,
+                         {'kept': 3, 'same second': 3, 'close': 0})
+
+    def test_last_point(self):
+        """Close points are dropped, but not the last one"""
+        track = self.track_of(*[(60.0 + i * 0.00001, 22.0, i)
+                                for i in range(5)])
+        track._decimate(metres=10)
+        self.assertEqual([tp.lat for tp in track.trackpoints],
+                         [60.0, 60.00004])
+        self.assertEqual(track.decimation,
+                         {'kept': 2, 'same second': 0, 'close': 3})
+
+    def test_counters(self):
+        track = self.track_of(*[(60.0 + i * 0.00001, 22.0, i // 2)
+                                for i in range(10)])
+        lib.start_stats()
+        try:
+            track._decimate(metres=20, seconds=2)
+        finally:
+            counters = lib.stop_stats()['counters']
+        self.assertEqual(counters, {
+            'points kept': track.decimation['kept'],
+            'points dropped, same second': 5,
+            'points dropped, close': track.decimation['close']})
+        self.assertEqual(sum(track.decimation.values()), 10)
+        self.assertEqual([tp.lat for tp in track.trackpoints],
+                         [60.0, 60.00008])  # Last second, its first fix
+
+    def test_breaks(self):
+        """The breaks found stay, and the segment starts stay close"""
+        filename = self.synthetic("a.gpx", 6000)
+        whole = self.segments(self.track(filename))
+        decimated = self.segments(self.track(filename, decimate=(5, 2)))
+        self.assertGreater(len(whole), 2)
+        self.assertEqual(len(decimated), len(whole))
+        for (start, end, _, _), (d_start, d_end, _, _) in zip(whole,
+                                                             decimated):
+            self.assertLessEqual(abs((d_start - start).total_seconds()), 30)
+            self.assertLessEqual(abs((d_end - end).total_seconds()), 30)
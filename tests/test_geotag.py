@@ -0,0 +1,64 @@
+# -*- coding: latin-1 -*-
+
+"""Photo times of Geotag: EXIF DateTimeOriginal, else the file time"""
+
+import datetime
+import os
+import struct
+
+from support import ConfigTestCase, kajgps
+
+
+def exif_jpeg(date_time, order="II"):
+    """Minimal JPEG with IFD0 -> EXIF IFD -> DateTimeOriginal"""
+    end = "<" if order == "II" else ">"
+    value = date_time + "\x00"
+    tiff = (order + struct.pack(end + "HI", 42, 8) +
+            struct.pack(end + "HHHII", 1, 0x8769, 4, 1, 26) +
+            struct.pack(end + "I", 0) +
+            struct.pack(end + "HHHII", 1, 0x9003, 2, len(value), 44) +
+            struct.pack(end + "I", 0) + value)
+    app1 = "Exif\x00\x00" + tiff
+    return ("\xff\xd8\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 +
+            "\xff\xda\x00\x02\xff\xd9")
+
+
+class GeotagPhotoTest(ConfigTestCase):
+    def write(self, filename, data):
+        with open(self.path(filename), "wb") as f:
+            f.write(data)
+        return self.path(filename)
+
+    def test_exif_datetime(self):
+        for order in ("II", "MM"):
+            filename = self.write("a.jpg", exif_jpeg("2015:06:01 10:11:12",
+                                                     order))
+            self.assertEqual(kajgps.Geotag._exif_datetime(filename),
+                             "2015:06:01 10:11:12")
+        self.assertIsNone(kajgps.Geotag._exif_datetime(self.write(
+            "b.jpg", "\xff\xd8\xff\xda\x00\x02\xff\xd9")))
+        self.assertIsNone(kajgps.Geotag._exif_datetime(self.write(
+            "c.jpg", "\xff\xd8\xff\xe1\x00")))
+        self.assertIsNone(kajgps.Geotag._exif_datetime(self.write(
+            "d.png", "\x89PNG")))
+
+    def test_read_photos(self):
+        self.write_config(**{'ge_day_metadata.csv':
+                             "date,activity_id,timezone,name,distance,"
+                             "comment\n2015-06-01,run,120,,,\n"})
+        self.use_config(self.dir_)
+        photo_dir = os.path.join(self.dir_, "photos")
+        os.mkdir(photo_dir)
+        self.write("photos/a.jpg", exif_jpeg("2015:06:01 10:11:12"))
+        mtime = self.write("photos/b.jpg", "\xff\xd8\xff\xd9")
+        utc = datetime.datetime(2015, 6, 1, 12, 0, 0)
+        seconds = (utc - datetime.datetime(1970, 1, 1)).total_seconds()
+        os.utime(mtime, (seconds, seconds))
+        bugs = kajgps.userbug.bug_count
+        geotag = kajgps.Geotag.__new__(kajgps.Geotag)
+        photos = dict((photo['filename'], photo['datetime'])
+                      for photo in geotag._read_photos(photo_dir))
+        self.assertEqual(photos, {
+            'a.jpg': datetime.datetime(2015, 6, 1, 10, 11, 12),
+            'b.jpg': datetime.datetime(2015, 6, 1, 14, 0, 0)})
+        self.assertEqual(kajgps.userbug.bug_count, bugs + 1)
@@ -0,0 +1,35 @@
+# -*- coding: latin-1 -*-
+
+"""Command.merge_tracks: files parsed, the merged track analysed once"""
+
+import json
+
+from support import ConfigTestCase, kajgps
+
+
+class MergeTest(ConfigTestCase):
+    def setUp(self):
+        super(MergeTest, self).setUp()
+        with open(self.synthetic("whole.csv", 3000, seconds=5)) as f:
+            lines = f.readlines()
+        half = len(lines) // 2
+        for filename, rows in (("a.csv", lines[1:half]),
+                               ("b.csv", lines[half:])):
+            with open(self.path(filename), "w") as f:
+                f.writelines([lines[0]] + rows)
+
+    def merged(self, *filenames):
+        return kajgps.Command.merge_tracks(
+            [self.path(filename) for filename in filenames], "run")
+
+    def test_same_as_one_file(self):
+        whole = self.track(self.path("whole.csv"))
+        merged, error = self.merged("b.csv", "a.csv")  # Sorted by time
+        self.assertEqual(error, "")
+        self.assertGreater(len(whole.segments), 1)
+        self.assertEqual(self.segments(merged), self.segments(whole))
+        self.assertEqual(merged.net_dist, whole.net_dist)
+
+    def test_overlap(self):
+        merged, error = self.merged("a.csv", "whole.csv")
+        self.assertEqual(json.loads(error)['errcode'], 7001)
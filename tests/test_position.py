@@ -0,0 +1,77 @@
+# -*- coding: latin-1 -*-
+
+"""Track.position_at_time and position_at_distance, and their users"""
+
+import datetime
+
+from support import ConfigTestCase, kajgps
+
+import kajresample as resample
+
+
+class PositionTest(ConfigTestCase):
+    START = datetime.datetime(2000, 1, 1, 8, 0, 0)
+
+    def track_of(self, *points):
+        """Track of (lat, lon, alt, seconds from START)"""
+        track = kajgps.Track(None, mode="empty")
+        track.trackpoints = [
+            kajgps.Trackpoint(lat, lon, self.START + datetime.timedelta(
+                seconds=seconds), alt) for lat, lon, alt, seconds in points]
+        return track
+
+    def test_outside_track(self):
+        track = self.track_of((60.0, 22.0, 0, 0), (60.01, 22.0, 10, 100))
+        second = datetime.timedelta(seconds=1)
+        self.assertIsNone(track.position_at_time(self.START - second))
+        self.assertIsNone(track.position_at_time(
+            self.START + 101 * second))
+        self.assertIsNone(track.position_at_distance(-0.001))
+        self.assertIsNone(track.position_at_distance(1.2))
+        self.assertIsNone(self.track_of().position_at_time(self.START))
+
+    def test_interpolation(self):
+        track = self.track_of((60.0, 22.0, 0, 0), (60.01, 22.0, 10, 100))
+        tp = track.position_at_time(self.START + datetime.timedelta(
+            seconds=25))
+        self.assertAlmostEqual(tp.lat, 60.0025)
+        self.assertAlmostEqual(tp.alt, 2.5)
+        km = track.distance_along_path(0, 1)
+        tp = track.position_at_distance(km / 2)
+        self.assertAlmostEqual(tp.lat, 60.005)
+        self.assertEqual(tp.datetime, self.START + datetime.timedelta(
+            seconds=50))
+        self.assertEqual(track.position_at_distance(km).lat, 60.01)
+
+    def test_duplicate_timestamps(self):
+        """The first point of a time, then on from the last one"""
+        track = self.track_of((60.0, 22.0, 0, 0), (60.01, 22.0, 0, 10),
+                              (60.02, 22.0, 0, 10), (60.03, 22.0, 0, 20))
+        at = lambda seconds: track.position_at_time(
+            self.START + datetime.timedelta(seconds=seconds)).lat
+        self.assertAlmostEqual(at(10), 60.01)
+        self.assertAlmostEqual(at(15), 60.025)
+        self.assertAlmostEqual(at(20), 60.03)
+
+    def test_milestones(self):
+        track = self.track(self.synthetic("run.gpx", 3000))
+        track.calc_milestones()
+        tps = track.compressed.trackpoints
+        lats, lons, seconds = track.columns(tps)
+        dists = resample.cumulative_distances(lats, lons)
+        dists, (lats, lons) = resample.resample(dists, [lats, lons], 1.0)
+        self.assertEqual(len(track.milestones), len(dists))
+        for milestone, lat, lon in zip(track.milestones, lats, lons):
+            self.assertAlmostEqual(milestone.lat, lat)
+            self.assertAlmostEqual(milestone.lon, lon)
+
+    def test_slope_colour(self):
+        """Downhill slope around a point, in degrees"""
+        track = self.track_of(*[(60.0 + 0.0001 * i, 22.0, 100 - 2 * i, i)
+                                for i in range(120)])
+        self.assertEqual(track.timepoint_color(track.trackpoints[60]),
+                         "Blue")  # atan(2 / 11,1) = 10 degrees
+        track = self.track_of(*[(60.0 + 0.0001 * i, 22.0, 100, i)
+                                for i in range(120)])
+        self.assertEqual(track.timepoint_color(track.trackpoints[60]),
+                         "Grey")
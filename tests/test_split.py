@@ -0,0 +1,47 @@
+# -*- coding: latin-1 -*-
+
+"""Track split by day (-split): the segments of a track in one go"""
+
+from support import ConfigTestCase, kajbench
+
+
+class SawtoothTrack(kajbench.SyntheticTrack):
+    """Up and down every 200 points, with sharp peaks (see
+    Segment.parse_segment_for_peaks)"""
+    def trackpoints(self):
+        points = super(SawtoothTrack, self).trackpoints()
+        for i, (lat, lon, alt, a_datetime) in enumerate(points):
+            yield lat, lon, 10 + 2 * abs(i % 200 - 100), a_datetime
+
+
+class SplitTest(ConfigTestCase):
+    def assertSameSegments(self, filename, **kwargs):
+        whole = self.segments(self.track(filename, **kwargs))
+        by_day = self.segments(self.track(filename, split="day", **kwargs))
+        self.assertEqual(whole, by_day)
+        return whole
+
+    def test_transit_track(self):
+        """Segments split at a forced break are not joined again"""
+        lat, lon, alt, a_datetime = list(
+            kajbench.SyntheticTrack(2000).trackpoints())[200]
+        self.write_config(**{'ge_forced_breaks.csv':
+            "text,lat,lon,from_activity,to_activity,direction\n"
+            "Ferry,%s,%s,run,run,\n" % (lat, lon)})
+        self.use_config(self.dir_)
+        filename = self.synthetic("transit.gpx", 2000)
+        segments = self.assertSameSegments(filename)
+        self.assertIn(a_datetime, [seg[0] for seg in segments])
+
+    def test_downhill_track(self):
+        """Segments split at peaks are not joined again"""
+        filename = self.path("downhill.gpx")
+        SawtoothTrack(1000, breaks=0).save_as(filename)
+        segments = self.assertSameSegments(filename, activity_id="downhill")
+        self.assertGreater(len(segments), 4)
+
+    def test_over_midnight(self):
+        """A segment going on over midnight is one segment"""
+        filename = self.synthetic("midnight.gpx", 1800, seconds=30, breaks=2,
+                                  climbs=0)
+        self.assertSameSegments(filename)
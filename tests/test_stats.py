@@ -0,0 +1,36 @@
+# -*- coding: latin-1 -*-
+
+"""Counters of -stats: the hot paths of _COUNTED, by the work done"""
+
+from support import ConfigTestCase, kajgps
+
+import kajlib as lib
+
+
+class CounterTest(ConfigTestCase):
+    def counters(self, func):
+        lib.start_stats(counted=kajgps._COUNTED)
+        try:
+            result = func()
+        finally:
+            stats = lib.stop_stats()
+        return result, stats['counters']
+
+    def test_closest_placemarks(self):
+        places = kajgps.Places(self.path('ge_places.csv'))
+        points = [kajgps.Point(60.0 + i * 0.01, 22.0, 0, "")
+                  for i in range(5)]
+        one, one_counters = self.counters(
+            lambda: [places.closest_placemark(point) for point in points])
+        many, many_counters = self.counters(
+            lambda: places.closest_placemarks(points))
+        self.assertEqual([pm.text for pm in many], [pm.text for pm in one])
+        self.assertEqual(many_counters, one_counters)
+        self.assertEqual(many_counters['closest_placemark calls'], 5)
+        self.assertGreater(many_counters['haversine calls'], 5)
+
+    def test_no_places(self):
+        places = kajgps.Places(None)
+        points = [kajgps.Point(60.0, 22.0, 0, "")] * 3
+        _, counters = self.counters(lambda: places.closest_placemarks(points))
+        self.assertEqual(counters, {'closest_placemark calls': 3})
@@ -0,0 +1,54 @@
+# -*- coding: latin-1 -*-
+
+"""Timetable: segments from the tracks, or from a track cache"""
+
+import os
+import re
+from collections import namedtuple
+
+from support import ConfigTestCase, kajgps
+
+Command = namedtuple('Command', kajgps.config_files['Commands']['fields'])
+
+
+class TimetableTest(ConfigTestCase):
+    def setUp(self):
+        super(TimetableTest, self).setUp()
+        self.write_config(**{'ge_areas.csv': "# area,sub_areas\nTest,%s\n" %
+                             ",".join("Place %s" % i for i in range(100))})
+        self.use_config(self.dir_)
+        self.tracks = self.path("tracks")
+        os.mkdir(self.tracks)
+        os.rename(self.synthetic("run.gpx", 1500),
+                  os.path.join(self.tracks, "run.gpx"))
+        self.cache = self.path("cache")
+        kajgps.Tracklist(self.tracks, mode="cache",
+                         parameters="").save_as(self.cache)
+
+    def timetable(self, parameters, mode=""):
+        """As made by Command.execute_rows, from a ge_commands.csv row"""
+        row = Command("Timetable", mode, parameters, "Test", "run", "", "",
+                      "", self.tracks, self.path("timetable.svg"))
+        return kajgps.Timetable(**kajgps.Command.as_dict(row))
+
+    def test_cache_or_tracks(self):
+        from_cache = self.timetable("landscape " + self.cache)
+        self.assertEqual(from_cache.cache_dir, self.cache)
+        from_tracks = self.timetable("landscape")
+        self.assertEqual(from_tracks.cache_dir, "")
+        blocks = [re.sub(r"<!-- Green Elk .*|Green Elk \d.*", "",
+                         timetable.as_svg())
+                  for timetable in (from_cache, from_tracks)]
+        self.assertEqual(blocks[0], blocks[1])
+        self.assertIsNone(from_cache.tracklist)  # No track read
+
+    def test_minutes_from_tracks(self):
+        """Minute modes read the tracks of infile, also with a cache"""
+        timetable = self.timetable("portrait " + self.cache, mode="hours")
+        timetable.as_svg()
+        self.assertTrue(timetable.tracklist.tracks[0]['track'].timepoints)
+
+    def test_batch_reads_cache(self):
+        row = Command("Timetable", "", "portrait " + self.cache, "", "", "",
+                      "", "", self.tracks, "t.svg")
+        self.assertIn(self.cache, kajgps.Batch.reads(row))